@@ -7,6 +7,7 @@ import os
 import sys
 import glob
 import time
+import json
 import pickle
 import shutil
 import logging
@@ -21,6 +22,9 @@ import iproc.steps as iProcSteps
 
 import iproc.qc as qc
 import iproc.bids as bids
+import iproc.codec as codec
+import iproc.engines as engines
+import iproc.ingest as ingest
 import iproc.commons as commons
 import iproc.executors as executors
 
@@ -61,7 +65,19 @@ def setup(steps,args):
     os.makedirs(dcm2nii_qdir) 
     logger.info('created empty Qdir')
 
-    if args.bids:
+    if args.batch_ingest:
+        # one job per session (or subject) for every image, instead of one per image
+        job_spec_list = steps.ingest_from_bids_batched(overwrite=args.overwrite, per=args.batch_ingest)
+        status_files = [j.cmd[j.cmd.index('--status') + 1] for j in job_spec_list]
+        try:
+            rmfiles += execute(args.executor, job_spec_list,steps, **ingest_bids_cluster(args))
+        finally:
+            if not args.dry_run:
+                failed = ingest.report(status_files)
+                if failed:
+                    logger.error(f'{len(failed)} images failed to ingest, see the logs above')
+
+    elif args.bids:
         job_spec_list = steps.fmap_from_bids(overwrite=args.overwrite)
         rmfiles += execute(args.executor, job_spec_list,steps, throttle=10, **args.cluster['ingest_fieldmap'])
 
@@ -338,9 +354,6 @@ def unwarp_motioncorrect_align(steps,args):
     for qc_pdf in qc_pdfs:
         logger.info(qc_pdf)
     logger.info('done with unwarp_motioncorrect_align preprocessing! Check QC PDFs above by flipping through and looking for major changes in the location of sulci and gyri, then proceed to T1_warp_and_mask')
-    if os.path.exists(steps.rm_dump_filename):
-        # if this is a rerun, we would want to skip that bc the rm_dump_filename will not exist
-        os.rename(steps.rm_dump_filename,steps.rm_final_filename)
 
     return rmfiles
 
@@ -697,6 +710,43 @@ def QC_warp(steps, outdir,merge_filter,header_images,ax_slicer,sag_slicer,task_s
        joblist.append(sag_job) 
     return joblist
 
+def filter_and_project_graph(steps, args):
+    '''
+    the steps of filter_and_project and what each one needs. The MNI and NAT
+    branches only share calculate_nuisance_params, and the projection of a
+    run to the surface only waits on the NAT outputs of that run.
+    '''
+    res = conf.out_atlas.RESOLUTION
+    graph = executors.PipelineGraph()
+    graph.add_step('calculate_nuisance_params', steps.calculate_nuisance_params(overwrite=args.overwrite),
+        args.cluster['calculate_nuisance_params'])
+    # afni: 3dTproject, 3dBandpass and 3dTproject again, as three steps that
+    #each read their input from disk. numpy: the single denoise step
+    separate = engines.engine('REGRESS') == 'afni'
+    for space,suffix in [(f'MNI{res}','mni'), (f'NAT{res}','anat')]:
+        if separate:
+            graph.add_step(f'nuisance_regress_{suffix}', steps.nuisance_regress(space, overwrite=args.overwrite),
+                args.cluster[f'nuisance_regress_{suffix}'], after=['calculate_nuisance_params'])
+            graph.add_step(f'bandpass_{suffix}', steps.bandpass(space, overwrite=args.overwrite),
+                args.cluster[f'bandpass_{suffix}'], after=[f'nuisance_regress_{suffix}'])
+            # only needs the outputs of combine_and_apply_warp
+            graph.add_step(f'wholebrain_only_regress_{suffix}', steps.wholebrain_only_regress(space, overwrite=args.overwrite),
+                args.cluster[f'wholebrain_only_regress_{suffix}'])
+        else:
+            # single-echo: nuisance regression, bandpass and wholebrain-only
+            #regression from one read of the data. multi-echo: bandpass only
+            graph.add_step(f'denoise_{suffix}', steps.denoise(space, overwrite=args.overwrite),
+                denoise_cluster(args, suffix), after=['calculate_nuisance_params'])
+            graph.add_step(f'bandpass_{suffix}', steps.bandpass(space, overwrite=args.overwrite, multi_echo_only=True),
+                args.cluster[f'bandpass_{suffix}'], after=['calculate_nuisance_params'])
+    if separate:
+        fs6_after = ['bandpass_anat', 'wholebrain_only_regress_anat']
+    else:
+        fs6_after = ['denoise_anat', 'bandpass_anat']
+    graph.add_step('fs6_project_to_surface', steps.fs6_project_to_surface(overwrite=args.overwrite),
+        args.cluster['fs6_project_to_surface'], after=fs6_after) #maybe 150GB
+    return graph
+
 def filter_and_project(steps, args):
 
     steps.load_rmfile_dump('unwarp_motioncorrect_align')
@@ -706,30 +756,17 @@ def filter_and_project(steps, args):
     ## Single-echo: calc nuisance, nuisance regress, bandpass, wholebrain, and projec to surf ###
     ### Multi-echo: only calc nuisance, bandpass, and projec to surf
 
-    job_spec_list = steps.calculate_nuisance_params(overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['calculate_nuisance_params'])
-    ## can these be run all at the same time? I think so
-
-    #MNI
-    res = conf.out_atlas.RESOLUTION
-    job_spec_list = steps.nuisance_regress(f'MNI{res}', overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['nuisance_regress_mni'])
-    job_spec_list = steps.bandpass(f'MNI{res}', overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['bandpass_mni'])
-    job_spec_list = steps.wholebrain_only_regress(f'MNI{res}', overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['wholebrain_only_regress_mni'])
-
-    #T1
-    job_spec_list = steps.nuisance_regress(f'NAT{res}', overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['nuisance_regress_anat'])
-    job_spec_list = steps.bandpass(f'NAT{res}', overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['bandpass_anat'])
-    job_spec_list = steps.wholebrain_only_regress(f'NAT{res}', overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['wholebrain_only_regress_anat'])
-
-    # step 6
-    job_spec_list = steps.fs6_project_to_surface(overwrite=args.overwrite)
-    rmfiles += execute(args.executor,job_spec_list,steps,**args.cluster['fs6_project_to_surface']) #maybe 150GB
+    graph = filter_and_project_graph(steps, args)
+    if args.sequential or args.array or args.single_file:
+        # one step at a time, each one waits for every job of the one before.
+        #job arrays and --single-file limit the jobs of one step, so they need it too
+        if not args.sequential:
+            logger.info('running the steps of filter_and_project one after the other, for --array/--single-file')
+        for step in graph.steps.values():
+            rmfiles += execute(args.executor,step.job_spec_list,steps,**step.kwargs)
+    else:
+        # submit everything at once, each run moves through the steps on its own
+        rmfiles += execute_graph(args.executor, graph, steps)
 
     logger.info('iProc completed')
     #os.rename(steps.rm_dump_filename,steps.rm_final_filename)
@@ -740,6 +777,16 @@ def filter_and_project(steps, args):
 # helpers
 ##
 
+def ingest_bids_cluster(args):
+    # cluster requests files from before batched ingest do not have it,
+    #ingest_task is the largest of the requests of the jobs it replaces
+    return args.cluster.get('ingest_bids_batch', args.cluster['ingest_task'])
+
+def denoise_cluster(args, suffix):
+    # cluster requests files from before the denoise step do not have it,
+    #it needs about what nuisance_regress needs, plus a copy of the data
+    return args.cluster.get(f'denoise_{suffix}', args.cluster[f'nuisance_regress_{suffix}'])
+
 def execute(executor_type, job_spec_list,steps, **kwargs):
     # short-circuit if step is set to "SKIP"
     if kwargs['RUNMODE'] == 'SKIP':
@@ -755,94 +802,11 @@ def execute(executor_type, job_spec_list,steps, **kwargs):
     if steps.args.dry_run:
         for job in job_spec_list:
             job.dummy = True
-    ## attach wrappers
-    if steps.args.singularity:
-        for j in job_spec_list:
-            # check for empty command
-            if j.skip:
-                continue
-            wrapper = os.path.join(conf.iproc.CODEDIR, 'wrappers','singularity_wrap.sh')
-            if steps.args.no_srun :
-                srun = "NO"
-            else:
-                srun = "YES"
-            def cpu(kwargs):
-                try:
-                    return str(kwargs['cpu'])
-                except KeyError:
-                    return str(1)
-            #ncf specific, will have to abstract
-            singularity_prefix = ['singularity', 'exec', '-e', steps.args.singularity, wrapper, conf.fs.SUBJECTS_DIR, srun, cpu(kwargs)]
-            j.prepend_cmd(singularity_prefix)
-            for dependent_job,_ in afterok_jobs(j):
-                dependent_job.prepend_cmd(singularity_prefix)
-
-    # non-singularity wrapper handling
-    if steps.args.wrap:
-        wrapper = os.path.join(conf.iproc.CODEDIR,'wrappers',steps.args.wrap)
-
-    if steps.args.user_wrap:
-        wrapper = steps.args.user_wrap
-
-    if steps.args.user_wrap or steps.args.wrap:
-        for j in job_spec_list:
-            if j.skip:
-                continue
-            prefix = [wrapper]
-            if steps.args.wrap_args:
-                prefix = prefix+steps.args.wrap_args
-            j.prepend_cmd(prefix)
-            for dependent_job,_ in afterok_jobs(j):
-                dependent_job.prepend_cmd(prefix)
+    attach_wrappers(job_spec_list, steps, kwargs)
 
     try:
         # could refactor all this to have child classes of executor object with internal type-specific logic, called here
-        if executor_type == 'local':
-            for job in job_spec_list:
-                # check for empty command
-                if job.skip:
-                    continue
-                if job.dummy:
-                    logger.info(job.cmd)
-                    continue
-                timestamp = time.time()
-                hostname = commons.check_output(['hostname']).strip()
-                job.stdout = job.logfile_base + f'_{hostname}_{timestamp}.out'
-                job.stderr = job.logfile_base + f'_{hostname}_{timestamp}.err'
-                stdout = open(job.stdout, 'w')
-                stderr = open(job.stderr, 'w')
-                logger.debug(job.cmd)
-                # run cmd, throw error if it fails
-                try:
-                    logger.debug(f'running {job.cmd}')
-                    commons.check_call(job.cmd, stdout=stdout, stderr=stderr)
-                    job.state = 'COMPLETED'
-                except Exception as e:
-                    logger.info(f'local script has failed: {e}')
-                    logger.info(job.stdout)
-                    logger.info(job.stderr)
-                    stdout.close()
-                    stderr.close()
-                    if skip_fail:
-                        continue
-                    raise commons.FailedJobError(job)
-                # run any dependent/afterok jobs
-                for dependent,_ in job.afterok:
-                    dependent.stdout = job.logfile_base + f'_{hostname}_{timestamp}.out'
-                    try:
-                        logger.debug(f'running dependent job: {dependent.cmd}')
-                        commons.check_call(dependent.cmd, stdout=stdout, stderr=stderr)
-                        dependent.state = 'COMPLETED'
-                    except Exception as e:
-                        logger.error(f'dependent job as failed {dependent.cmd}')
-                        logger.error(f'stdout: {job.stdout}')
-                        logger.error(f'stderr: {job.stderr}')
-                        stdout.close()
-                        stderr.close()
-                        if skip_fail:
-                            continue
-                        raise commons.FailedJobError(dependent)
-        elif executor_type in ['slurm', 'pbsubmit']:
+        if executor_type in ['local', 'slurm', 'pbsubmit']:
             if executor_type=='slurm':
                 if steps.args.sbatch_args: 
                     sbatch_arg_dict = {str(x):y for x,y in zip(list(range(len(steps.args.sbatch_args))),steps.args.sbatch_args)}
@@ -868,49 +832,175 @@ def execute(executor_type, job_spec_list,steps, **kwargs):
                 # check for empty command
                 kwargs_prep(kwargs,steps.args)
                 jobspec_kwargs.append((job_spec,kwargs))
-                if job_spec.afterok:
-                    for dependent_pair in job_spec.afterok:
-                        # for now, dependent jobs only play nice with throttling when there is one per job.
-                        dependent_job,afterok_kwargs=dependent_pair
-                        # skip afterOK part if parent job is a skipped job
-                        kwargs_prep(afterok_kwargs,steps.args)
-                        jobspec_kwargs.append((dependent_job,afterok_kwargs))
+                # for now, dependent jobs only play nice with throttling when there is one per job.
+                for dependent_job,afterok_kwargs in afterok_jobs(job_spec):
+                    kwargs_prep(afterok_kwargs,steps.args)
+                    jobspec_kwargs.append((dependent_job,afterok_kwargs))
             if jobspec_kwargs:
                 if skip_fail:
                     cancel=False
                 else:
                     cancel=True
 
+                watcher = None
+                if steps.args.notify:
+                    notify_dir = os.path.join(conf.iproc.LOGDIR, 'notify')
+                    notify_wrapper = os.path.join(conf.iproc.CODEDIR, 'wrappers', 'notify_exit.sh')
+                    watcher = executors.CompletionWatcher(notify_dir, notify_wrapper, max_interval=60 * steps.args.interval)
+
                 pickle_file = os.path.join(conf.iproc.RMFILE_DUMP, "save.p")
                 pickle.dump( jobspec_kwargs, open(pickle_file, "wb" ) )                
-                executors.rolling_submit(executor,jobspec_kwargs,job_limit,steps.args.interval,cancel_on_fail=cancel)
+                mark_started(job_spec_list, steps)
+                write_manifests(job_spec_list, steps)
+                if steps.args.array and executor_type == 'slurm':
+                    # one sbatch per step, with the throttle enforced by slurm
+                    array_dir = os.path.join(conf.iproc.LOGDIR, 'arrays')
+                    runner = os.path.join(conf.iproc.CODEDIR, 'wrappers', 'array_task.sh')
+                    throttle = None if job_limit == float('inf') else int(job_limit)
+                    executors.array_submit(executor,job_spec_list,kwargs,array_dir,runner,throttle,steps.args.interval,cancel_on_fail=cancel,watcher=watcher,collector=steps.collector)
+                else:
+                    executors.rolling_submit(executor,jobspec_kwargs,job_limit,steps.args.interval,cancel_on_fail=cancel,watcher=watcher,collector=steps.collector)
         else:
             raise NotImplementedError(f'executor type {executor_type} is not supported')
     except commons.FailedJobError as e:
-        post_process_jobs(job_spec_list,steps.args)
+        post_process_jobs(job_spec_list,steps.args,steps.provenance)
         raise e
-    post_process_jobs(job_spec_list,steps.args)
-    rmfiles = rmfiles_from_job_specs(job_spec_list)
+    post_process_jobs(job_spec_list,steps.args,steps.provenance)
+    rmfiles = release_rmfiles(job_spec_list,steps)
     if rmfiles:
         return rmfiles
     else:
         # so += works wherever we're calling this function from
         return []
 
+def execute_graph(executor_type, graph, steps):
+    '''
+    Like execute(), but for all steps of a PipelineGraph at once. Every job
+    is submitted up front, and waits in the queue on its own parents only, so
+    a run can move on to its next step while other runs are still busy.
+    '''
+    submit_graph = executors.PipelineGraph()
+    for step in graph.steps.values():
+        kwargs = dict(step.kwargs)
+        job_spec_list = step.job_spec_list
+        if kwargs.pop('RUNMODE') == 'SKIP':
+            logger.info(f'skipping jobs of {step.name}')
+            job_spec_list = []
+        if 'throttle' in kwargs:
+            # nothing limits the jobs of one step when the whole stage is in the queue
+            raise ValueError(f'{step.name} has a throttle, which only execute() enforces')
+        if steps.args.dry_run:
+            for job in job_spec_list:
+                job.dummy = True
+                for dependent_job,_ in afterok_jobs(job):
+                    dependent_job.dummy = True
+        attach_wrappers(job_spec_list, steps, kwargs)
+        if executor_type == 'slurm' and steps.args.sbatch_args:
+            kwargs.update({str(x):y for x,y in enumerate(steps.args.sbatch_args)})
+        kwargs_prep(kwargs, steps.args)
+        for job in job_spec_list:
+            for _,afterok_kwargs in afterok_jobs(job):
+                kwargs_prep(afterok_kwargs, steps.args)
+        submit_graph.add_step(step.name, job_spec_list, kwargs, step.after, step.after_all)
+
+    job_spec_list = [job for l in submit_graph.job_spec_lists() for job in l]
+    if not job_spec_list:
+        logger.debug('empty job_spec_list')
+        return []
+    executor = executors.get(executor_type)
+    watcher = None
+    if steps.args.notify:
+        notify_dir = os.path.join(conf.iproc.LOGDIR, 'notify')
+        notify_wrapper = os.path.join(conf.iproc.CODEDIR, 'wrappers', 'notify_exit.sh')
+        watcher = executors.CompletionWatcher(notify_dir, notify_wrapper, max_interval=60 * steps.args.interval)
+    pickle_file = os.path.join(conf.iproc.RMFILE_DUMP, "save.p")
+    pickle.dump(submit_graph.job_spec_lists(), open(pickle_file, "wb"))
+    mark_started(job_spec_list, steps)
+    write_manifests(job_spec_list, steps)
+    try:
+        executors.graph_submit(executor,submit_graph,steps.args.interval,cancel_on_fail=not steps.args.skip_fail,watcher=watcher,collector=steps.collector)
+    except commons.FailedJobError as e:
+        post_process_jobs(job_spec_list,steps.args,steps.provenance)
+        raise e
+    post_process_jobs(job_spec_list,steps.args,steps.provenance)
+    return release_rmfiles(job_spec_list,steps)
+
+def attach_wrappers(job_spec_list, steps, kwargs):
+    # prefix job commands, and those of their dependents, with the requested wrappers
+    if steps.args.singularity:
+        for j in job_spec_list:
+            # check for empty command
+            if j.skip:
+                continue
+            wrapper = os.path.join(conf.iproc.CODEDIR, 'wrappers','singularity_wrap.sh')
+            if steps.args.no_srun :
+                srun = "NO"
+            else:
+                srun = "YES"
+            def cpu(kwargs):
+                try:
+                    return str(kwargs['cpu'])
+                except KeyError:
+                    return str(1)
+            #ncf specific, will have to abstract
+            singularity_prefix = ['singularity', 'exec', '-e', steps.args.singularity, wrapper, conf.fs.SUBJECTS_DIR, srun, cpu(kwargs)]
+            j.prepend_cmd(singularity_prefix)
+            for dependent_job,_ in afterok_jobs(j):
+                dependent_job.prepend_cmd(singularity_prefix)
+
+    # non-singularity wrapper handling
+    if steps.args.wrap:
+        wrapper = os.path.join(conf.iproc.CODEDIR,'wrappers',steps.args.wrap)
+
+    if steps.args.user_wrap:
+        wrapper = steps.args.user_wrap
+
+    if steps.args.user_wrap or steps.args.wrap:
+        for j in job_spec_list:
+            if j.skip:
+                continue
+            prefix = [wrapper]
+            if steps.args.wrap_args:
+                prefix = prefix+steps.args.wrap_args
+            j.prepend_cmd(prefix)
+            for dependent_job,_ in afterok_jobs(j):
+                dependent_job.prepend_cmd(prefix)
+
 def afterok_jobs(j):
-    if j.afterok:
-        for dependent_pair in j.afterok:
-            dependent_job,kwargs = dependent_pair
-            while dependent_job:
-                yield(dependent_job,kwargs)
-                if dependent_job.afterok:
-                    next_level_job,next_kwargs = dependent_job.afterok
-                    dependent_job = next_level_job
-                    kwargs = next_kwargs
-                else:
-                    break
+    # walks all levels of dependent jobs, each parent before its dependents
+    for dependent_job,kwargs in j.afterok:
+        yield(dependent_job,kwargs)
+        yield from afterok_jobs(dependent_job)
+
+def mark_started(job_spec_list, steps):
+    # until they complete, the outfiles of these jobs count as out of date
+    if steps.args.dry_run:
+        return
+    # and directory listings taken so far will not show what they write
+    steps.fsindex.clear()
+    for job in job_spec_list:
+        for j in [job] + [dependent_job for dependent_job,_ in afterok_jobs(job)]:
+            if not j.skip:
+                steps.provenance.started(j)
+
+def write_manifests(job_spec_list, steps):
+    # the input files of jobs that are really submitted, not of skipped jobs or dry runs
+    if steps.args.dry_run:
+        return
+    for job in job_spec_list:
+        for j in [job] + [dependent_job for dependent_job,_ in afterok_jobs(job)]:
+            if j.skip:
+                continue
+            for fname,content in j.manifests.items():
+                if content is None:
+                    if os.path.exists(fname):
+                        os.remove(fname)
+                    continue
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+                with open(fname, 'w') as fo:
+                    json.dump(content, fo, indent=2)
 
-def post_process_jobs(job_spec_list, args):
+def post_process_jobs(job_spec_list, args, provenance=None):
     # process job list after it has been run through an executor
     # compile all jobs and dependencies
     jobs=[]
@@ -922,6 +1012,9 @@ def post_process_jobs(job_spec_list, args):
     for job in jobs:
         logger.debug(vars(job))
         if job.state == 'COMPLETED':
+            if provenance:
+                # record what the outfiles were made from
+                provenance.completed(job)
             # copy outfiles to destination directory, append rmfiles to object and file.
             logger.debug('execution finished successfully. Produced the following files:')
             logger.debug(job.outfiles)
@@ -933,10 +1026,14 @@ def post_process_jobs(job_spec_list, args):
             for outdir in job.outfile_dirs:
                 if not os.path.isdir(outdir):
                     os.makedirs(outdir)
-                if job.stdout:
-                    shutil.copy2(job.stdout, outdir)
-                if job.stderr:
-                    shutil.copy2(job.stderr, outdir)
+                for log in [job.stdout, job.stderr]:
+                    if not log:
+                        continue
+                    # the executor no longer waits for logs to show up, so they may still be missing
+                    if not os.path.exists(log):
+                        logger.warning(f'log file {log} not found, not copying it to {outdir}')
+                        continue
+                    shutil.copy2(log, outdir)
     if die:
         raise Exception('autodiff failure, aborting')
 
@@ -1026,6 +1123,15 @@ def rmfiles_from_job_specs(l):
                 rmfile_list.append(item)
     return rmfile_list
 
+def release_rmfiles(job_spec_list, steps):
+    # record the rmfiles of a list of JobSpecs, and of their dependents, in
+    # the ledger as safe to delete after this stage. returns flat list of rmfiles.
+    jobs = []
+    for job in job_spec_list:
+        jobs += [job] + [dependent_job for dependent_job,_ in afterok_jobs(job)]
+    steps.ledger.release(steps.args.stage, jobs)
+    return rmfiles_from_job_specs(job_spec_list)
+
 def kwargs_prep(kwargs,args):
     try:
         assert(kwargs['partition'])
@@ -1149,13 +1255,17 @@ def main():
 
     job_handling = parser.add_argument_group('job handling behavior options')
     job_handling.add_argument('--no-remove-files', action='store_true',
-        help='generate shell script of files to remove, rather than the default, which is to automatically remove files at the earliest opportunity.')
+        help='generate shell script of files to remove, rather than the default, which is to automatically remove files at the earliest opportunity. Set QUOTA (e.g. 500G) in the [iproc] section of the config file to hold back jobs while the subject directory is near it.')
     job_handling.add_argument('--overwrite', action='store_true',
         help='overwrite files from prior runs. Default is to skip reruns of jobs that have already produced output files.')
+    job_handling.add_argument('--batch-nuisance', action='store_true',
+        help='compute the nuisance regressors of all runs of the subject in one job, instead of one job per run')
+    job_handling.add_argument('--batch-ingest', choices=['session', 'subject'],
+        help='with --bids, ingest the anat, fieldmap and task images of each session (or of the whole subject) in one job, instead of one job per image')
 
     ## edge case handlers
     parser.add_argument('--blank-rmfiles', action='store_true',
-        help='if no rmfiles dump is found from a prior step, ignore and load blank. You should only need to use this if you see some error mentioning rmfiles.')
+        help='if the rmfiles ledger has nothing from a prior step, ignore and start blank. You should only need to use this if you see some error mentioning rmfiles.')
 
     ## alternate use cases
     parser.add_argument('--bids',
@@ -1171,6 +1281,10 @@ def main():
         help='default slurm/pbs partition to submit to')
     executor.add_argument('-i', '--interval', default=5, type=int,
         help='check children jobs once every i minutes')
+    executor.add_argument('--notify', action='store_true',
+        help='jobs write an exit sentinel to the log directory, and iProc checks on the scheduler as soon as one appears, rather than only once every polling interval')
+    executor.add_argument('--sequential', action='store_true',
+        help='run the steps of filter_and_project one after the other, each one waiting for every job of the step before it, instead of submitting all of them at once, with each job waiting only on the jobs of its own run that it depends on. Implied by --array and --single-file')
     executor.add_argument('--dry-run', action='store_true',
         help='dry-run mode (no scripts are actually run)')
     executor.add_argument('--skip-fail', action='store_true',
@@ -1185,6 +1299,8 @@ def main():
         help='list of nodes to exclude from slurm run, usage --exclude "holy2a06201,holy2a06202" ')
     slurm.add_argument('--nodelist',
         help='list of nodes to run on for slurm run, usage --nodelist "holy2a06201,holy2a06202" ')
+    slurm.add_argument('--array', action='store_true',
+        help='submit the jobs of each step as a single slurm job array, with throttling done by slurm instead of by iProc')
     slurm.add_argument('--sbatch-args', nargs='+', 
         help='a way to pass in arguments to sbatch, if needed.\n Will be applied to all sbatch commands.\n each argument must be a single string without spaces, and missing the initial dashes, e.g. --sbatch-args "chdir=<directory>" (which would correspond to `sbatch --chdir=<directory>` in regular command line usage of sbatch.)')
 
@@ -1206,6 +1322,8 @@ def main():
 
     # set up args
     args = parser.parse_args()
+    if args.batch_ingest and not args.bids:
+        parser.error('--batch-ingest only applies to BIDS ingest, it needs --bids')
     if args.sbatch_args:
         args.sbatch_args = [f'--{arg}' for arg in args.sbatch_args]
 
@@ -1272,6 +1390,10 @@ def main():
         os.environ['IPROC_SRUN'] = "NO"
     else:
         os.environ['IPROC_SRUN'] = "YES"
+    # gzip levels, threads and intermediate format from the [io] section
+    codec.export(conf)
+    # fsl or in-process engines from the [engines] section
+    engines.export(conf)
 
     # configure logging
     level = logging.DEBUG if args.debug else logging.INFO
@@ -1301,21 +1423,33 @@ def main():
     shutil.copy2(args.config_file,csv_archive)
 
     if args.bids:
+        # one index of the BIDS directory, for matching scans and for the ingest steps
+        args.bids_layout = bids.Layout(args.bids, cache=os.path.join(conf.iproc.RMFILE_DUMP, 'bids_index.json'),
+            save=not args.dry_run)
         # add 'BIDS_ID' attribute
-        bids.match_scan_no_to_bids(args.bids,scans)
+        bids.match_scan_no_to_bids(args.bids,scans,args.bids_layout)
 
     # run the stage specified by the user
     steps = iProcSteps.jobConstructor(conf,scans,args)
     stage = stages.get(args.stage)
     
-    rm_list = stage(steps,args)
+    stage(steps,args)
+    if not args.dry_run:
+        # so that the next stage finds it, even if it handed nothing off
+        steps.ledger.mark_stage(args.stage)
 
+    # earlier runs of the stage are already in the script, add what this one released
     rmscript_location = os.path.join(conf.iproc.LOGDIR,f'rm_{args.stage}.sh')
     rm_script = commons.ScriptBuilder(rmscript_location)
     rm_script.check_header()
-    for rmfile in rm_list:
+    rmfiles = steps.ledger.releasable(args.stage)
+    reclaimable = steps.ledger.reclaimable(args.stage)
+    for rmfile in rmfiles:
         rm_script.append(['rm','-rf', rmfile])
-    logger.info(f'in order to remove files, run {rmscript_location}')
+    steps.ledger.prune_releases(args.stage, rmfiles)
+    for stepname,nbytes in reclaimable.items():
+        logger.info(f'{stepname}: {nbytes / 2**30:.2f} GiB reclaimable')
+    logger.info(f'in order to remove files ({sum(reclaimable.values()) / 2**30:.2f} GiB more), run {rmscript_location}')
 
 if __name__ == '__main__':
     main()
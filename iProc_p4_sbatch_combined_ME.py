@@ -17,13 +17,18 @@ import glob
 import subprocess
 import re
 import socket
+import tempfile
 from subprocess import call
 from argparse import ArgumentParser
 import concurrent.futures as cf
 from iproc.commons import execute, program, machine
+import iproc.codec as codec
 import iproc.executors as executors
+import iproc.warp as warp
+import iproc.xfm as xfm
 
 import numpy as np
+import nibabel as nib
 #import matplotlib as mpl
 #mpl.use('Agg')
 #import matplotlib.pyplot as plt
@@ -76,7 +81,7 @@ def convert_warpcall_anat(fi_name):
 
 def apply_warpcall_MNI(fi_name):
     start = time.time()
-    res = re.findall("time_point_(\d+).nii.gz", fi_name)
+    res = re.findall(r"time_point_(\d+)\.nii", fi_name)
     spacename='MNI'
     end_mat = os.path.join(args.scratch,"{}_TARG_WARP_{}".format(spacename, res[0]))
     fnirt_out = os.path.join(args.scratch,"{}_TARG_FILE_{}".format(spacename, res[0]))
@@ -99,7 +104,7 @@ def apply_warpcall_MNI(fi_name):
 
 def apply_warpcall_anat(fi_name):
     start = time.time()
-    res = re.findall("time_point_(\d+).nii.gz", fi_name)
+    res = re.findall(r"time_point_(\d+)\.nii", fi_name)
 
     comb_mat = os.path.join(args.scratch,"T1_TARG_WARP_%s" % res[0])
     fnirt_out = os.path.join(args.scratch,"T1_TARG_FILE_%s" % res[0])
@@ -113,6 +118,47 @@ def apply_warpcall_anat(fi_name):
     print(cmd)
     summary = execute(cmd, kill=True)
 
+def warp_in_process(matfiles):
+    # same transforms as convert_warpcall_* and apply_warpcall_*, but the
+    # static part of the chain is evaluated once, the input is read through
+    # a memory map, and the volumes are written into a single 4D file
+    start = time.time()
+    ref = nib.load(warp.find_image(target))
+    if args.destination_space == "MNI":
+        points = warp.convertwarp(ref, warp1=warp.Warp(fmmat), midmat=anat_mat, warp2=warp.Warp(std_mat))
+        spacename = 'MNI'
+    else:
+        points = warp.convertwarp(ref, warp1=warp.Warp(fmmat), postmat=anat_mat)
+        spacename = 'T1'
+    premats = xfm.read_mats(matfiles)
+    logger.info(f'warp chain evaluated in {time.time() - start:.1f}s')
+
+    # uncompressed intermediates go in a subdirectory that is removed
+    # before the scratch directory is copied back
+    tmpdir = tempfile.mkdtemp(dir=args.scratch)
+    in_img = warp.open_mmap(args.input, tmpdir)
+    out_tmp = os.path.join(tmpdir, f'{spacename}_TARG_FILE.nii')
+    out = warp.create_4d(out_tmp, ref, len(matfiles))
+
+    def write(i, vol):
+        out[...,i] = vol
+    warp.warp_volumes(in_img, ref, points, premats, write, threads=cpus)
+    out.flush()
+    del out, in_img
+    logger.info(f'{len(matfiles)} volumes warped in {time.time() - start:.1f}s')
+
+    codec.store(out_tmp, os.path.join(args.scratch, codec.intermediate(f'{spacename}_TARG_FILE')), intermediate=True)
+    shutil.rmtree(tmpdir)
+    logger.info(f'4D output written in {time.time() - start:.1f}s')
+
+def merge_in_scratch(spacename):
+    # leave only the merged file in scratch, like the numpy engine does
+    volumes = sorted(glob.glob(os.path.join(args.scratch, f'{spacename}_TARG_FILE_*.nii*')))
+    execute(['fslmerge', '-t', os.path.join(args.scratch, f'{spacename}_TARG_FILE')] + volumes, kill=True)
+    for pattern in [f'{spacename}_TARG_FILE_*', f'{spacename}_TARG_WARP_*', 'time_point_*']:
+        for f in glob.glob(os.path.join(args.scratch, pattern)):
+            os.remove(f)
+
 def visualize_runtimes(results,fig):
     start,stop = np.array(results).T
     fig.barh(list(range(len(start))), stop-start, left=start)
@@ -154,6 +200,10 @@ parser.add_argument("-a", "--mni-atlas",
     help="mni atlas to use.")
 parser.add_argument("-e", "--echo-num", required=True, 
     help="echo number of this volume")
+parser.add_argument("-i", "--input", required=True,
+    help="4D BOLD data to warp")
+parser.add_argument("--engine", default="fsl", choices=["numpy","fsl"],
+    help="warp in-process with numpy, or with one convertwarp and applywarp call per volume")
 # TODO: no-unwarp
 args = parser.parse_args()
 if args.destination_space == "MNI" and not args.mni_atlas:
@@ -167,22 +217,13 @@ logger.info(machine())
 args.mat_dir = os.path.expanduser(args.mat_dir)
 args.output_dir = os.path.expanduser(args.output_dir)
 
-# Combine warps (mcTarget-meanBOLD + meanBOLD-T1)
-template_cmd = "convert_xfm -omat {OMAT} -concat {BtoC} {AtoB}"
-
-# TODO: check output exists before executing
+# Combine warps (mcTarget-meanBOLD + meanBOLD-T1), as convert_xfm -concat would.
+# anat_mat is used in memory, the file is for the fsl engine and for the record
 omat = os.path.join(args.output_dir,"%s_to_anat.mat" % args.bold_no)
 atob = os.path.join(args.output_dir,"%s_to_allscans.mat" % args.bold_no)
 btoc = os.path.join(args.template_dir,"%s_allscans_meanBOLD_to_T1.mat" % args.subject_id)
-
-cmd=template_cmd.format(
-    OMAT=omat,
-    AtoB=atob,
-    BtoC=btoc)
-
-summary = execute(cmd, kill=True)
-print(cmd)
-time.sleep(2)
+anat_mat = xfm.concat(xfm.read_mat(btoc), xfm.read_mat(atob))
+xfm.write_mat(omat, anat_mat)
 
 # declare global variables so we can easily access in parallel-run function
 target = None
@@ -201,14 +242,16 @@ if args.destination_space == "MNI":
     target = os.path.join(args.mni_atlas)
     std_mat = os.path.join(args.template_dir,"mpr_to_mni_FNIRT.mat.nii.gz")
     
-    cmd=template_cmd.format(
-        COMB_MAT=comb_mat,
-        TARGET=target,
-        OMAT=omat,
-        STD_MAT=std_mat)
-    print(cmd)
-    summary = execute(cmd, kill=True) 
-    time.sleep(2)
+    if args.engine == "fsl":
+        # the numpy engine chains std_mat and anat_mat itself
+        cmd=template_cmd.format(
+            COMB_MAT=comb_mat,
+            TARGET=target,
+            OMAT=omat,
+            STD_MAT=std_mat)
+        print(cmd)
+        summary = execute(cmd, kill=True) 
+        time.sleep(2)
 
     target = os.path.join(args.mni_atlas)
     convert_warpcall = convert_warpcall_MNI
@@ -232,13 +275,20 @@ if not all(matfiles_exist.values()):
     matfiles_missing = [k for k,v in list(matfiles_exist.items()) if not v]
     matfiles_join = ' '.join(matfiles_missing)
     raise Exception('Some matfiles do not exist: {}'.format(matfiles_join))
-# writes to scratch to save on i/o
-multiprocessing(cpus, convert_warpcall, matfiles)
-
-#apply non-linear matrix registration to specific volume
-tmpfiles = glob.glob(os.path.join(args.scratch, "time_point_*.nii.gz"))
-print(tmpfiles)
-multiprocessing(cpus, apply_warpcall, tmpfiles)
+if args.engine == "numpy":
+    warp_in_process(matfiles)
+else:
+    # FSL writes the per-volume intermediates in the configured format
+    os.environ['FSLOUTPUTTYPE'] = codec.fsloutputtype()
+    execute("fslsplit {} {}".format(args.input, os.path.join(args.scratch, "time_point_")), kill=True)
+    # writes to scratch to save on i/o
+    multiprocessing(cpus, convert_warpcall, matfiles)
+
+    #apply non-linear matrix registration to specific volume
+    tmpfiles = glob.glob(os.path.join(args.scratch, "time_point_*.nii*"))
+    print(tmpfiles)
+    multiprocessing(cpus, apply_warpcall, tmpfiles)
+    merge_in_scratch('MNI' if args.destination_space == "MNI" else 'T1')
 
 print((socket.getfqdn()))
 print("Done!")
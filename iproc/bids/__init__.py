@@ -1,82 +1,219 @@
 import re
 import os
-import glob
 import logging
 import json
 import subprocess as sp
 import collections as col
+import concurrent.futures as cf
 import iproc.commons as commons
+import iproc.fsindex as fsindex
 logger = logging.getLogger(__name__)
 
-def match_scan_no_to_bids(bids_base,scans):
+# bump when the cache format changes
+INDEX_VERSION = 2
+# sub-XX, ses-YY, then the datatype directories
+DEPTH = 2
+# the entities of a file name, in the order BIDS puts them
+ENTITIES = re.compile(
+    r'^sub-(?P<sub>[a-zA-Z0-9]+)'
+    r'(?:_ses-(?P<ses>[a-zA-Z0-9]+))?'
+    r'(?:_task-(?P<task>[a-zA-Z0-9]+))?'
+    r'(?:_acq-(?P<acq>[a-zA-Z0-9]+))?'
+    r'(?:_ce-(?P<ce>[a-zA-Z0-9]+))?'
+    r'(?:_rec-(?P<rec>[a-zA-Z0-9]+))?'
+    r'(?:_dir-(?P<dir>[a-zA-Z0-9]+))?'
+    r'(?:_run-(?P<run>[0-9]+))?'
+    r'(?:_echo-(?P<echo>[0-9]+))?'
+    r'(?:_part-(?P<part>[a-zA-Z0-9]+))?'
+    r'_(?P<suffix>[a-zA-Z0-9]+)'
+    r'(?P<extension>\.[a-zA-Z0-9.]+)$')
+
+def parse_entities(fname):
+    ''' entities of a BIDS file name, with suffix and extension, or None if it is not one '''
+    match = ENTITIES.match(os.path.basename(fname))
+    if not match:
+        return None
+    return {k:v for k,v in match.groupdict().items() if v is not None}
+
+def _read_sidecar(fname):
+    with open(fname) as fo:
+        try:
+            return json.load(fo)
+        except ValueError:
+            logger.error('problem with json {}'.format(fname))
+            raise
+
+class Layout(fsindex.FileIndex):
+    '''
+    Index of the files of a BIDS subject directory (sub-XX/ses-YY/anat|func|fmap),
+    and of the content of their JSON sidecars.
+
+    The tree is listed the way FileIndex.prefetch_tree() does it, file names
+    are parsed with one compiled pattern, and the sidecars are read in
+    parallel threads. With a cache file, the index is saved with the mtime of
+    every directory, and the next Layout only lists again the directories
+    whose mtime changed, and only reads the sidecars in those. A sidecar
+    rewritten in place, which does not change the mtime of its directory, is
+    not seen.
+    '''
+    def __init__(self, root, cache=None, threads=fsindex.THREADS, save=True):
+        '''
+        :param save: write the cache file, if the index changed
+        '''
+        super().__init__(threads)
+        self.root = os.path.abspath(root)
+        self.cache = cache
+        # directory: {'mtime': ns, 'listing': FileIndex listing, 'dirs': [names], 'sidecars': {name: content}}
+        self._dirs = {}
+        # directories listed again, rather than taken from the cache
+        self._listed = set()
+        self._load()
+        self._update(save)
+        self._build()
+
+    def _load(self):
+        if not self.cache or not os.path.exists(self.cache):
+            return
+        try:
+            with open(self.cache) as fo:
+                saved = json.load(fo)
+        except ValueError:
+            logger.warning(f'ignoring unreadable BIDS index {self.cache}')
+            return
+        if saved.get('version') == INDEX_VERSION and saved.get('root') == self.root:
+            self._dirs = saved['dirs']
+
+    def _save(self):
+        def write(tmp):
+            with open(tmp, 'w') as fo:
+                json.dump({'version': INDEX_VERSION, 'root': self.root, 'dirs': self._dirs}, fo)
+        commons.replace_file(self.cache, write, '.json')
+
+    def _mtime(self, directory):
+        try:
+            return os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _scan(self, directory):
+        ''' FileIndex._scan(), unless the directory has not changed since it was indexed '''
+        mtime = self._mtime(directory)
+        with self._lock:
+            known = self._dirs.get(directory)
+        if known and known['mtime'] == mtime:
+            with self._lock:
+                self._listings[directory] = known['listing']
+            return [os.path.join(directory, d) for d in known['dirs']]
+        subdirs = super()._scan(directory)
+        with self._lock:
+            listing = self._listings[directory]
+            if listing is not None:
+                self._dirs[directory] = {'mtime': mtime, 'listing': listing,
+                    'dirs': [os.path.basename(d) for d in subdirs], 'sidecars': {}}
+                self._listed.add(directory)
+        return subdirs
+
+    def _update(self, save):
+        self.prefetch_tree([self.root], DEPTH)
+        sidecars = [os.path.join(directory, name) for directory in self._listed
+                    for name in self._dirs[directory]['listing'] if name.endswith('.json')]
+        if sidecars:
+            with cf.ThreadPoolExecutor(min(self.threads, len(sidecars))) as ex:
+                for fname,sidecar in zip(sidecars, ex.map(_read_sidecar, sidecars)):
+                    self._dirs[os.path.dirname(fname)]['sidecars'][os.path.basename(fname)] = sidecar
+        removed = set(self._dirs) - set(self._listings)
+        for directory in removed:
+            del self._dirs[directory]
+        logger.debug(f'{len(self._dirs)} directories under {self.root}, listed {len(self._listed)}, read {len(sidecars)} sidecars')
+        if self.cache and save and (self._listed or removed):
+            self._save()
+
+    def _build(self):
+        # path: entities, and (ses, datatype): [paths]
+        self.files = {}
+        self.by_dir = col.defaultdict(list)
+        for directory,known in self._dirs.items():
+            rel = os.path.relpath(directory, self.root).split(os.sep)
+            key = (rel[0][len('ses-'):], rel[1]) if len(rel) == 2 and rel[0].startswith('ses-') else None
+            for name in known['listing']:
+                entities = parse_entities(name)
+                if entities is None:
+                    continue
+                path = os.path.join(directory, name)
+                self.files[path] = entities
+                if key:
+                    self.by_dir[key].append(path)
+
+    def sidecar(self, fname):
+        ''' content of the JSON sidecar of fname, which may be a NIfTI file or the sidecar itself '''
+        fname = os.path.abspath(fname)
+        base = re.sub(r'\.nii(\.gz)?$', '', fname)
+        if not base.endswith('.json'):
+            base += '.json'
+        directory,name = os.path.split(base)
+        try:
+            sidecar = self._dirs[directory]['sidecars'][name]
+        except KeyError:
+            raise IOError(f'{base} does not exist')
+        return sidecar
+
+    def get_json_entity(self, fname, entity_name):
+        ''' same as commons.get_json_entity, from the index '''
+        try:
+            return self.sidecar(fname)[entity_name]
+        except KeyError:
+            logger.error('Make sure {} field is populated for file {}'.format(entity_name, fname))
+            raise
+
+    def query(self, ses, datatype, **entities):
+        '''
+        files of a session and datatype (anat, func, fmap) whose entities,
+        suffix and extension are all those given
+        :returns: [(path, entities)]
+        '''
+        return [(path, self.files[path]) for path in self.by_dir.get((ses, datatype), [])
+                if all(self.files[path].get(k) == v for k,v in entities.items())]
+
+def match_scan_no_to_bids(bids_base,scans,layout=None):
+    '''
+    add BIDS_ID (the BIDS run) to the anat and bold scans, and the BIDS file
+    names of the fieldmaps, matched by SeriesNumber
+    :param layout: Layout of bids_base, to reuse an index that was built already
+    '''
+    if layout is None:
+        layout = Layout(bids_base)
     for sessionid,sess in scans.sessions():
         #set corresponding BIDS subdir
         bids_sessionid = sanitize(sessionid)
-        bids_sessionid_dirname = f'ses-{bids_sessionid}'
         # take care of fmap
         # compile list of SeriesNumber:(task,run)
-        bids_func_fullpath = os.path.join(bids_base,bids_sessionid_dirname,'func')
-        bids_json_fglob = f'sub-{sess.subjid}_ses-{bids_sessionid}_*_bold.json'
-        bids_json_glob = os.path.join(bids_func_fullpath,bids_json_fglob)
         scan_no_to_json = {}
-        for json in glob.glob(bids_json_glob):
+        for json_fname,entities in layout.query(bids_sessionid,'func',sub=sess.subjid,ses=bids_sessionid,
+                                                suffix='bold',extension='.json'):
+            if 'task' not in entities or 'run' not in entities:
+                continue
             # get series number from json, save in dict for later
-
-            #try for single echo with direction:
-            json_regex_dir = f'.*sub-{sess.subjid}_ses-{bids_sessionid}_task-(\w+)_dir-(\w+)_run-([0-9]+)_bold.json'
-            bids_pair_tmp_dir = re.match(json_regex_dir,json)
-
-            #try for single echo with direction:
-            json_regex = f'.*sub-{sess.subjid}_ses-{bids_sessionid}_task-(\w+)_run-([0-9]+)_bold.json'
-            bids_pair_tmp = re.match(json_regex,json)
-
-            #try for single echo with direction:
-            json_regex_dir_me = f'.*sub-{sess.subjid}_ses-{bids_sessionid}_task-(\w+)_dir-(\w+)_run-([0-9]+)_echo-([0-9]+)_bold.json'
-            bids_pair_tmp_dir_me = re.match(json_regex_dir_me,json)
-
-            #try for single echo with direction:
-            json_regex_me = f'.*sub-{sess.subjid}_ses-{bids_sessionid}_task-(\w+)_run-([0-9]+)_echo-([0-9]+)_bold.json'
-            bids_pair_tmp_me = re.match(json_regex_me,json)
-
-
-            if bids_pair_tmp != None:
-                bids_pair = bids_pair_tmp.groups()
-                dirSpec = 0 # set to 0 if direction is NOT specified in file name
-                ME = 0 # set to 0 if single echo
-            elif bids_pair_tmp_dir != None:
-                bids_pair = bids_pair_tmp_dir.groups()
-                dirSpec = 1 #set to 1 if direction is specified in file name
-                ME = 0 
-            elif bids_pair_tmp_me != None:
-                bids_pair = bids_pair_tmp_me.groups()
-                dirSpec = 0 
-                ME = 1 # set to 1 if multi-echo
-            elif bids_pair_tmp_dir_me != None:
-                bids_pair = bids_pair_tmp_dir_me.groups()
-                dirSpec = 1
-                ME = 1 
-                
-            series_no = get_json_entity(json,'SeriesNumber')
+            dirSpec = 1 if 'dir' in entities else 0 # set to 1 if direction is specified in file name
+            ME = 1 if 'echo' in entities else 0 # set to 1 if multi-echo
+            bids_pair = tuple(entities[k] for k in ('task','dir','run','echo') if k in entities)
+            series_no = str(layout.get_json_entity(json_fname,'SeriesNumber'))
             scan_no_to_json[series_no]=bids_pair
 
         # Compile list of phase_SeriesNumber:BIDS_run_no
-        bids_fmap_fullpath = os.path.join(bids_base,bids_sessionid_dirname,'fmap')
-        bids_json_fglob = '*.json'.format(SUB=sess.subjid,SES=bids_sessionid)
-        bids_json_glob = os.path.join(bids_fmap_fullpath,bids_json_fglob)
-
-        fmap_jsons = glob.glob(bids_json_glob)
+        fmap_jsons = [f for f,_ in layout.query(bids_sessionid,'fmap',extension='.json')]
         if not fmap_jsons:
-            logger.error(f'no JSON file found for {bids_json_glob}')
+            bids_fmap_fullpath = os.path.join(bids_base,f'ses-{bids_sessionid}','fmap')
+            logger.error(f'no JSON file found in {bids_fmap_fullpath}')
             raise IOError
 
         fmap_no_to_nifti = {}
-        for json_fname in fmap_jsons:
+        for json_fname in sorted(fmap_jsons):
             # get filenames by aquisition number
-            series_no = get_json_entity(json_fname,'SeriesNumber')
+            series_no = str(layout.get_json_entity(json_fname,'SeriesNumber'))
                 
-            nifti_filename = json_fname.rstrip('.json') + '.nii.gz'
-            if not os.path.exists(nifti_filename):
-                raise ValueError
+            nifti_filename = json_fname[:-len('.json')] + '.nii.gz'
+            if not layout.exists(nifti_filename):
+                raise ValueError(f'{nifti_filename} does not exist')
             existing_fmap = fmap_no_to_nifti.get(series_no)
             logger.debug(f'{existing_fmap} {json_fname} {series_no}')
             if not existing_fmap:
@@ -87,25 +224,22 @@ def match_scan_no_to_bids(bids_base,scans):
                 fmap_no_to_nifti[series_no].append(nifti_filename)
 
         # Compile list of anat_SeriesNumber:BIDS_run_no
-        bids_anat_fullpath = os.path.join(bids_base,bids_sessionid_dirname,'anat')
-        bids_T1_json_fglob = f'sub-{sess.subjid}_ses-{bids_sessionid}_*_T1w.json'
-        bids_T2_json_fglob = f'sub-{sess.subjid}_ses-{bids_sessionid}_*_T2w.json'
-        bids_T1_json_glob = os.path.join(bids_anat_fullpath,bids_T1_json_fglob)
-        bids_T2_json_glob = os.path.join(bids_anat_fullpath,bids_T2_json_fglob)
-        anat_no_to_json = {}     
-        anat_jsons = glob.glob(bids_T1_json_glob) + glob.glob(bids_T2_json_glob)
+        anat_jsons = [(f,e) for suffix in ('T1w','T2w')
+                      for f,e in layout.query(bids_sessionid,'anat',sub=sess.subjid,ses=bids_sessionid,
+                                              suffix=suffix,extension='.json')]
         if not anat_jsons:
-            logger.error(f'no JSON file found for {bids_json_glob}')
+            bids_anat_fullpath = os.path.join(bids_base,f'ses-{bids_sessionid}','anat')
+            logger.error(f'no T1w or T2w JSON file found in {bids_anat_fullpath}')
             raise IOError
-        for json in anat_jsons:
+        anat_no_to_json = {}     
+        for json_fname,entities in anat_jsons:
             # get series number for T1w anat from json, save in dict for later
-            anat_regex = f'.*sub-{sess.subjid}_ses-{bids_sessionid}_run-([0-9]+)_(T1w|T2w).json'
-            anat_match = re.match(anat_regex,json)
-            run_no = anat_match.group(1)
-            series_no = get_json_entity(anat_match.string,'SeriesNumber')
-            anat_no_to_json[series_no]=run_no
-            print(anat_no_to_json)
-            print(sess.anat_scans)
+            if 'run' not in entities:
+                continue
+            series_no = str(layout.get_json_entity(json_fname,'SeriesNumber'))
+            anat_no_to_json[series_no]=entities['run']
+        logger.debug(anat_no_to_json)
+        logger.debug(sess.anat_scans)
         try:
             for scan_no,anat_scan in iter(sess.anat_scans.items()):
                 anat_scan['BIDS_ID'] = anat_no_to_json[scan_no]
@@ -0,0 +1,190 @@
+'''
+Eager removal of intermediate files, and disk quota accounting.
+
+The rmfiles of a job are the intermediates it is the last step to need. As
+soon as that job has completed, along with every other job of the submission
+whose command line refers to the same file, or to a directory it is in, the
+file is deleted. The
+trailing rmfiles argument of the runscripts leaves files behind when a job
+is skipped or a runscript stops short, and rm_{stage}.sh only runs when
+someone runs it, after the whole stage.
+
+The collector also keeps a running count of the bytes under the subject
+directory: a single walk of the tree the first time it is needed, plus the
+outfiles of every job that completes, minus what it deletes. With a quota
+set (QUOTA in the [iproc] section of the config file, e.g. 500G), the
+outfiles of jobs still running and of the next job, estimated from the jobs
+of the same step that have completed, are added to it to decide whether
+rolling_submit can submit the next job or has to wait for space to free up.
+'''
+import os
+import re
+import glob
+import shutil
+import fnmatch
+import logging
+import collections
+from iproc.ledger import disk_usage
+
+logger = logging.getLogger(__name__)
+
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40, 'P': 2**50}
+
+def parse_size(size):
+    ''' bytes from a size such as 500G or 1.5T, None stays None '''
+    if size is None:
+        return None
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGTP]?)i?B?\s*$', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError(f'cannot parse size {size}, use e.g. 500G')
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+# states a job does not come back from, as reported by any of the executors
+TERMINAL_STATES = ('COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'BOOT_FAIL', 'DEADLINE', 'PREEMPTED')
+
+def _terminal(job):
+    return bool(job.state) and any(state in job.state for state in TERMINAL_STATES)
+
+def _finished(job):
+    return job.skip or job.state == 'COMPLETED'
+
+def _args(job):
+    ''' words of the command line of a job. An argument can be a space-joined list of paths. '''
+    return [word for arg in job.cmd or [] for word in str(arg).split()]
+
+def _words(job):
+    ''' paths in the command line of a job, and every directory above them '''
+    words = set()
+    for word in _args(job):
+        while word and word not in words and word != os.sep:
+            words.add(word)
+            word = os.path.dirname(word.rstrip(os.sep))
+    return words
+
+def _above(path):
+    ''' the directories above a path '''
+    above = []
+    path = os.path.dirname(path.rstrip(os.sep))
+    while path and path != os.sep:
+        above.append(path)
+        path = os.path.dirname(path)
+    return above
+
+class Collector(object):
+    def __init__(self, root, quota=None, remove=True):
+        '''
+        :param root: subject directory, the bytes under it count against quota
+        :param quota: bytes, or None for no quota
+        :param remove: delete intermediates, otherwise only do the accounting
+        '''
+        self.root = root
+        self.quota = quota
+        self.remove = remove
+        self._live = None
+        # path: [jobs that have to finish before it can go]
+        self._artifacts = collections.OrderedDict()
+        self._accounted = set()
+        self._in_flight = {}
+        # step name: [bytes of outfiles of each completed job]
+        self._written = collections.defaultdict(list)
+
+    def track(self, jobs):
+        ''' the jobs of a submission, dependents included '''
+        jobs = list(jobs)
+        for job in jobs:
+            rmfiles = [job.rmfiles] if isinstance(job.rmfiles, str) else job.rmfiles or []
+            for path in rmfiles:
+                consumers = self._artifacts.setdefault(path, [])
+                if job not in consumers:
+                    consumers.append(job)
+        # a job that is not the one to remove a file may still read it, a
+        # file in it, a file matching it, or a directory it is in
+        readers = collections.defaultdict(list)
+        named = collections.defaultdict(list)
+        for job in jobs:
+            for word in _words(job):
+                readers[word].append(job)
+            for word in _args(job):
+                named[word.rstrip(os.sep)].append(job)
+        for path,consumers in self._artifacts.items():
+            if glob.has_magic(path):
+                matches = fnmatch.filter(readers, path)
+            else:
+                matches = [path.rstrip(os.sep)]
+            holders = [job for word in matches for job in readers.get(word, [])]
+            holders += [job for directory in _above(path) for job in named.get(directory, [])]
+            for job in holders:
+                if job not in consumers:
+                    consumers.append(job)
+
+    @property
+    def live(self):
+        ''' bytes under the subject directory '''
+        if self._live is None:
+            self._live = disk_usage(self.root)
+            logger.info(f'{self._live / 2**30:.2f} GiB in use under {self.root}')
+        return self._live
+
+    def estimate(self, job):
+        ''' bytes a job will write, from the completed jobs of its step '''
+        written = self._written.get(job.name)
+        return max(written) if written else 0
+
+    def submitted(self, job):
+        if self.quota is not None:
+            self._in_flight[id(job)] = self.estimate(job)
+
+    def hold(self, job):
+        ''' whether submitting job now could take the subject over quota '''
+        if self.quota is None:
+            return False
+        projected = self.live + sum(self._in_flight.values()) + self.estimate(job)
+        if projected > self.quota:
+            logger.info(f'holding back {job.name}: {projected / 2**30:.2f} GiB projected, quota is {self.quota / 2**30:.2f} GiB')
+            return True
+        return False
+
+    def collect(self, jobs):
+        '''
+        account for jobs that have finished since the last call, and delete
+        the intermediates that nothing is waiting on anymore. Returns the
+        number of bytes freed.
+        '''
+        for job in jobs:
+            if id(job) in self._accounted or not (job.skip or _terminal(job)):
+                continue
+            self._accounted.add(id(job))
+            self._in_flight.pop(id(job), None)
+            if job.state == 'COMPLETED' and self.quota is not None:
+                written = sum(disk_usage(outfile) for outfile in job.outfiles)
+                self._written[job.name].append(written)
+                self._live = self.live + written
+        if not self.remove:
+            return 0
+        freed = 0
+        for path,consumers in list(self._artifacts.items()):
+            if not all(_finished(job) for job in consumers):
+                continue
+            del self._artifacts[path]
+            freed += self._delete(path)
+        if freed:
+            logger.info(f'freed {freed / 2**30:.2f} GiB of intermediates')
+            if self._live is not None:
+                self._live = max(self._live - freed, 0)
+        return freed
+
+    def _delete(self, path):
+        freed = 0
+        for match in glob.glob(path):
+            size = disk_usage(match)
+            try:
+                if os.path.isdir(match) and not os.path.islink(match):
+                    shutil.rmtree(match)
+                else:
+                    os.remove(match)
+            except OSError as e:
+                logger.warning(f'could not remove {match}: {e}')
+                continue
+            logger.debug(f'removed {match}')
+            freed += size
+        return freed
@@ -0,0 +1,124 @@
+'''
+Output codecs for NIfTI files.
+
+gzip is the longest tail of many jobs, so compression is done here in
+parallel: the file is cut in blocks, each block is deflated in its own thread
+(zlib releases the GIL) as a complete gzip member, and the members are
+written one after the other. A multi-member stream is a valid gzip file, the
+same as pigz -i writes, and gzip, nibabel, FSL and AFNI all read it.
+
+The codecs are set in the [io] section of the subject config file:
+
+    [io]
+    # level of the files that are kept
+    GZIP_LEVEL = 6
+    # level of the intermediates, which are deleted later on
+    INTERMEDIATE_GZIP_LEVEL = 1
+    # nii.gz, or nii to not compress the intermediates at all
+    INTERMEDIATE_FORMAT = nii.gz
+    # compression threads, default is every cpu available to the job
+    GZIP_THREADS = 8
+
+iProc exports them to the environment (export()), so that the runscripts
+and the python scripts they call see the same settings as the steps that
+name their outfiles.
+'''
+import os
+import zlib
+import shutil
+import logging
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+GZIP_LEVEL = 6
+INTERMEDIATE_GZIP_LEVEL = 1
+INTERMEDIATE_FORMATS = ('nii.gz', 'nii')
+# bytes deflated per thread at a time; the compression lost at the block
+# boundaries is negligible at this size
+BLOCK_SIZE = 4 * 1024 ** 2
+
+# [io] option: environment variable
+ENVIRONMENT = {
+    'GZIP_LEVEL': 'IPROC_GZIP_LEVEL',
+    'INTERMEDIATE_GZIP_LEVEL': 'IPROC_INTERMEDIATE_GZIP_LEVEL',
+    'INTERMEDIATE_FORMAT': 'IPROC_INTERMEDIATE_FORMAT',
+    'GZIP_THREADS': 'IPROC_GZIP_THREADS',
+}
+
+def export(conf):
+    ''' copy the [io] section of the config into the environment of the jobs '''
+    for option,variable in ENVIRONMENT.items():
+        value = conf.get('io', option)
+        if value is not None:
+            os.environ[variable] = value.strip()
+    # fail here rather than in a job
+    level(), level(intermediate=True), intermediate_format(), threads()
+
+def level(intermediate=False):
+    ''' gzip level of kept files, or of intermediates '''
+    if intermediate:
+        value = int(os.environ.get(ENVIRONMENT['INTERMEDIATE_GZIP_LEVEL'], INTERMEDIATE_GZIP_LEVEL))
+    else:
+        value = int(os.environ.get(ENVIRONMENT['GZIP_LEVEL'], GZIP_LEVEL))
+    if not 0 <= value <= 9:
+        raise ValueError(f'gzip level must be between 0 and 9, not {value}')
+    return value
+
+def threads():
+    value = os.environ.get(ENVIRONMENT['GZIP_THREADS'])
+    return int(value) if value else len(os.sched_getaffinity(0))
+
+def intermediate_format():
+    value = os.environ.get(ENVIRONMENT['INTERMEDIATE_FORMAT'], INTERMEDIATE_FORMATS[0]).lstrip('.')
+    if value not in INTERMEDIATE_FORMATS:
+        raise ValueError(f'INTERMEDIATE_FORMAT must be one of {", ".join(INTERMEDIATE_FORMATS)}, not {value}')
+    return value
+
+def intermediate(base):
+    ''' file name of an intermediate NIfTI image, from its name without extension '''
+    return f'{base}.{intermediate_format()}'
+
+def fsloutputtype():
+    ''' FSLOUTPUTTYPE that makes FSL tools write intermediates in the configured format '''
+    return 'NIFTI_GZ' if intermediate_format() == 'nii.gz' else 'NIFTI'
+
+def _member(block, level):
+    # wbits 31: a complete gzip member, header and trailer included
+    deflate = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return deflate.compress(block) + deflate.flush()
+
+def compress(src, dst=None, gzip_level=None, nthreads=None, intermediate=False):
+    '''
+    gzip src into dst (src.gz by default), with blocks compressed in parallel
+    threads, and remove src, like gzip -f
+    :param gzip_level: default is level(intermediate)
+    :param nthreads: default is threads()
+    '''
+    dst = dst or src + '.gz'
+    gzip_level = level(intermediate) if gzip_level is None else gzip_level
+    nthreads = nthreads or threads()
+    with open(src, 'rb') as fi, open(dst, 'wb') as fo, \
+            concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+        # an empty file still gets one, empty, member
+        block = fi.read(BLOCK_SIZE)
+        pending = [pool.submit(_member, block, gzip_level)]
+        while block:
+            block = fi.read(BLOCK_SIZE)
+            if block:
+                pending.append(pool.submit(_member, block, gzip_level))
+            # keep at most 2 blocks per thread in memory, written in order
+            while len(pending) >= 2 * nthreads:
+                fo.write(pending.pop(0).result())
+        for member in pending:
+            fo.write(member.result())
+    os.remove(src)
+    logger.debug(f'compressed {src} into {dst}, level {gzip_level}, {nthreads} threads')
+    return dst
+
+def store(src, dst, intermediate=False, nthreads=None):
+    ''' move an uncompressed image to dst, compressing it on the way if dst ends in .gz '''
+    if dst.endswith('.gz'):
+        return compress(src, dst, nthreads=nthreads, intermediate=intermediate)
+    shutil.move(src, dst)
+    return dst
@@ -9,6 +9,7 @@ import logging
 import hashlib
 import pickle
 import json
+import tempfile
 import subprocess as sp
 import collections as col
 
@@ -258,6 +259,26 @@ def get_json_entity(json_fname,entity_name):
             raise
     return entity_value
 
+def replace_file(fname, write, suffix=''):
+    '''
+    write fname in one step: write(tmp) fills a temporary file next to it,
+    which is then renamed over fname, so it is never seen half-written.
+    Concurrent writers of the same file do not clash, the last rename wins.
+
+    :param write: function of the temporary file name
+    :param suffix: of the temporary file, for writers that go by it
+    '''
+    dirname = os.path.dirname(os.path.abspath(fname))
+    os.makedirs(dirname, exist_ok=True)
+    fd,tmp = tempfile.mkstemp(dir=dirname, suffix=suffix)
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
 class ScriptBuilder():
     #This allows for more flexible creation of sbatch scripts for 
     #non-computational steps, while maintaing provenance info
@@ -311,7 +332,7 @@ class JobSpec(object):
     used to contain all the information the executor needs to run a job, 
     and that is needed for pre-and post-processing.
     '''
-    def __init__(self, cmd,logfile_base,outfiles,rmfiles=None):
+    def __init__(self, cmd,logfile_base,outfiles,rmfiles=None,run=None):
         self.cmd = cmd
         self.logfile_base = logfile_base
         self.outfiles = outfiles
@@ -326,6 +347,19 @@ class JobSpec(object):
         self.afterok = [] # to be filled with other jobspecs #jobception
         self.skip = False 
         self.dummy = False 
+        # name and command line of the step, taken before any wrappers are prepended to cmd
+        self.name = os.path.basename(cmd[0]) if cmd else None
+        self.command = list(cmd) if cmd else []
+        # set by executors.CompletionWatcher, if completion notification is on
+        self.sentinel = None
+        # (sessionid, scan_no) of per-run jobs, used to link them across steps
+        self.run = run
+        # in-process equivalent of cmd, for jobs that can be batched (see iproc.ingest)
+        self.ingest = None
+        # {path: JSON-able content} of the files the job reads its inputs
+        #from, written only when the job is submitted. None removes the file,
+        #for one the job writes, left from an earlier submission
+        self.manifests = {}
 
     def prepend_cmd(self, prefix):
         self.cmd =  prefix + self.cmd 
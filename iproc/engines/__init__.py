@@ -0,0 +1,49 @@
+'''
+Choice between the FSL/FreeSurfer/AFNI tools and their in-process replacements.
+
+The engines are set in the [engines] section of the subject config file:
+
+    [engines]
+    # fsl: one convertwarp and applywarp call per volume, then fslmerge
+    # numpy: the same chain in-process, with iproc.warp
+    WARP = fsl
+    # freesurfer: mri_vol2surf and mri_surf2surf for each input and hemisphere
+    # numpy: projection and smoothing in-process, with iproc.surface
+    SURFACE = freesurfer
+    # afni: nuisance_regress (3dTproject), bandpass (3dBandpass) and
+    #   wholebrain_only_regress (3dTproject) as three steps
+    # numpy: nuisance_regress in-process, with iproc.regress, and in
+    #   filter_and_project the single denoise step in place of all three
+    REGRESS = afni
+
+The external tools stay the default. iProc exports the choice to the
+environment (export()), where the runscripts that have both paths read it.
+'''
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# [engines] option: (environment variable, choices, the first is the default)
+ENGINES = {
+    'WARP': ('IPROC_WARP_ENGINE', ('fsl', 'numpy')),
+    'SURFACE': ('IPROC_SURF_ENGINE', ('freesurfer', 'numpy')),
+    'REGRESS': ('IPROC_REGRESS_ENGINE', ('afni', 'numpy')),
+}
+
+def export(conf):
+    ''' copy the [engines] section of the config into the environment of the jobs '''
+    for option,(variable,choices) in ENGINES.items():
+        value = conf.get('engines', option)
+        if value is not None:
+            os.environ[variable] = value.strip()
+        # fail here rather than in a job
+        engine(option)
+
+def engine(option):
+    ''' engine of an [engines] option, from the environment '''
+    variable,choices = ENGINES[option]
+    value = os.environ.get(variable, choices[0])
+    if value not in choices:
+        raise ValueError(f'{option} engine must be one of {", ".join(choices)}, not {value}')
+    return value
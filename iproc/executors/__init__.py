@@ -3,13 +3,32 @@ import sys
 import pkgutil
 import importlib
 import time
+import uuid
 import logging
+import collections
 from iproc.commons import which
 import iproc.commons as commons
 
 current_module = sys.modules[__name__]
 logger = logging.getLogger(__name__)
 
+# states, of any executor, that a job does not leave once it is in them.
+# slurm decorates some of them, e.g. 'CANCELLED by 1234'
+TERMINAL_STATES = (
+    'COMPLETED',
+    'FAILED',
+    'CANCELLED',
+    'TIMEOUT',
+    'OUT_OF_MEMORY',
+    'NODE_FAIL',
+    'BOOT_FAIL',
+    'DEADLINE',
+    'PREEMPTED',
+)
+
+def is_terminal(state):
+    return bool(state) and any(s in state for s in TERMINAL_STATES)
+
 def get(name=None):
     if name:
        return importlib.import_module('.' + name, 'iproc.executors')
@@ -20,23 +39,112 @@ def _detect_scheduler():
         module = loader.find_module(modname).load_module(modname)
         if module.__name__ == '__version__':
             continue
+        elif modname == 'local':
+            # always available, only used when asked for by name
+            continue
         elif module.available():
             return module
     raise SchedulerNotFoundError('no scheduler was found on this system')
 
-def wait_for_finished_job(executor,jobs,cancel_on_fail,polling_interval,jobs_to_wait_for):
+def wait_for_finished_job(executor,jobs,cancel_on_fail,polling_interval,jobs_to_wait_for,watcher=None,collector=None):
     ''' polls jobs in 'jobs' dict(ID:jobSpec), 
     returns the number of finished jobs when job count exceeds jobs_to_wait_for.
     waits for the specified number of minutes in between polling attempts.
+    If a CompletionWatcher is passed in, the wait is cut short as soon as
+    a job reports its exit. If a cleanup.Collector is passed in, it gets to
+    remove the intermediates of finished jobs after every poll.
     '''
     while True:
         finished_job_count = executor.poll_count(jobs, cancel_on_fail)
+        if collector:
+            collector.collect(jobs.values())
         if finished_job_count < jobs_to_wait_for: 
-            time.sleep(60 * polling_interval)
+            if watcher:
+                watcher.wait(jobs, 60 * polling_interval)
+            elif hasattr(executor, 'wait'):
+                # executors that can tell when a job exits
+                executor.wait(jobs, 60 * polling_interval)
+            else:
+                time.sleep(60 * polling_interval)
             continue
         else:
             return finished_job_count
 
+class CompletionWatcher(object):
+    '''
+    Completion notification for rolling_submit. Each submitted job is wrapped
+    in wrappers/notify_exit.sh, which writes a sentinel file holding the exit
+    status of the job into notify_dir when the job exits. Instead of sleeping
+    out the whole polling interval, the driver checks notify_dir with an
+    adaptive back-off, and goes back to the scheduler as soon as a sentinel 
+    shows up. The scheduler is still polled at least once per polling 
+    interval, in case a job dies without running its exit trap.
+
+    The sentinels live on the (networked) output file system and are written
+    from compute nodes, so inotify would not see them. Listing a single 
+    directory is cheap compared to a scheduler query, so it is done instead.
+    '''
+    def __init__(self, notify_dir, wrapper, min_interval=2, max_interval=60):
+        self.notify_dir = notify_dir
+        self.wrapper = wrapper
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._delay = min_interval
+        self._seen = set()
+        if not os.path.isdir(notify_dir):
+            os.makedirs(notify_dir)
+
+    def attach(self, job):
+        ''' wrap job command so that it writes a sentinel on exit '''
+        if job.skip or job.dummy or job.sentinel:
+            return
+        job.sentinel = os.path.join(self.notify_dir, '{}.exit'.format(uuid.uuid4().hex))
+        job.prepend_cmd([self.wrapper, job.sentinel])
+
+    def wait(self, jobs, timeout):
+        '''
+        block until a job in 'jobs' dict(ID:jobSpec) has written a sentinel 
+        that the scheduler has not yet confirmed, or until timeout seconds 
+        have passed. Returns the number of such jobs.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return 0
+            time.sleep(min(self._delay, remaining))
+            self._delay = min(self._delay * 2, self.max_interval)
+            exited = self._scan()
+            fresh = exited - self._seen
+            self._seen |= exited
+            if fresh:
+                logger.debug('{} job(s) reported exit'.format(len(fresh)))
+                self._delay = self.min_interval
+            # jobs can show up here a little before the scheduler catches up,
+            # so keep waking up (at the backed-off pace) until it does. A job
+            # that failed under --skip-fail is as confirmed as a completed one
+            unconfirmed = [job for job in jobs.values() if job.sentinel in exited and not is_terminal(job.state)]
+            if unconfirmed:
+                return len(unconfirmed)
+
+    def cleanup(self, jobs):
+        ''' remove sentinels of finished jobs '''
+        for job in jobs:
+            if not job.sentinel:
+                continue
+            try:
+                os.remove(job.sentinel)
+            except OSError:
+                pass
+            self._seen.discard(job.sentinel)
+
+    def _scan(self):
+        try:
+            return {entry.path for entry in os.scandir(self.notify_dir) if entry.name.endswith('.exit')}
+        except OSError as e:
+            logger.debug(e)
+            return set()
+
 def afterok_submit(executor, job, **kwargs):
     '''submits jobid, then adds jobid to jobs that depend on it in the job
     queue, from the 'afterok' structure, and returns jobid or sentinel object
@@ -52,12 +160,15 @@ def afterok_submit(executor, job, **kwargs):
             dependent_job,afterok_kwargs = dependent_pair
             if not jobid == commons.skipped_job:
                 afterok_kwargs['parent'] = jobid 
+            elif kwargs.get('parent'):
+                # skipped job in the middle of a chain, wait on its own parent instead
+                afterok_kwargs['parent'] = kwargs['parent']
             else:
                 logger.debug('parent already ran, not assigning jobid value to parent key') 
             # dependent job will have been added to jobspeclist after parent, so this is all we need to do
     return jobid 
 
-def rolling_submit(executor,jobspec_list, job_limit=float('inf'), polling_interval=5, cancel_on_fail=True):
+def rolling_submit(executor,jobspec_list, job_limit=float('inf'), polling_interval=5, cancel_on_fail=True, watcher=None, collector=None):
     '''
     takes in a list of jobs and makes sure that there are always as many jobs
     running as there can be
@@ -69,7 +180,14 @@ def rolling_submit(executor,jobspec_list, job_limit=float('inf'), polling_interv
     :type polling_interval: int
     :param cancel_on_fail: Cancel jobs on failure
     :type cancel_on_fail: bool
+    :param watcher: wake up on job completion sentinels instead of sleeping
+    :type watcher: CompletionWatcher or None
+    :param collector: remove intermediates as soon as they are no longer needed,
+        and hold back jobs while the subject is at its disk quota
+    :type collector: cleanup.Collector or None
     '''
+    if collector:
+        collector.track(job_spec for job_spec,_ in jobspec_list)
     number_of_jobs = len(jobspec_list)
     if number_of_jobs < job_limit:
         job_limit = number_of_jobs
@@ -77,19 +195,25 @@ def rolling_submit(executor,jobspec_list, job_limit=float('inf'), polling_interv
     old_total_finished = 0
     jobs={}
     while jobspec_list:
-        if active_job_count < job_limit :
+        # with nothing running, waiting would not free up any space
+        held = active_job_count and collector and collector.hold(jobspec_list[0][0])
+        if active_job_count < job_limit and not held:
             job_spec,kwargs = jobspec_list.pop(0)
+            if watcher:
+                watcher.attach(job_spec)
             jid = afterok_submit(executor, job_spec, **kwargs)
             if jid == commons.skipped_job:
                 logger.info('jid == skipped job')
                 continue
             active_job_count += 1
             jobs[jid] = (job_spec) 
+            if collector:
+                collector.submitted(job_spec)
         else:
             #want to let one additional job finish
             jobs_to_wait_for=old_total_finished+1
             logger.info('waiting for {} jobs to be done'.format(jobs_to_wait_for))
-            total_finished_jobs = wait_for_finished_job(executor,jobs, cancel_on_fail,polling_interval,jobs_to_wait_for)
+            total_finished_jobs = wait_for_finished_job(executor,jobs, cancel_on_fail,polling_interval,jobs_to_wait_for,watcher,collector)
             newly_finished_job_count = total_finished_jobs - old_total_finished 
             active_job_count -= newly_finished_job_count
             old_total_finished = total_finished_jobs
@@ -98,12 +222,222 @@ def rolling_submit(executor,jobspec_list, job_limit=float('inf'), polling_interv
             logger.debug('{} active jobs'.format(active_job_count))
     final_jobs_to_wait_for = old_total_finished + active_job_count
     assert(final_jobs_to_wait_for <= number_of_jobs)
-    wait_for_finished_job(executor, jobs,cancel_on_fail,polling_interval,jobs_to_wait_for=final_jobs_to_wait_for) 
+    wait_for_finished_job(executor, jobs,cancel_on_fail,polling_interval,jobs_to_wait_for=final_jobs_to_wait_for,watcher=watcher,collector=collector) 
+    if watcher:
+        watcher.cleanup(list(jobs.values()))
     # print job profiling information, only available in slurm right now
     job_profiles = executor.profile(list(jobs.keys()))
     logger.debug('job profile\n%s', job_profiles)
     return True
 
+def array_submit(executor, job_spec_list, kwargs, manifest_dir, runner, throttle=None, polling_interval=5, cancel_on_fail=True, watcher=None, collector=None):
+    '''
+    submits the jobs of a step as job arrays instead of one job at a time, 
+    and waits for them all to finish. The throttle is handed to the scheduler
+    (e.g. the %N suffix of sbatch --array) rather than enforced by polling.
+    Dependent (afterok) jobs go into a second array, where each task waits for
+    the corresponding task of the first array if the two line up one to one,
+    and otherwise are submitted one by one with a dependency on their parent
+    task.
+    :param job_spec_list: list of JobSpecs, all sharing kwargs
+    :type job_spec_list: list
+    :param kwargs: kwargs for the executor, as for rolling_submit
+    :type kwargs: dict
+    :param manifest_dir: directory to write the array manifests to
+    :type manifest_dir: str
+    :param runner: script that runs one array task from a manifest
+    :type runner: str
+    :param throttle: Maximum number of tasks of an array running at once
+    :type throttle: int or None
+    '''
+    def manifest(jobs):
+        name = jobs[0].name if jobs[0].name else os.path.basename(jobs[0].cmd[0])
+        return os.path.join(manifest_dir, '{}_{}.manifest'.format(name, uuid.uuid4().hex[:8]))
+
+    def kwargs_key(job_kwargs):
+        return tuple(sorted((k,str(v)) for k,v in job_kwargs.items() if k != 'parent'))
+
+    def array_kwargs(job_kwargs):
+        # the afterok kwargs are shared by every job of a step, and may hold
+        # a parent left there by another submission; arrays get theirs from
+        # aftercorr, or have none
+        return {k:v for k,v in job_kwargs.items() if k != 'parent'}
+
+    parents = [job for job in job_spec_list if not job.skip]
+    # dependents of submitted jobs, and of jobs that were skipped
+    chained,unchained = [],[]
+    for job in job_spec_list:
+        for dependent_job,afterok_kwargs in job.afterok:
+            if dependent_job.skip:
+                continue
+            if job.skip:
+                unchained.append((dependent_job,afterok_kwargs))
+            else:
+                chained.append((job,dependent_job,afterok_kwargs))
+    if watcher:
+        for job in parents + [d for _,d,_ in chained] + [d for d,_ in unchained]:
+            watcher.attach(job)
+    if collector:
+        collector.track(job_spec_list + [d for job in job_spec_list for d,_ in job.afterok])
+
+    jobs = {}
+    parent_ids = {}
+    if parents:
+        task_ids = executor.submit_array(parents, manifest(parents), runner, throttle=throttle, **kwargs)
+        for task_id,job in zip(task_ids, parents):
+            jobs[task_id] = job
+            parent_ids[id(job)] = task_id
+    # aftercorr needs task N of the dependent array to belong to task N of the parent array
+    one_to_one = (len(chained) == len(parents) and
+                  [id(p) for p,_,_ in chained] == [id(p) for p in parents] and
+                  len({kwargs_key(k) for _,_,k in chained}) == 1)
+    if chained and one_to_one:
+        array_id = parent_ids[id(parents[0])].split('_')[0]
+        dependents = [d for _,d,_ in chained]
+        task_ids = executor.submit_array(dependents, manifest(dependents), runner, aftercorr=array_id, throttle=throttle, **array_kwargs(chained[0][2]))
+        jobs.update(zip(task_ids, dependents))
+    else:
+        for parent,dependent_job,afterok_kwargs in chained:
+            # a copy per job, the dict is shared by all dependents of the step
+            job_kwargs = dict(afterok_kwargs, parent=parent_ids[id(parent)])
+            jobs[executor.submit(dependent_job, **job_kwargs)] = dependent_job
+    # jobs whose parent already ran, grouped by resource request
+    groups = {}
+    for dependent_job,afterok_kwargs in unchained:
+        groups.setdefault(kwargs_key(afterok_kwargs), []).append((dependent_job,afterok_kwargs))
+    for group in groups.values():
+        dependents = [d for d,_ in group]
+        task_ids = executor.submit_array(dependents, manifest(dependents), runner, throttle=throttle, **array_kwargs(group[0][1]))
+        jobs.update(zip(task_ids, dependents))
+
+    if not jobs:
+        if collector:
+            # everything was skipped, its intermediates can still go
+            collector.collect([])
+        return True
+    wait_for_finished_job(executor, jobs, cancel_on_fail, polling_interval, len(jobs), watcher, collector)
+    if watcher:
+        watcher.cleanup(list(jobs.values()))
+    job_profiles = executor.profile(list(jobs.keys()))
+    logger.debug('job profile\n%s', job_profiles)
+    return True
+
+class PipelineGraph(object):
+    '''
+    The steps of a stage, with the dependencies between them. Instead of 
+    running a step only once the step before it has finished entirely, every
+    job is submitted up front, and only waits on the jobs it needs: the jobs
+    of the same run (JobSpec.run) in the steps listed in 'after', and every
+    job of the steps listed in 'after_all'.
+
+    If a run has no job in a step it depends on (its outputs were already 
+    there, or the step is set to SKIP), it waits on whatever that step 
+    depended on for the run instead.
+    '''
+    Step = collections.namedtuple('Step', ['name', 'job_spec_list', 'kwargs', 'after', 'after_all'])
+
+    def __init__(self):
+        self.steps = collections.OrderedDict()
+
+    def add_step(self, name, job_spec_list, kwargs, after=(), after_all=()):
+        '''
+        add a step. Steps it depends on have to be added first.
+        :param kwargs: executor kwargs shared by the jobs of the step
+        :type kwargs: dict
+        :param after: names of steps whose job for the same run has to succeed first
+        :type after: list
+        :param after_all: names of steps whose jobs all have to succeed first
+        :type after_all: list
+        '''
+        for dependency in list(after) + list(after_all):
+            if dependency not in self.steps:
+                raise ValueError('step {} depends on {}, which has not been added'.format(name, dependency))
+        self.steps[name] = self.Step(name, job_spec_list, kwargs, list(after), list(after_all))
+
+    def job_spec_lists(self):
+        return [step.job_spec_list for step in self.steps.values()]
+
+    def submit(self, executor):
+        '''
+        submit every job, parents before dependents. Returns dict(ID:jobSpec).
+        '''
+        jobs = {}
+        # step name: {run: [job ids]}, ids of None are jobs not tied to a run
+        submitted = {}
+        for step in self.steps.values():
+            submitted[step.name] = collections.defaultdict(list)
+            for job in step.job_spec_list:
+                if job.skip:
+                    continue
+                parents = []
+                for dependency in step.after:
+                    parents += self._parent_ids(submitted, dependency, job.run)
+                for dependency in step.after_all:
+                    parents += self._parent_ids(submitted, dependency, None)
+                kwargs = dict(step.kwargs)
+                kwargs.pop('parent', None)
+                if parents:
+                    kwargs['parent'] = ':'.join(sorted(set(parents)))
+                jobid = afterok_submit(executor, job, **kwargs)
+                if jobid == commons.skipped_job:
+                    continue
+                jobs[jobid] = job
+                submitted[step.name][job.run].append(jobid)
+                for dependent_job,afterok_kwargs in job.afterok:
+                    if dependent_job.skip:
+                        continue
+                    dependent_id = afterok_submit(executor, dependent_job, **afterok_kwargs)
+                    jobs[dependent_id] = dependent_job
+                    submitted[step.name][job.run].append(dependent_id)
+        return jobs
+
+    def _parent_ids(self, submitted, name, run):
+        step = self.steps[name]
+        if run is None or None in submitted[name]:
+            # whole step, or a step that is not split up by run
+            ids = [i for run_ids in submitted[name].values() for i in run_ids]
+            if ids or step.job_spec_list:
+                return ids
+        elif run in submitted[name]:
+            return list(submitted[name][run])
+        # nothing submitted for this run, fall through to what the step waited on
+        ids = []
+        for dependency in step.after:
+            ids += self._parent_ids(submitted, dependency, run)
+        for dependency in step.after_all:
+            ids += self._parent_ids(submitted, dependency, None)
+        return ids
+
+def graph_submit(executor, graph, polling_interval=5, cancel_on_fail=True, watcher=None, collector=None):
+    '''
+    submits all jobs of a PipelineGraph at once, with the scheduler holding 
+    back each job until its parents have succeeded, then waits for all of 
+    them to finish.
+    :param graph: the steps to run
+    :type graph: PipelineGraph
+    '''
+    if watcher:
+        for job_spec_list in graph.job_spec_lists():
+            for job in job_spec_list:
+                watcher.attach(job)
+                for dependent_job,_ in job.afterok:
+                    watcher.attach(dependent_job)
+    if collector:
+        collector.track(j for job_spec_list in graph.job_spec_lists() for job in job_spec_list
+                        for j in [job] + [d for d,_ in job.afterok])
+    jobs = graph.submit(executor)
+    if not jobs:
+        if collector:
+            # everything was skipped, its intermediates can still go
+            collector.collect([])
+        return True
+    wait_for_finished_job(executor, jobs, cancel_on_fail, polling_interval, len(jobs), watcher, collector)
+    if watcher:
+        watcher.cleanup(list(jobs.values()))
+    job_profiles = executor.profile(list(jobs.keys()))
+    logger.debug('job profile\n%s', job_profiles)
+    return True
+
 class SchedulerNotFoundError(Exception):
     pass
 
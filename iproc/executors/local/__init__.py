@@ -0,0 +1,268 @@
+import os
+import re
+import time
+import socket
+import logging
+import subprocess as sp
+import collections
+import iproc.commons as commons
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks on running processes while waiting
+CHECK_INTERVAL = 0.5
+
+MEM_UNITS = {
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4
+}
+
+def available():
+    # always there, but never auto-detected over a real scheduler
+    return True
+
+def parse_mem(mem):
+    '''
+    Convert a memory request as written in cluster_requests.csv (e.g. 25GB,
+    500M, 2048) to bytes. Like sbatch, a number without a unit is megabytes.
+    '''
+    if mem is None:
+        return 0
+    match = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)B?\s*$', str(mem), re.IGNORECASE)
+    if not match:
+        raise ValueError('could not parse memory request "{}"'.format(mem))
+    value,unit = match.groups()
+    return int(float(value) * MEM_UNITS[unit.upper() if unit else 'M'])
+
+def _available_memory():
+    try:
+        with open('/proc/meminfo') as fo:
+            for line in fo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+def _available_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count()))
+
+class Task(object):
+    '''
+    a job handed to the local executor, from submission until it exits
+    '''
+    def __init__(self, job_id, job, cpu, mem, parents):
+        self.job_id = job_id
+        self.job = job
+        self.cpu = cpu
+        self.mem = mem
+        self.parents = parents
+        self.state = 'PENDING'
+        self.cores = []
+        self.process = None
+        self.start = None
+        self.end = None
+        self.rusage = None
+
+class Pool(object):
+    '''
+    Runs jobs as child processes of iProc. A job is started once all jobs it
+    depends on have completed, and its cpu and mem request fit into what is
+    left of the cores and memory that were free when the pool was created.
+    Each job is pinned to the cores it was given, so scripts that size their
+    thread count from their cpu affinity use exactly their share.
+    '''
+    def __init__(self, cores=None, mem=None):
+        self.cores = cores if cores is not None else _available_cores()
+        self.mem = mem if mem is not None else _available_memory()
+        self.free_cores = list(self.cores)
+        self.free_mem = self.mem
+        self.tasks = collections.OrderedDict()
+        self.hostname = socket.gethostname().split('.')[0]
+        self._counter = 0
+        logger.debug('local pool with {} cores and {} bytes of memory'.format(len(self.cores), self.mem))
+
+    def submit(self, job, cpu=1, mem=None, parent=None):
+        self._counter += 1
+        job_id = str(self._counter)
+        cpu = int(cpu)
+        if cpu > len(self.cores):
+            logger.warning('job {} asks for {} cpus, only {} are available'.format(job_id, cpu, len(self.cores)))
+        mem = parse_mem(mem)
+        parents = str(parent).split(':') if parent else []
+        self.tasks[job_id] = Task(job_id, job, cpu, mem, parents)
+        job.stdout = job.logfile_base + '_{}_{}.out'.format(self.hostname, job_id)
+        job.stderr = job.logfile_base + '_{}_{}.err'.format(self.hostname, job_id)
+        self.schedule()
+        return job_id
+
+    def schedule(self):
+        ''' reap finished processes, then start whatever can run now '''
+        for task in self.tasks.values():
+            if task.state == 'RUNNING':
+                self._reap(task)
+        for task in self.tasks.values():
+            if task.state != 'PENDING':
+                continue
+            parent_states = [self.tasks[p].state if p in self.tasks else 'COMPLETED' for p in task.parents]
+            if any(s not in ('PENDING', 'RUNNING', 'COMPLETED') for s in parent_states):
+                # same as slurm with --kill-on-invalid-dep
+                logger.info('cancelling job {}, a job it depends on did not complete'.format(task.job_id))
+                task.state = 'CANCELLED'
+                continue
+            if any(s != 'COMPLETED' for s in parent_states):
+                continue
+            if self._fits(task):
+                self._start(task)
+
+    def _fits(self, task):
+        running = [t for t in self.tasks.values() if t.state == 'RUNNING']
+        if not running:
+            # an oversized job still gets to run, on its own
+            return True
+        return task.cpu <= len(self.free_cores) and task.mem <= self.free_mem
+
+    def _start(self, task):
+        cpu = min(task.cpu, len(self.free_cores)) or 1
+        task.cores, self.free_cores = self.free_cores[:cpu], self.free_cores[cpu:]
+        self.free_mem -= task.mem
+        cores = set(task.cores) if task.cores else None
+        def pin():
+            if cores and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, cores)
+        env = dict(os.environ, SLURM_CPUS_PER_TASK=str(cpu), OMP_NUM_THREADS=str(cpu))
+        logger.debug('running job {}: {}'.format(task.job_id, sp.list2cmdline(task.job.cmd)))
+        with open(task.job.stdout, 'w') as stdout, open(task.job.stderr, 'w') as stderr:
+            task.process = sp.Popen(task.job.cmd, stdout=stdout, stderr=stderr, env=env, preexec_fn=pin)
+        task.start = time.time()
+        task.state = 'RUNNING'
+
+    def _reap(self, task):
+        try:
+            pid,status,rusage = os.wait4(task.process.pid, os.WNOHANG)
+            if pid == 0:
+                return
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+        except ChildProcessError:
+            # already collected by the Popen object
+            returncode = task.process.wait()
+            rusage = None
+        task.end = time.time()
+        task.rusage = rusage
+        task.process.returncode = returncode
+        task.state = 'COMPLETED' if returncode == 0 else 'FAILED'
+        self.free_cores.extend(task.cores)
+        self.free_cores.sort()
+        self.free_mem += task.mem
+        logger.debug('job {} exited with {}'.format(task.job_id, returncode))
+
+    def cancel(self, job_ids):
+        for job_id in job_ids:
+            task = self.tasks[job_id]
+            if task.state == 'RUNNING':
+                task.process.terminate()
+                task.process.wait()
+                self._reap(task)
+                task.state = 'CANCELLED'
+            elif task.state == 'PENDING':
+                task.state = 'CANCELLED'
+
+_pool = None
+
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = Pool()
+    return _pool
+
+def submit(job, cpu=1, mem=None, parent=None, **kwargs):
+    '''
+    Given a JobSpec, queue it to run on this machine. Returns a job id.
+    Other keyword arguments (partition, time, ...) do not apply locally.
+    '''
+    if job.skip:
+        logger.debug('skipped job:')
+        logger.debug(job)
+        return commons.skipped_job
+    elif job.dummy:
+        logger.info(job.cmd)
+        return 'dummy_{}'.format(id(job))
+    return pool().submit(job, cpu=cpu, mem=mem, parent=parent)
+
+def poll_count(jobs, cancel_on_fail=True):
+    '''
+    poll a dict of job ids: JobSpecs and return the number of finished jobs.
+    With cancel_on_fail, a failed job cancels all others and raises
+    FailedJobError. Without it, failed and cancelled jobs count as finished,
+    so that the remaining jobs keep going.
+    '''
+    if all(job.dummy for job in jobs.values()):
+        return len(jobs)
+    p = pool()
+    p.schedule()
+    finished_job_count = 0
+    failed_jobs = []
+    for job_id,job in jobs.items():
+        task = p.tasks[job_id]
+        job.state = task.state
+        if task.state == 'COMPLETED':
+            finished_job_count += 1
+        elif task.state in ('FAILED', 'CANCELLED'):
+            failed_jobs.append(job)
+            if not cancel_on_fail:
+                finished_job_count += 1
+    if failed_jobs:
+        loglist = ['local jobs have failed']
+        for job in failed_jobs:
+            loglist.append('{} job, logs at:'.format(job.state))
+            loglist.append('{} {}'.format(job.stderr, job.stdout))
+        if cancel_on_fail:
+            logger.warning('performing autocancel...')
+            p.cancel(list(jobs.keys()))
+            raise commons.FailedJobError('\n'.join(loglist))
+        logger.warning('\n'.join(loglist))
+    return finished_job_count
+
+def wait(jobs, timeout):
+    '''
+    block until a job in 'jobs' dict(ID:jobSpec) exits, or until timeout
+    seconds have passed
+    '''
+    p = pool()
+    deadline = time.time() + timeout
+    running = {job_id for job_id in jobs if job_id in p.tasks and p.tasks[job_id].state in ('PENDING', 'RUNNING')}
+    while running and time.time() < deadline:
+        p.schedule()
+        if any(p.tasks[job_id].state not in ('PENDING', 'RUNNING') for job_id in running):
+            return
+        time.sleep(min(CHECK_INTERVAL, max(deadline - time.time(), 0)))
+
+def profile(job_ids):
+    ''' get profiling information for a list of job ids '''
+    job_ids = list(job_ids)
+    if not job_ids:
+        return 'no jobids to profile'
+    if 'dummy' in job_ids[0]:
+        return 'dummy run, no profiling to show'
+    p = pool()
+    rows = ['{:>8} {:<40} {:<10} {:>4} {:>12} {:>12} {:>10} {:>10}'.format(
+        'JobID', 'JobName', 'State', 'CPU', 'ReqMem', 'MaxRSS', 'Elapsed', 'TotalCPU')]
+    for job_id in job_ids:
+        task = p.tasks[job_id]
+        elapsed = (task.end or time.time()) - task.start if task.start else 0
+        maxrss = totalcpu = ''
+        if task.rusage:
+            # ru_maxrss is in kilobytes on linux
+            maxrss = '{}K'.format(task.rusage.ru_maxrss)
+            totalcpu = '{:.0f}'.format(task.rusage.ru_utime + task.rusage.ru_stime)
+        rows.append('{:>8} {:<40} {:<10} {:>4} {:>12} {:>12} {:>10.0f} {:>10}'.format(
+            job_id, task.job.name or '', task.state, task.cpu, task.mem, maxrss, elapsed, totalcpu))
+    return '\n'.join(rows)
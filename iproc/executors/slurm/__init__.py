@@ -8,6 +8,7 @@ import re
 import random
 import shutil
 import glob
+import shlex
 import collections
 import subprocess as sp
 from . import runtime
@@ -51,7 +52,7 @@ def submit(job, time, mem, cpu=1, partition='ncf', nodelist=None, exclude=None,
     Given a JobSpec, submit the job. 
     '''
 
-    stepname = os.path.basename(job.cmd[0])
+    stepname = job.name if job.name else os.path.basename(job.cmd[0])
     # %N completes to hostname, %j to job in slurmland
     stdout = job.logfile_base +'_%N_%j.out'
     stderr = job.logfile_base +'_%N_%j.err'
@@ -93,6 +94,99 @@ def submit(job, time, mem, cpu=1, partition='ncf', nodelist=None, exclude=None,
     job.stderr = job.logfile_base +'*_{}.err'.format(jobid)
     return jobid
            
+def submit_array(jobs, manifest, runner, time, mem, cpu=1, partition='ncf', nodelist=None, exclude=None, aftercorr=None, throttle=None, **kwargs):
+    '''
+    Given a list of JobSpecs that share their resource request, submit them 
+    as a single job array with one task per JobSpec. The command of each task
+    is written to the manifest file, where the runner script picks it up. 
+    Returns the list of task ids (<array id>_<index>), in the order of jobs.
+
+    :param manifest: File to write the per-task log file bases and commands to
+    :type manifest: str
+    :param runner: Path to wrappers/array_task.sh
+    :type runner: str
+    :param aftercorr: Id of an array with the same number of tasks, task N of
+                      this array will wait for task N of that one to succeed
+    :type aftercorr: str
+    :param throttle: Maximum number of tasks running at once
+    :type throttle: int
+    '''
+    stepname = jobs[0].name if jobs[0].name else os.path.basename(jobs[0].cmd[0])
+    # the runner redirects each task to its own logs, these only catch
+    # failures of the runner itself
+    manifest_base = os.path.splitext(manifest)[0]
+    array = '0-{}'.format(len(jobs) - 1)
+    if throttle:
+        array += '%{}'.format(throttle)
+    sbatch_cmd = [
+        'sbatch', '--parsable',
+        '--partition', partition,
+        '--job-name', stepname,
+        '--time', time,
+        '--mem', mem,
+        '-c', str(cpu),
+        '--array', array,
+        '-o', manifest_base + '_%A_%a.out',
+        '-e', manifest_base + '_%A_%a.err'
+    ]
+    if nodelist:
+        sbatch_cmd.extend(['--nodelist', nodelist])
+    if exclude:
+        sbatch_cmd.extend(['--exclude', exclude])
+    if aftercorr:
+        sbatch_cmd.extend(['--dependency', 'aftercorr:{JID}'.format(JID=aftercorr)])
+        logger.debug('parent array is {}'.format(aftercorr))
+    if kwargs:
+        # used for the sbatch_args command line function in iProc.py
+        for arg in list(kwargs.values()):
+            sbatch_cmd.append(arg)
+    sbatch_cmd.extend([runner, manifest])
+    logger.debug('submitting {0}'.format(sp.list2cmdline(sbatch_cmd)))
+    if all(job.dummy for job in jobs):
+        logger.debug(sbatch_cmd)
+        dummy_id = random.randint(0,9999)
+        return ['dummy_{}_{}'.format(dummy_id, index) for index in range(len(jobs))]
+
+    manifest_dir = os.path.dirname(manifest)
+    if manifest_dir and not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest, 'w') as fo:
+        for job in jobs:
+            fo.write(' '.join(shlex.quote(x) for x in [job.logfile_base] + list(job.cmd)) + '\n')
+    array_id = commons.check_output(sbatch_cmd).strip()
+    logger.debug('array id is {0}'.format(array_id))
+    task_ids = []
+    for index,job in enumerate(jobs):
+        task_id = '{}_{}'.format(array_id, index)
+        job.stdout = job.logfile_base +'*_{}.out'.format(task_id)
+        job.stderr = job.logfile_base +'*_{}.err'.format(task_id)
+        task_ids.append(task_id)
+    return task_ids
+
+def _job_id_key(job_id):
+    ''' sort key for plain (123) and array task (123_4) job ids '''
+    return tuple(int(x) for x in job_id.split('_'))
+
+def _expand_array_job_id(job_id):
+    '''
+    sacct reports array tasks that have not started yet on one line, e.g. 
+    123_[4-7,9%2]. Expand that into a list of task ids.
+    '''
+    match = re.match(r'^(\d+)_\[([^\]]+)\]$', job_id)
+    if not match:
+        return [job_id]
+    array_id,spec = match.groups()
+    spec = spec.split('%')[0]
+    task_ids = []
+    for part in spec.split(','):
+        if '-' in part:
+            start,stop = part.split('-')
+            indices = range(int(start), int(stop) + 1)
+        else:
+            indices = [int(part)]
+        task_ids.extend('{}_{}'.format(array_id, i) for i in indices)
+    return task_ids
+
 def collect(jobs, polling_interval=5, cancel_on_fail=True):
     '''
     This function will block until a Slurm job fails, where it will throw an error
@@ -116,42 +210,88 @@ def collect(jobs, polling_interval=5, cancel_on_fail=True):
     logger.debug('job profile\n%s', job_profiles)
     return True
 
-def _sacct_state_query(job_ids):
-    
-    if not job_ids:
+def _is_terminal(job_state):
+    ''' True if a job in this state will not change state anymore '''
+    if 'COMPLETED' in job_state:
+        return True
+    return any(failed_state in job_state for failed_state in FAILED_STATES)
+
+def _parse_job_rows(output):
+    ''' parse JobID|<field> rows into a dict, expanding pending array ranges '''
+    job_states = {}
+    for line in output.split('\n'):
+        fields = line.strip().split('|')
+        if len(fields) != 2 or not re.match(r'^\d', fields[0]):
+            # header, blank or warning line
+            continue
+        job_id,job_state = fields
+        for task_id in _expand_array_job_id(job_id):
+            job_states[task_id] = job_state
+    return job_states
+
+def _squeue_state_query(job_ids):
+    ''' states of jobs still known to the controller, i.e. pending or running '''
+    squeue_list = [
+        'squeue',
+        '--noheader',
+        '--array',
+        '--states', 'all',
+        '--format', '%i|%T',
+        '--jobs', ','.join(job_ids)
+    ]
+    logger.debug(squeue_list)
+    try:
+        return _parse_job_rows(commons.check_output(squeue_list))
+    except sp.CalledProcessError as e:
+        # squeue errors out if none of the jobs are known to it anymore
+        logger.debug('Squeue Error')
+        logger.debug(e)
         return {}
-    def sacct(job_ids):
-        sacct_list = [
-        'sacct', 
+
+def _sacct_state_query(job_ids):
+    ''' states of jobs from the accounting database, for jobs that have left the queue '''
+    sacct_list = [
+        'sacct',
         '--noheader',
         '--parsable2',
         '--allocations',
         '--jobs', ','.join(job_ids),
-        '--format', 'State'
-        ]
-        logger.debug(sacct_list)
-        return sacct_list
+        '--format', 'JobID,State'
+    ]
+    logger.debug(sacct_list)
     try:
-        sacct_output = commons.check_output(sacct(job_ids)).strip('\n')
-        job_state_list = sacct_output.split('\n')
-        logger.debug(job_state_list)
+        return _parse_job_rows(commons.check_output(sacct_list))
     except sp.CalledProcessError as e:
         logger.debug('Sacct Error')
         logger.info(e)
-        job_state_list = []
-        
-    if len(job_state_list) == len(job_ids):
-        job_states = dict(list(zip(job_ids, job_state_list)))
-    else:
-        job_states={}
-        #we need to go one at a time, because slurm has not returned all jobids 
-        #therefore, results could be in any order
-        for job in job_ids:
-            sacct_cmd = sacct([job])
-            job_state = commons.check_output(sacct_cmd).strip('\n')
-            logger.debug(job_state)
-            job_states[job] = job_state
+        return {}
 
+# JobID: State, for jobs that have reached a terminal state
+_terminal_states = {}
+
+def _job_state_query(job_ids):
+    '''
+    Get the state of each job in job_ids. Rows are matched to jobs by their
+    JobID, so missing or extra rows do not matter. Jobs that reached a 
+    terminal state on an earlier poll are answered from a cache, jobs still
+    in the queue are looked up with one squeue call, and only the rest with
+    one sacct call. Jobs that neither knows about yet are left out.
+    '''
+    job_states = {job_id: _terminal_states[job_id] for job_id in job_ids if job_id in _terminal_states}
+    remaining = [job_id for job_id in job_ids if job_id not in job_states]
+    if remaining:
+        found = _squeue_state_query(remaining)
+        job_states.update((job_id, found[job_id]) for job_id in remaining if job_id in found)
+        remaining = [job_id for job_id in remaining if job_id not in found]
+    if remaining:
+        found = _sacct_state_query(remaining)
+        job_states.update((job_id, found[job_id]) for job_id in remaining if job_id in found)
+        for job_id in remaining:
+            if job_id not in found:
+                logger.debug('no state for job {} yet'.format(job_id))
+    for job_id,job_state in job_states.items():
+        if _is_terminal(job_state):
+            _terminal_states[job_id] = job_state
     logger.debug(job_states)
     return job_states
 
@@ -167,6 +307,81 @@ def __poll(jobs, cancel_on_fail=True):
     else: #return_jobs > joblimit. Not good
         raise Exception
 
+# ids of finished jobs whose logs have not shown up yet
+_pending_logs = set()
+# how many polls each of them has been looked for on
+_pending_log_polls = collections.Counter()
+# polls after which a job whose logs never showed up is given up on
+MAX_LOG_POLLS = 10
+
+def _sacct_nodelist_query(job_ids):
+    ''' node each job ran on, as a dict of JobID: NodeList '''
+    sacct_list = [
+        'sacct',
+        '--noheader',
+        '--parsable2',
+        '--allocations',
+        '--jobs', ','.join(job_ids),
+        '--format', 'JobID,NodeList'
+    ]
+    logger.debug(sacct_list)
+    try:
+        return _parse_job_rows(commons.check_output(sacct_list))
+    except sp.CalledProcessError as e:
+        logger.debug('Sacct Error')
+        logger.info(e)
+        return {}
+
+def _resolve_logs(jobs):
+    '''
+    Replace the stdout/stderr globs of finished jobs in dict(ID:jobSpec) with 
+    file names, without waiting on the file system. If a glob does not match
+    yet (NFS attribute caching can hide new files for minutes), the name is
+    built from the node sacct reports the job ran on, the same way sbatch 
+    expands %N and %j, and used once those files exist. Returns the ids of
+    jobs that could not be resolved either way, so a later poll can retry
+    them. After MAX_LOG_POLLS tries, a job is given up on with a warning.
+    '''
+    unresolved = {}
+    for job_id,job in jobs.items():
+        errlist = glob.glob(job.stderr)
+        outlist = glob.glob(job.stdout)
+        if len(errlist) > 1 or len(outlist) > 1:
+            logger.error(errlist + outlist)
+            logger.error('{} {}'.format(job.stderr, job.stdout))
+            raise IOError('more than one log file matches job {}'.format(job_id))
+        if errlist and outlist:
+            job.stderr = errlist[0]
+            job.stdout = outlist[0]
+            _forget_pending(job_id)
+        else:
+            unresolved[job_id] = job
+    if not unresolved:
+        return []
+    nodes = _sacct_nodelist_query(sorted(unresolved, key=_job_id_key))
+    for job_id,job in list(unresolved.items()):
+        node = nodes.get(job_id, '')
+        if node and node != 'None assigned' and '[' not in node:
+            stderr = job.logfile_base + '_{}_{}.err'.format(node, job_id)
+            stdout = job.logfile_base + '_{}_{}.out'.format(node, job_id)
+            if os.path.exists(stderr) and os.path.exists(stdout):
+                logger.debug('logs of job {} found from node {}'.format(job_id, node))
+                job.stderr,job.stdout = stderr,stdout
+                _forget_pending(job_id)
+                del unresolved[job_id]
+                continue
+        _pending_log_polls[job_id] += 1
+        if _pending_log_polls[job_id] >= MAX_LOG_POLLS:
+            logger.warning('logs of job {} did not show up after {} polls, giving up on them ({})'.format(
+                job_id, MAX_LOG_POLLS, job.stderr))
+            _forget_pending(job_id)
+            del unresolved[job_id]
+    return list(unresolved)
+
+def _forget_pending(job_id):
+    _pending_logs.discard(job_id)
+    _pending_log_polls.pop(job_id, None)
+
 def poll_count(jobs, cancel_on_fail=True):
     ''' poll a list of generic job ids and return the number of finished jobs '''
     job_ids = list(jobs.keys())
@@ -180,8 +395,8 @@ def poll_count(jobs, cancel_on_fail=True):
         else:
             return len(jobs)
 
-    job_ids = sorted(job_ids,key=int)
-    job_states = _sacct_state_query(job_ids)
+    job_ids = sorted(job_ids,key=_job_id_key)
+    job_states = _job_state_query(job_ids)
     logger.debug('job states are\n' + json.dumps(job_states, indent=2))
     # iterate over each polled job state to check for failure
     failed_jobs = []
@@ -196,6 +411,7 @@ def poll_count(jobs, cancel_on_fail=True):
 
     # check completion and update job state
     finished_job_count=0
+    newly_finished = {}
     for job_id,job_state in list(job_states.items()):
         job = jobs[job_id]
         if job.state == 'COMPLETED':
@@ -210,42 +426,21 @@ def poll_count(jobs, cancel_on_fail=True):
         if incomplete_flag:
                 # keep going on to the next job
                 continue
-        if 'COMPLETED' in job_state or job_state in FAILED_STATES:
-            # convert glob to actual filename.
-            # could replace star with host job ran on, as job is now in sacct
-            errlist = glob.glob(job.stderr)
-            if len(errlist) != 1:
-                # wait a minute, then retry one last time
-                time.sleep(1*60)
-                errlist = glob.glob(job.stderr)
-                if len(errlist) > 1:
-                    logger.error(errlist)
-                    logger.error(job.stderr)
-                    raise IOError
-                elif len(errlist)==0 :
-                    logger.error(job.stderr)
-                    if job_state == 'CANCELLED':
-                        # probably autocanceled dependent job
-                        continue
-                    else:
-                        logger.error(job.stderr)
-                        logger.error(job_state)
-                        raise IOError
-            job.stderr = errlist[0]
-            outlist = glob.glob(job.stdout)
-            if len(outlist) != 1:
-                # wait ten minutes, then retry one last time
-                time.sleep(10*60)
-                outlist = glob.glob(job.stdout)
-                if len(outlist) != 1:
-                    logger.error(outlist)
-                    logger.error(job.stdout)
-                    raise IOError
-            job.stdout = outlist[0]
+        if _is_terminal(job_state):
+            newly_finished[job_id] = job
         if 'COMPLETED' in job_state:
             finished_job_count += 1
         # set object's state to state from query
         job.state = job_state
+    # logs of jobs that finished on an earlier poll, but could not be found then
+    retry = {job_id: jobs[job_id] for job_id in _pending_logs if job_id in jobs}
+    retry.update(newly_finished)
+    for job_id in _resolve_logs(retry):
+        if 'CANCELLED' in jobs[job_id].state and job_id not in _pending_logs:
+            # probably autocanceled dependent job, which never started
+            logger.debug('no logs for cancelled job {}'.format(job_id))
+            continue
+        _pending_logs.add(job_id)
 
     if failed_jobs:
         job_profiles = profile(job_ids)
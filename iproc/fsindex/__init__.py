@@ -0,0 +1,94 @@
+'''
+Existence checks answered from directory listings.
+
+Building a job list checks thousands of outfiles, most of them in a few
+dozen directories. On NFS, one os.scandir per directory is far cheaper than
+one stat per file, so each directory is listed once, the listing is kept,
+and the directories of a batch of paths are listed in parallel threads.
+
+Listings go stale when jobs write to the directories, call clear() before
+that happens.
+'''
+import os
+import logging
+import threading
+import concurrent.futures as cf
+
+logger = logging.getLogger(__name__)
+
+# directory listings are network bound, not cpu bound
+THREADS = 16
+
+class FileIndex(object):
+    def __init__(self, threads=THREADS):
+        self.threads = threads
+        # directory: {name: is_symlink}, or None if the directory does not exist
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def _scan(self, directory):
+        subdirs = []
+        try:
+            listing = {}
+            with os.scandir(directory) as it:
+                for entry in it:
+                    listing[entry.name] = entry.is_symlink()
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+        except (FileNotFoundError, NotADirectoryError):
+            listing = None
+        with self._lock:
+            self._listings[directory] = listing
+        return subdirs
+
+    def _listing(self, directory):
+        with self._lock:
+            if directory in self._listings:
+                return self._listings[directory]
+        self._scan(directory)
+        return self._listings[directory]
+
+    def prefetch(self, paths):
+        ''' list the directories of paths that have not been listed yet, in parallel '''
+        with self._lock:
+            directories = {os.path.dirname(os.path.abspath(p)) for p in paths} - set(self._listings)
+        if len(directories) < 2:
+            return
+        logger.debug('listing {} directories'.format(len(directories)))
+        with cf.ThreadPoolExecutor(min(self.threads, len(directories))) as ex:
+            list(ex.map(self._scan, directories))
+
+    def prefetch_tree(self, roots, depth=4):
+        '''
+        list every directory under roots, down to depth levels, with all
+        directories of a level listed in parallel
+        '''
+        level = [os.path.abspath(r) for r in roots if r]
+        with cf.ThreadPoolExecutor(self.threads) as ex:
+            for _ in range(depth + 1):
+                if not level:
+                    break
+                logger.debug('listing {} directories'.format(len(level)))
+                level = [d for subdirs in ex.map(self._scan, level) for d in subdirs]
+
+    def exists(self, path):
+        ''' same as os.path.exists, from the listing of the directory of path '''
+        path = os.path.abspath(path)
+        directory,name = os.path.split(path)
+        if not name:
+            return os.path.exists(path)
+        listing = self._listing(directory)
+        if listing is None or name not in listing:
+            return False
+        if listing[name]:
+            # a dangling symlink does not exist
+            return os.path.exists(path)
+        return True
+
+    def empty(self):
+        with self._lock:
+            return not self._listings
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
@@ -0,0 +1,197 @@
+'''
+Ingest of BIDS images, in-process.
+
+The per-file runscripts (func_from_bids.py, anat_from_bids.py) are one job
+per image, each paying the scheduler latency and the start-up of Python and
+FSL for one fslmaths -odt float. Here the same conversions are done with
+NumPy, so that one job can ingest every image of a session:
+
+ - fslmaths -odt float: the data is scaled and cast to float32, and written
+   under a copy of the input header
+ - fslorient -getorient / -swaporient: if the sform (or the qform, without
+   an sform) is not RADIOLOGICAL, the x axis of both is flipped, the header
+   only, as fslorient does it
+ - fslroi skip numvol: only those volumes are written. As in the runscript,
+   nothing is cut when skip is 0
+
+4D runs are streamed a chunk of volumes at a time into an uncompressed
+memory map in scratch, and compressed into place with iproc.codec.
+'''
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import tempfile
+import subprocess as sp
+import numpy as np
+import nibabel as nib
+import iproc.codec as codec
+import iproc.nuisance as nuisance
+import iproc.warp as warp
+
+logger = logging.getLogger(__name__)
+
+def is_radiological(header):
+    ''' fslorient -getorient, from the sform if it is set, else the qform '''
+    affine,code = header.get_sform(coded=True)
+    if not code:
+        affine,_ = header.get_qform(coded=True)
+    return np.linalg.det(affine[:3,:3]) < 0
+
+def swaporient(header):
+    ''' in place, fslorient -swaporient: flip the x axis of the qform and sform, not the data '''
+    swap = np.eye(4)
+    swap[0,0] = -1
+    swap[0,3] = header.get_data_shape()[0] - 1
+    affine,code = header.get_qform(coded=True)
+    if code:
+        header.set_qform(affine @ swap, int(code))
+    affine,code = header.get_sform(coded=True)
+    if code:
+        header.set_sform(affine @ swap, int(code))
+
+def to_float(input, output, skip=0, numvol=None, radiological=False, scratch=None, nthreads=None):
+    '''
+    fslmaths input output -odt float, then, for 4D images, fslroi output
+    output skip numvol if skip is not 0. With radiological, the header is
+    swapped to RADIOLOGICAL if it is not already, like forceorient() of
+    func_from_bids.py.
+    :param nthreads: compression threads, see codec.compress()
+    '''
+    img = nib.load(input)
+    header = img.header.copy()
+    if radiological and not is_radiological(header):
+        logger.info(f'{input} is not RADIOLOGICAL, swapping its orientation')
+        swaporient(header)
+    # the image with the header to write, the data is not read
+    ref = type(img)(img.dataobj, None, header)
+    start,stop = 0,(img.shape[3] if img.ndim > 3 else 1)
+    if img.ndim > 3 and skip:
+        start = skip
+        if numvol is not None:
+            stop = min(stop, skip + numvol)
+    tmpdir = tempfile.mkdtemp(dir=scratch)
+    try:
+        tmp = os.path.join(tmpdir, re.sub(r'\.gz$', '', os.path.basename(output)))
+        out = warp.create_4d(tmp, ref, stop - start if img.ndim > 3 else None)
+        if img.ndim > 3:
+            flat = out.reshape((-1, out.shape[3]), order='F')
+            for first,data in nuisance.iter_volumes(input):
+                lo,hi = max(first, start),min(first + data.shape[1], stop)
+                if lo < hi:
+                    flat[:,lo - start:hi - start] = data[:,lo - first:hi - first]
+            del flat
+        else:
+            out[:] = np.asanyarray(img.dataobj, dtype=np.float32)
+        out.flush()
+        del out
+        codec.store(tmp, output, nthreads=nthreads)
+    finally:
+        shutil.rmtree(tmpdir)
+    logger.info(f'wrote {output}')
+    return output
+
+def write_sec(input, sec_base, numechos):
+    '''
+    EchoTime and EffectiveEchoSpacing of the sidecar of input, in the .sec
+    files of translate_json() of func_from_bids.py
+    :returns: the sidecar, and the files written
+    '''
+    nifti_basename = re.match(r'^(.*)\.nii(\.gz)?$', input).group(1)
+    json_name = f'{nifti_basename}.json'
+    with open(json_name) as j:
+        scan_data = json.load(j)
+    echoTime = scan_data['EchoTime']
+    dwellTime = scan_data['EffectiveEchoSpacing']
+    # not going to use here, but want to make sure it's in json
+    scan_data['PhaseEncodingDirection']
+    if int(numechos) == 1:
+        echoTime_fname = f'{sec_base}_echoTime.sec'
+        dwellTime_fname = f'{sec_base}_dwellTime.sec'
+    else:
+        echonum = int(re.search(r'_echo-([0-9]+)_', os.path.basename(input)).group(1))
+        echoTime_fname = f'{sec_base}_echoTime_e{echonum}.sec'
+        dwellTime_fname = f'{sec_base}_dwellTime_e{echonum}.sec'
+    # rounding to be consistent with xnat_to_nii_gz_task
+    with open(echoTime_fname, 'w') as f:
+        f.write(f'{echoTime:.4f}')
+    with open(dwellTime_fname, 'w') as f:
+        f.write(f'{dwellTime:.5f}')
+    return json_name,[echoTime_fname, dwellTime_fname]
+
+def func(input, output, sec_base, skip, numvol, numechos, scratch=None, nthreads=None):
+    ''' what runscript/func_from_bids.py does, in-process '''
+    to_float(input, output, int(skip), int(numvol), radiological=True, scratch=scratch, nthreads=nthreads)
+    json_name,written = write_sec(input, sec_base, numechos)
+    if int(numechos) == 1:
+        dst = f'{sec_base}.json'
+    else:
+        dst = re.sub(r'\.nii\.gz$', '.json', output)
+    shutil.copyfile(json_name, dst)
+    return [output, dst] + written
+
+def anat(input, raw_output, reorient_output, scratch=None, nthreads=None):
+    ''' what runscript/anat_from_bids.py does, in-process '''
+    to_float(input, raw_output, scratch=scratch, nthreads=nthreads)
+    shutil.copy2(raw_output, reorient_output)
+    return [raw_output, reorient_output]
+
+def command(cmd):
+    ''' a runscript that has no in-process equivalent, e.g. fieldmap preparation '''
+    logger.info(sp.list2cmdline(cmd))
+    proc = sp.run(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
+    output = proc.stdout.decode(errors='replace')
+    logger.info(output)
+    if proc.returncode:
+        raise sp.CalledProcessError(proc.returncode, cmd, output)
+    return []
+
+KINDS = {
+    'func': func,
+    'anat': anat,
+    'command': command,
+}
+
+def run_item(item, scratch=None, nthreads=None):
+    '''
+    ingest one image of a manifest
+    :param nthreads: compression threads, see codec.compress()
+    :returns: its status, {'kind', 'name', 'outfiles', 'status', 'seconds', 'error'}
+    '''
+    kwargs = {k:v for k,v in item.items() if k not in ('kind', 'name', 'session', 'outfiles')}
+    if item['kind'] != 'command':
+        kwargs['scratch'] = scratch
+        kwargs['nthreads'] = nthreads
+    status = {'kind': item['kind'], 'name': item['name'], 'outfiles': item.get('outfiles', [])}
+    started = time.time()
+    try:
+        KINDS[item['kind']](**kwargs)
+        status['status'] = 'ok'
+    except Exception as e:
+        logger.exception(f'failed to ingest {item["name"]}')
+        status['status'] = 'failed'
+        status['error'] = getattr(e, 'output', None) or repr(e)
+    status['seconds'] = round(time.time() - started, 1)
+    return status
+
+def report(status_files):
+    '''
+    log the status of every image of batched ingest jobs, from their status
+    files, and return the images that failed
+    '''
+    failed = []
+    for fname in status_files:
+        if not os.path.exists(fname):
+            logger.warning(f'no status in {fname}, the job did not finish')
+            continue
+        with open(fname) as fo:
+            statuses = json.load(fo)
+        for status in statuses:
+            if status['status'] == 'ok':
+                logger.info(f'ingested {status["name"]} in {status["seconds"]}s')
+            else:
+                logger.error(f'failed to ingest {status["name"]}: {status.get("error")}')
+                failed.append(status)
+    return failed
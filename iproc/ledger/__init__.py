@@ -0,0 +1,165 @@
+'''
+SQLite ledger of the intermediate files of a subject.
+
+Three kinds of records are kept:
+
+ - handoffs: files a step creates, that a later step (the last one to need
+   them) deletes. Keyed by (step, session, scan), the same keys the old
+   pickled rmfiles dict had.
+ - releases: files that are safe to delete once a stage has run, which is
+   what rm_{stage}.sh is appended to from. They are pruned once they are in
+   the script, so each is only listed once.
+ - stages: the stages that have run, whether or not they handed any files
+   off.
+
+Every write is its own transaction, so the ledger is never left half
+written when iProc is killed, and each write only touches its own rows.
+'''
+import os
+import glob
+import pickle
+import sqlite3
+import logging
+import collections
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS handoffs (
+    stage TEXT,
+    step TEXT,
+    session TEXT,
+    scan TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS handoffs_key ON handoffs (step, session, scan);
+CREATE TABLE IF NOT EXISTS releases (
+    stage TEXT,
+    step TEXT,
+    session TEXT,
+    scan TEXT,
+    path TEXT,
+    UNIQUE (stage, step, session, scan, path)
+);
+CREATE INDEX IF NOT EXISTS releases_stage ON releases (stage);
+CREATE TABLE IF NOT EXISTS stages (
+    stage TEXT PRIMARY KEY
+);
+'''
+
+def _key(value):
+    return None if value is None else str(value)
+
+def _paths(rmfiles):
+    # a single path was stored as a plain string in places
+    if not rmfiles:
+        return []
+    if isinstance(rmfiles, str):
+        return [rmfiles]
+    return list(rmfiles)
+
+def disk_usage(path, seen=None):
+    '''
+    bytes used by a path, a glob, or a directory tree; 0 if gone.
+    :param seen: files already counted, by real path, and not to count again
+    '''
+    seen = set() if seen is None else seen
+    total = 0
+    for match in glob.glob(path):
+        if os.path.isdir(match) and not os.path.islink(match):
+            files = [os.path.join(root, f) for root,_,names in os.walk(match) for f in names]
+        else:
+            files = [match]
+        for fname in files:
+            real = os.path.realpath(fname)
+            if real in seen:
+                continue
+            seen.add(real)
+            try:
+                total += os.lstat(fname).st_size
+            except OSError:
+                pass
+    return total
+
+class ArtifactLedger(object):
+    def __init__(self, fname):
+        self.fname = fname
+        # autocommit, transactions are opened explicitly
+        self.db = sqlite3.connect(fname, timeout=60, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def _transaction(self, statements):
+        cur = self.db.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            for sql,params in statements:
+                cur.executemany(sql, params)
+            cur.execute('COMMIT')
+        except:
+            cur.execute('ROLLBACK')
+            raise
+
+    def set_handoff(self, stage, step, session, scan, rmfiles):
+        ''' replace the files that step deletes for (session, scan) '''
+        key = (step, _key(session), _key(scan))
+        self._transaction([
+            ('DELETE FROM handoffs WHERE step IS ? AND session IS ? AND scan IS ?', [key]),
+            ('INSERT INTO handoffs VALUES (?, ?, ?, ?, ?)', [(stage,) + key + (p,) for p in _paths(rmfiles)]),
+            ('INSERT OR IGNORE INTO stages VALUES (?)', [(stage,)] if stage else [])
+        ])
+
+    def get_handoff(self, step, session, scan):
+        rows = self.db.execute('SELECT path FROM handoffs WHERE step IS ? AND session IS ? AND scan IS ? ORDER BY rowid',
+            (step, _key(session), _key(scan)))
+        return [path for path, in rows]
+
+    def has_stage(self, stage):
+        ''' whether stage has run, even if it handed no files off to later steps '''
+        row = self.db.execute('SELECT 1 FROM stages WHERE stage IS ?', (stage,)).fetchone()
+        if row is None:
+            # ledgers from before the stages table
+            row = self.db.execute('SELECT 1 FROM handoffs WHERE stage IS ? LIMIT 1', (stage,)).fetchone()
+        return row is not None
+
+    def mark_stage(self, stage):
+        ''' record that stage has run '''
+        self._transaction([('INSERT OR IGNORE INTO stages VALUES (?)', [(stage,)])])
+
+    def import_pickle(self, stage, fname):
+        ''' load a rmfiles dump of the pickled {step: {session: {scan: rmfiles}}} kind '''
+        with open(fname, 'rb') as f:
+            rmfiles = pickle.load(f)
+        for step,sessions in rmfiles.items():
+            for session,scans in sessions.items():
+                for scan,paths in scans.items():
+                    self.set_handoff(stage, step, session, scan, paths)
+        logger.info(f'imported rmfiles from {fname} into {self.fname}')
+
+    def release(self, stage, jobs):
+        ''' record the rmfiles of jobs as safe to delete after stage '''
+        rows = []
+        for job in jobs:
+            session,scan = job.run if job.run else (None, None)
+            rows += [(stage, job.name, _key(session), _key(scan), p) for p in _paths(job.rmfiles)]
+        self._transaction([('INSERT OR IGNORE INTO releases VALUES (?, ?, ?, ?, ?)', rows)])
+
+    def releasable(self, stage):
+        ''' all files safe to delete after stage, in the order they were released '''
+        rows = self.db.execute('SELECT path FROM releases WHERE stage IS ? GROUP BY path ORDER BY MIN(rowid)', (stage,))
+        return [path for path, in rows]
+
+    def prune_releases(self, stage, paths):
+        ''' forget released files of stage, once they are in its rm script '''
+        self._transaction([('DELETE FROM releases WHERE stage IS ? AND path IS ?', [(stage, p) for p in paths])])
+
+    def reclaimable(self, stage=None):
+        ''' bytes that deleting the released files would free, per step '''
+        if stage is None:
+            rows = self.db.execute('SELECT DISTINCT step, path FROM releases')
+        else:
+            rows = self.db.execute('SELECT DISTINCT step, path FROM releases WHERE stage IS ?', (stage,))
+        per_step = collections.OrderedDict()
+        seen = set()
+        for step,path in rows:
+            per_step[step] = per_step.get(step, 0) + disk_usage(path, seen)
+        return per_step
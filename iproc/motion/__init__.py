@@ -0,0 +1,70 @@
+'''
+Motion outliers from mcflirt motion parameters.
+
+Framewise displacement (FD) is computed as in Power et al., 2012,
+Neuroimage, and fsl_motion_outliers --fd: the sum of the absolute
+volume-to-volume changes of the 3 translations, and of the 3 rotations
+as arc lengths on a sphere of 50mm radius. The first volume has an FD of 0.
+
+A .par file has one row per volume, with the 3 rotations (radians) first and
+the 3 translations (mm) last. FD only depends on the changes between
+volumes, so it does not matter which volume mcflirt used as its reference.
+'''
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# head radius (mm) to turn rotations into displacements
+HEAD_RADIUS = 50.0
+# how many volumes past the middle one to try, if the middle one is an outlier
+MIDVOL_TRIES = 5
+# fraction of outlier volumes to warn about
+OUTLIER_WARNING = 0.2
+
+def read_par(fname, numvol=None):
+    '''
+    mcflirt motion parameters as an (N,6) array. With numvol, only the last
+    numvol volumes are kept, as in p2a.sh.
+    '''
+    par = np.loadtxt(fname, comments='#', ndmin=2)
+    if par.shape[1] != 6:
+        raise ValueError('{} has {} columns, expected 6'.format(fname, par.shape[1]))
+    if numvol is not None:
+        if par.shape[0] < numvol:
+            raise ValueError('{} has {} rows, expected {}'.format(fname, par.shape[0], numvol))
+        par = par[-numvol:]
+    return par
+
+def framewise_displacement(par, radius=HEAD_RADIUS):
+    ''' (N,) FD of each volume, from (N,6) motion parameters '''
+    delta = np.abs(np.diff(par, axis=0, prepend=par[:1]))
+    return radius * delta[:,:3].sum(axis=1) + delta[:,3:].sum(axis=1)
+
+def outliers(fd, thresh):
+    ''' indices of the volumes whose FD is above thresh '''
+    return np.flatnonzero(fd > float(thresh))
+
+def choose_midvol(numvol, outlier_idx, tries=MIDVOL_TRIES):
+    '''
+    the middle volume, or the first of the volumes after it that is not an
+    outlier. Raises ValueError if none of them will do.
+    '''
+    midvol = numvol // 2
+    bad = set(int(i) for i in outlier_idx)
+    for candidate in range(midvol, min(midvol + tries, numvol)):
+        if candidate not in bad:
+            return candidate
+        logger.info('{} is an outlier'.format(candidate))
+    raise ValueError('unable to find a usable midvol in {} volumes after {}'.format(tries, midvol))
+
+def outlier_matrix(outlier_idx, numvol):
+    ''' (N,M) regressors, one per outlier, 1 at the outlier volume and 0 elsewhere '''
+    outlier_idx = np.asarray(outlier_idx, dtype=int)
+    outlier_idx = outlier_idx[outlier_idx < numvol]
+    matrix = np.zeros((numvol, outlier_idx.size), dtype=np.uint8)
+    matrix[outlier_idx, np.arange(outlier_idx.size)] = 1
+    return matrix
+
+def write_outlier_matrix(fname, matrix):
+    np.savetxt(fname, matrix, fmt='%d', delimiter=' ')
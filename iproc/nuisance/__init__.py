@@ -0,0 +1,112 @@
+'''
+Nuisance regressors, computed in-process from a 4D run and a set of masks.
+
+The 4D image is read once, front to back, a chunk of volumes at a time, and
+the mean of every mask is taken for all volumes of a chunk with a single
+sparse matrix product, so any number of masks costs one pass over the data.
+'''
+import logging
+import collections
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+from scipy.stats import zscore
+from scipy.signal import detrend
+
+logger = logging.getLogger(__name__)
+
+# volumes read at a time, a few hundred MB for a 2mm run
+CHUNK = 32
+
+def iter_volumes(fname, chunk=CHUNK):
+    '''
+    Stream a NIfTI image, compressed or not, in one sequential pass.
+    Yields the index of the first volume of each chunk, and a (P,k) float32
+    array with one row per voxel in NIfTI (Fortran) order and one column per
+    volume.
+    '''
+    img = nib.load(fname)
+    # the proxy, not img.header, has the data offset and scaling on disk
+    proxy = img.dataobj
+    nvox = int(np.prod(img.shape[:3]))
+    numvol = img.shape[3] if img.ndim > 3 else 1
+    dtype = proxy.dtype
+    slope,inter = proxy.slope, proxy.inter
+    with nib.openers.ImageOpener(fname) as fo:
+        fo.seek(proxy.offset)
+        for start in range(0, numvol, chunk):
+            k = min(chunk, numvol - start)
+            buf = fo.read(nvox * k * dtype.itemsize)
+            if len(buf) < nvox * k * dtype.itemsize:
+                raise IOError('{} is truncated'.format(fname))
+            data = np.frombuffer(buf, dtype=dtype).reshape((nvox, k), order='F').astype(np.float32)
+            if slope != 1.0:
+                data *= slope
+            if inter != 0.0:
+                data += inter
+            yield start, data
+
+def mask_weights(masks, shape):
+    '''
+    Sparse (M,P) matrix that averages the voxels of each of M masks. Like
+    fslmeants, a voxel is in a mask if its value is above zero.
+    :param masks: mask file names
+    :param shape: spatial shape of the images the masks are applied to
+    '''
+    rows = []
+    for fname in masks:
+        mask = np.asanyarray(nib.load(fname).dataobj)
+        if mask.shape[:3] != tuple(shape[:3]):
+            raise ValueError('mask {} is {}, data is {}'.format(fname, mask.shape[:3], tuple(shape[:3])))
+        voxels = np.flatnonzero(mask.reshape(-1, order='F') > 0)
+        if voxels.size == 0:
+            raise ValueError('mask {} is empty'.format(fname))
+        rows.append(sparse.csr_matrix(
+            (np.full(voxels.size, 1.0 / voxels.size), (np.zeros(voxels.size, dtype=int), voxels)),
+            shape=(1, int(np.prod(shape[:3])))))
+    return sparse.vstack(rows).tocsr()
+
+def mask_means(fname, masks, chunk=CHUNK):
+    '''
+    Mean timeseries of each mask over a 4D image, with a single read of it.
+    :returns: (N,M) array, one column per mask
+    '''
+    img = nib.load(fname)
+    numvol = img.shape[3] if img.ndim > 3 else 1
+    weights = mask_weights(masks, img.shape)
+    means = np.empty((numvol, len(masks)))
+    for start,data in iter_volumes(fname, chunk):
+        means[start:start + data.shape[1]] = (weights @ data).T
+    return means
+
+def regressors_36p(nuis_ts):
+    '''
+    Detrended and normalized regressors, their temporal derivatives (18P)
+    and the squares of both (36P), as in Satterthwaite et al., 2013,
+    Neuroimage. Runs of equal length can be stacked along a leading axis
+    and are all computed at once.
+    :param nuis_ts: (N,9) or (R,N,9) array, 6 motion parameters and CSF, WM
+        and WB means for each of N volumes
+    :returns: (N,36) or (R,N,36) array
+    '''
+    nuis_norm = zscore(detrend(nuis_ts, axis=-2), ddof=1, axis=-2)
+    nuis_deriv1 = np.diff(nuis_norm, axis=-2, prepend=nuis_norm[...,:1,:])
+    nuis_18P = np.concatenate([nuis_norm, nuis_deriv1], axis=-1)
+    return np.concatenate([nuis_18P, nuis_18P ** 2], axis=-1)
+
+def batch_regressors_36p(nuis_ts_list):
+    '''
+    regressors_36p() for a list of runs, with runs of equal length stacked
+    and computed together.
+    :returns: list of (N,36) arrays, in the order of nuis_ts_list
+    '''
+    by_length = collections.defaultdict(list)
+    for i,nuis_ts in enumerate(nuis_ts_list):
+        by_length[nuis_ts.shape].append(i)
+    results = [None] * len(nuis_ts_list)
+    for shape,indices in by_length.items():
+        stacked = regressors_36p(np.stack([nuis_ts_list[i] for i in indices]))
+        logger.debug('36P for {} runs of shape {}'.format(len(indices), shape))
+        for i,regressors in zip(indices, stacked):
+            results[i] = regressors
+    return results
@@ -0,0 +1,149 @@
+'''
+Provenance of job outputs, for make-like rerun decisions.
+
+When a job is submitted, each of its outfiles gets a record marking it as
+started. When the job completes, the record is replaced with what the job
+was run from:
+
+ - the command line, as the step built it, before any wrappers are
+   prepended (the notify wrapper adds a path that differs on every run)
+ - the md5 of every script in the command line (anything under CODEDIR)
+ - the size and mtime of every other file in the command line (its inputs)
+ - every config value that appears in the command line, other than
+   directories
+
+An existing outfile is only up to date if its record is complete, and the
+scripts, inputs and config values it was made from have not changed since,
+nor has the command line, for steps that build it before deciding to skip
+(it carries values from the scan and task CSVs, e.g. SKIP and NUMVOL).
+Inputs that have been removed since (intermediates) are not a change.
+Outfiles that predate provenance records have no record at all, and are
+trusted as they were before.
+'''
+import os
+import json
+import hashlib
+import logging
+import iproc.commons as commons
+
+logger = logging.getLogger(__name__)
+
+STARTED = 'started'
+COMPLETED = 'completed'
+
+def command(cmd, rmfiles=None):
+    '''
+    a command line as it is recorded, without the trailing list of files to
+    remove, which depends on what else runs with the job
+    '''
+    cmd = [str(arg) for arg in cmd or []]
+    if rmfiles and cmd and cmd[-1] == ' '.join(rmfiles):
+        cmd = cmd[:-1]
+    return cmd
+
+def file_stat(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+class Provenance(object):
+    def __init__(self, record_dir, conf):
+        self.record_dir = record_dir
+        self.conf = conf
+        self.codedir = os.path.realpath(os.path.expanduser(conf.iproc.CODEDIR))
+        self._md5 = {}
+        self._records = {}
+
+    def _record_file(self, outfile):
+        digest = hashlib.md5(os.path.abspath(outfile).encode()).hexdigest()
+        return os.path.join(self.record_dir, digest[:2], digest + '.json')
+
+    def _write(self, outfile, record):
+        def write(tmp):
+            with open(tmp, 'w') as fo:
+                json.dump(dict(record, outfile=outfile), fo, indent=2)
+        commons.replace_file(self._record_file(outfile), write)
+        self._records[outfile] = dict(record, outfile=outfile)
+
+    def read(self, outfile):
+        ''' the record of an outfile, or None if it has none '''
+        if outfile not in self._records:
+            try:
+                with open(self._record_file(outfile)) as fo:
+                    self._records[outfile] = json.load(fo)
+            except (IOError, ValueError):
+                self._records[outfile] = None
+        return self._records[outfile]
+
+    def md5(self, fname):
+        if fname not in self._md5:
+            self._md5[fname] = commons.md5file(fname)
+        return self._md5[fname]
+
+    def _is_script(self, fname):
+        return os.path.realpath(fname).startswith(self.codedir + os.sep)
+
+    def key(self, job):
+        '''
+        what a job is run from, see the module docstring
+        '''
+        cmd = [str(arg) for arg in job.cmd or []]
+        outfiles = set(job.outfiles)
+        scripts = {}
+        inputs = {}
+        for arg in cmd:
+            if arg in outfiles or not os.path.isfile(arg):
+                continue
+            if self._is_script(arg):
+                scripts[arg] = self.md5(arg)
+            else:
+                inputs[arg] = file_stat(arg)
+        args = set(cmd)
+        config = {}
+        for section,items in self.conf.items().items():
+            for name,value in items:
+                # directories are locations, not settings, a change to them
+                # changes the paths the job uses anyway
+                if value in args and not os.path.isdir(value):
+                    config[f'{section}.{name}'] = value
+        return dict(cmd=command(job.command, job.rmfiles), scripts=scripts, inputs=inputs, config=config)
+
+    def started(self, job):
+        for outfile in job.outfiles:
+            self._write(outfile, dict(state=STARTED, cmd=command(job.command, job.rmfiles)))
+
+    def completed(self, job):
+        record = dict(self.key(job), state=COMPLETED)
+        for outfile in job.outfiles:
+            if os.path.exists(outfile):
+                self._write(outfile, record)
+
+    def check(self, outfiles, pending=(), cmd=None):
+        '''
+        whether existing outfiles are up to date.
+        :param pending: files that jobs yet to run will write
+        :param cmd: the command line that would write them, if it is known
+        :returns: (bool, reason)
+        '''
+        if cmd is not None:
+            cmd = command(cmd)
+        for outfile in outfiles:
+            record = self.read(outfile)
+            if record is None:
+                continue
+            if record['state'] != COMPLETED:
+                return False, f'the job writing {outfile} did not complete'
+            if cmd is not None and record['cmd'] != cmd:
+                return False, f'the command line that writes {outfile} changed'
+            for fname,md5 in record['scripts'].items():
+                if not os.path.exists(fname) or self.md5(fname) != md5:
+                    return False, f'{fname} changed since {outfile} was written'
+            for fname,stat in record['inputs'].items():
+                if fname in pending:
+                    return False, f'{fname} is about to be rewritten'
+                if os.path.exists(fname) and file_stat(fname) != stat:
+                    return False, f'{fname} changed since {outfile} was written'
+            for name,value in record['config'].items():
+                section,option = name.split('.', 1)
+                if self.conf.get(section, option) != value:
+                    return False, f'config value {name} changed since {outfile} was written'
+        return True, None
@@ -1,25 +1,299 @@
-import subprocess as sp
+'''
+QC PDFs, rendered in-process.
+
+Each page is a mosaic of slices of one image, the way
+    fslreorient2std | fslswapdim | fslroi | slicer -u -S | convert label:
+used to draw it, but without the intermediate files: only the header and
+the slab of voxels inside the window are read (memory-mapped when the file
+is not compressed), the reorientation and swap are flips and transposes
+worked out from the affine and applied to that slab, and the mosaic is a
+NumPy array. Pages are rendered in a process pool and written one after the
+other into a multi-page PDF with matplotlib.
+
+A page of a 4D image shows its middle volume only. That volume is read
+through an indexed gzip reader when indexed_gzip is installed, so that it is
+reached by a seek rather than by inflating the run up to it, and the seek
+points found on the way are kept for the next read of the same file. It is
+then kept uncompressed under QCDIR/images, keyed by the path and mtime of
+the source, and so are the rendered mosaics of the pages: rerunning QC only
+reads and renders the pages whose image or window changed. A new entry
+replaces the one of the previous version of its source.
+
+qc_pdf_maker writes the pages of a PDF to a JSON manifest, and the job it
+returns runs runscript/qc_pdf.py on it.
+'''
 import os
-import shutil
+import glob
+import gzip
+import json
+import math
+import hashlib
 import logging
 import time
 import tempfile
+import concurrent.futures
+import numpy as np
+import nibabel as nib
 import iproc.commons as commons
 
 logger = logging.getLogger(__name__)
+
+# orientation fslreorient2std puts images in, that of the MNI152 templates
+STD_AXCODES = ('L', 'A', 'S')
+AXES = {'x': 0, 'y': 1, 'z': 2}
+# slicer -S width, in pixels, per image across
+PIXELS_PER_WIDTH = 180
+# slicer intensity range, robust min and max
+PERCENTILES = (2, 98)
+# convert -pointsize of the label
+POINTSIZE = 20
+# matplotlib font family of the label, also the fallback of iproc.font
+DEFAULT_FONT = 'sans-serif'
+# under the cache directory, middle volumes and rendered pages
+VOLUME_CACHE = 'volumes'
+PAGE_CACHE = 'pages'
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+def display_transform(affine, swapdims):
+    '''
+    fslreorient2std followed by fslswapdim, as index arithmetic: display axis
+    a is voxel axis perm[a] of the image, reversed if flip[a]
+    :returns: (perm, flip)
+    '''
+    to_std = nib.orientations.ornt_transform(nib.orientations.io_orientation(affine),
+        nib.orientations.axcodes2ornt(STD_AXCODES))
+    perm_std,flip_std = [0] * 3,[False] * 3
+    for axis,(std_axis,direction) in enumerate(to_std.astype(int)):
+        perm_std[std_axis] = axis
+        flip_std[std_axis] = direction < 0
+    perm,flip = [],[]
+    for dim in swapdims:
+        std_axis = AXES[dim.lstrip('-')]
+        perm.append(perm_std[std_axis])
+        flip.append(flip_std[std_axis] != dim.startswith('-'))
+    return perm,flip
+
+def midvol(img):
+    ''' index of the middle volume of an image, 0 if it is 3D '''
+    return img.shape[3] // 2 if img.ndim > 3 else 0
+
+def _sha1(value):
+    return hashlib.sha1(json.dumps(value).encode()).hexdigest()
+
+def cache_entry(dirname, fname, suffix, *extra):
+    '''
+    path of the cache entry under dirname of a file as it is now, and of
+    whatever else is derived from it. The name is <key of fname and
+    extra>.<key of the mtime and size of fname><suffix>, so that the entries
+    of older versions of the file can be found by their prefix (store_entry)
+    '''
+    st = os.stat(fname)
+    name = _sha1([os.path.abspath(fname)] + list(extra))
+    return os.path.join(dirname, f'{name}.{_sha1([st.st_mtime, st.st_size])}{suffix}')
+
+def store_entry(entry, write):
+    '''
+    write a cache entry with write(tmp), and remove the entries it replaces,
+    those of the same file and extra made before the file last changed
+    '''
+    dirname,basename = os.path.split(entry)
+    name,_,rest = basename.partition('.')
+    suffix = rest[rest.index('.'):]
+    commons.replace_file(entry, write, suffix)
+    for stale in glob.glob(os.path.join(dirname, f'{name}.*{suffix}')):
+        if stale != entry:
+            logger.debug(f'removing stale cache entry {stale}')
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                # another job got to it first
+                pass
+
+def read_bytes(fname, offset, nbytes, index_file=None):
+    '''
+    nbytes of the uncompressed content of fname from offset. A .gz file is
+    read through indexed_gzip if it is available, starting from the seek
+    points saved in index_file, and the index is saved there afterwards;
+    otherwise the stream is inflated up to offset, without being kept.
+    '''
+    if not fname.endswith('.gz'):
+        with open(fname, 'rb') as fo:
+            fo.seek(offset)
+            return fo.read(nbytes)
+    if indexed_gzip is None:
+        with gzip.open(fname, 'rb') as fo:
+            fo.seek(offset)
+            return fo.read(nbytes)
+    with indexed_gzip.IndexedGzipFile(fname) as fo:
+        have_index = index_file and os.path.exists(index_file)
+        if have_index:
+            fo.import_index(index_file)
+        fo.seek(offset)
+        data = fo.read(nbytes)
+        if index_file and not have_index:
+            store_entry(index_file, fo.export_index)
+    return data
+
+def read_volume(fname, volume=None, cache=None):
+    '''
+    one volume of an image, the middle one by default. Only the bytes of
+    that volume are read.
+    :param cache: directory to keep the seek index of fname in
+    :returns: (3D float32 array, affine)
+    '''
+    img = nib.load(fname)
+    volume = midvol(img) if volume is None else volume
+    # where the data is and how it is scaled, as the array proxy sees it
+    proxy = img.dataobj
+    shape = img.shape[:3]
+    nbytes = int(np.prod(shape)) * proxy.dtype.itemsize
+    index_file = None
+    if cache:
+        index_file = cache_entry(os.path.join(cache, VOLUME_CACHE), fname, '.gzidx')
+    buf = read_bytes(fname, int(proxy.offset) + volume * nbytes, nbytes, index_file)
+    if len(buf) != nbytes:
+        raise ValueError(f'{fname} is truncated, volume {volume} is not all there')
+    data = np.frombuffer(buf, dtype=proxy.dtype).reshape(shape, order='F').astype(np.float32)
+    return data * np.float32(proxy.slope) + np.float32(proxy.inter),img.affine
+
+def thumbnail(fname, cache):
+    '''
+    the image to render a page of fname from: fname if it is 3D, else its
+    middle volume, extracted once into cache and kept there, uncompressed, until
+    fname changes
+    '''
+    img = nib.load(fname)
+    if img.ndim < 4 or img.shape[3] == 1:
+        return fname
+    volume = midvol(img)
+    # the middle volume follows from the file, it is not part of the key
+    cached = cache_entry(os.path.join(cache, VOLUME_CACHE), fname, '.nii')
+    if os.path.exists(cached):
+        logger.debug(f'volume {volume} of {fname} is {cached}')
+        return cached
+    data,affine = read_volume(fname, volume, cache)
+    store_entry(cached, lambda tmp: nib.save(nib.Nifti1Image(data, affine), tmp))
+    logger.info(f'extracted volume {volume} of {fname} into {cached}')
+    return cached
+
+def read_window(fname, swapdims, window_dims, volume=None):
+    '''
+    the window of an image, in display orientation, as fslroi would cut it
+    out of the swapped image. Only the voxels of the window are read. For a
+    4D image, the window is taken from one volume, the middle one by default.
+    :param window_dims: xmin xsize ymin ysize zmin zsize, of the display axes
+    '''
+    img = nib.load(fname)
+    perm,flip = display_transform(img.affine, swapdims)
+    shape = img.shape[:3]
+    index = [None] * 3
+    for axis,(voxel_axis,reverse) in enumerate(zip(perm, flip)):
+        size = shape[voxel_axis]
+        start = min(max(int(window_dims[2 * axis]), 0), size)
+        stop = min(start + max(int(window_dims[2 * axis + 1]), 0), size)
+        if reverse:
+            start,stop = size - stop,size - start
+        index[voxel_axis] = slice(start, stop)
+    if img.ndim > 3:
+        index += [midvol(img) if volume is None else volume] + [0] * (img.ndim - 4)
+    slab = np.asanyarray(img.dataobj[tuple(index)], dtype=np.float32)
+    slab = slab.transpose(perm)
+    return slab[tuple(slice(None, None, -1) if reverse else slice(None) for reverse in flip)]
+
+def scale(data, percentiles=PERCENTILES):
+    ''' 8-bit grey levels over the robust range of the non-zero voxels '''
+    values = data[np.isfinite(data) & (data != 0)]
+    if not values.size:
+        return np.zeros(data.shape, dtype=np.uint8)
+    lo,hi = np.percentile(values, percentiles)
+    if hi <= lo:
+        hi = lo + 1
+    scaled = np.clip((np.nan_to_num(data) - lo) / (hi - lo), 0, 1)
+    return np.round(scaled * 255).astype(np.uint8)
+
+def mosaic(window, sample, width):
+    '''
+    every sample-th axial slice of the window, left to right and top to
+    bottom, in an image width pixels wide, as slicer -S sample width does it
+    '''
+    tiles = scale(window[:,:,::max(int(sample), 1)])
+    # x across, y up
+    tiles = tiles[:,::-1].transpose(2, 1, 0)
+    nslices,rows,cols = tiles.shape
+    across = max(int(width) // max(cols, 1), 1)
+    down = math.ceil(nslices / across)
+    out = np.zeros((down * rows, max(int(width), across * cols)), dtype=np.uint8)
+    for i,tile in enumerate(tiles):
+        row,col = divmod(i, across)
+        out[row * rows:(row + 1) * rows, col * cols:(col + 1) * cols] = tile
+    return out
+
+def render_page(spec):
+    '''
+    mosaic of one page of a manifest. With a cache directory, the mosaic is
+    kept there, and rendered again only if the image or the page changed.
+    :returns: (label, 8-bit image)
+    '''
+    cache = spec.get('cache')
+    width = int(spec['width']) * PIXELS_PER_WIDTH
+    if not cache:
+        window = read_window(spec['infile'], spec['swapdims'], spec['window_dims'])
+        return spec['label'],mosaic(window, spec['sample'], width)
+    cached = cache_entry(os.path.join(cache, PAGE_CACHE), spec['infile'], '.npz', spec['swapdims'],
+        list(spec['window_dims']), spec['sample'], width)
+    if os.path.exists(cached):
+        logger.debug(f'{spec["label"]} is {cached}')
+        with np.load(cached) as npz:
+            return spec['label'],npz['image']
+    window = read_window(thumbnail(spec['infile'], cache), spec['swapdims'], spec['window_dims'])
+    image = mosaic(window, spec['sample'], width)
+    store_entry(cached, lambda tmp: np.savez_compressed(tmp, image=image))
+    return spec['label'],image
+
+def write_pdf(manifest, processes=None):
+    '''
+    render the pages of a manifest in a process pool, and write them in order
+    into its multi-page PDF, each mosaic with its label on top
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    pages = [dict(page, swapdims=manifest['swapdims'], cache=manifest.get('cache')) for page in manifest['pages']]
+    # points are pixels at 72 dpi, so each mosaic pixel is drawn once
+    dpi = 72
+    label_height = 2 * POINTSIZE
+    tmp = manifest['out_pdf'] + '.tmp'
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool, PdfPages(tmp) as pdf:
+        font = manifest.get('font') or DEFAULT_FONT
+        family = [font] if font == DEFAULT_FONT else [font, DEFAULT_FONT]
+        for label,image in pool.map(render_page, pages):
+            height,width = image.shape
+            fig = plt.figure(figsize=(width / dpi, (height + label_height) / dpi), dpi=dpi, facecolor='white')
+            fig.figimage(image, xo=0, yo=0, cmap='gray', vmin=0, vmax=255, origin='upper')
+            fig.text(0, 1, label, fontsize=POINTSIZE, ha='left', va='top',
+                family=family)
+            pdf.savefig(fig, dpi=dpi)
+            plt.close(fig)
+            logger.debug(f'rendered {label}')
+    os.replace(tmp, manifest['out_pdf'])
+    logger.info(f'wrote {len(pages)} pages to {manifest["out_pdf"]}')
+
 # probably going to want to create a page factory that produces pages with 
 # certain hard-coded values, and others that can vary.
 class page(object):
     # this object holds all the info you need to run a slicer command and 
     #produce a single page in a QC PDF.
     def __init__(self,infile,slicer):
-        # to store the final outputs of a slicer command, 
-        # tableaus are themselves aggregates of many pngs
         self.infile = infile
-        self.tableau = None
         infile_basename = os.path.basename(self.infile)
         self.infile_basename = infile_basename.split('.')[0]
-        # this is a dict with keys size,sample,width
+        # this is a dict with keys window_dims,sample,width
         self.slicer = slicer
 
 class qc_pdf_maker(object):
@@ -57,10 +331,9 @@ class qc_pdf_maker(object):
         # pdf name set. Time to initialize script
         self.script = commons.ScriptBuilder(self.scriptname)
         self.script.blank_file() # make sure script is blank
-        for page in self.pages:
-            page.tableau = os.path.join(self.scratch,"tableau_sliced_{SPACE}_{PLANE}.png".format(SPACE=page.infile_basename,PLANE=self.plane))
-            self.slicer(page)
-        self.png_to_PDF()
+        manifest = self.write_manifest()
+        self.script.append(['python', os.path.join(self.conf.iproc.CODEDIR, 'runscript', 'qc_pdf.py'),
+                            '--manifest', manifest])
         self.final_cleanup(save_intermediates)
         job_spec = commons.JobSpec([self.scriptname],logfile_base,[self.out_pdf])
         return job_spec
@@ -80,49 +353,30 @@ class qc_pdf_maker(object):
             logger.debug('overwrite set to True or {} does not exist. RUNNING'.format(out_pdf))
             return True
 
-    def slicer(self,page):
-
-        sliced = os.path.join(self.scratch,"tile_sliced_{SPACE}_{PLANE}.png".format(SPACE=page.infile_basename,PLANE=self.plane))
-
-        # make swap nifti with plane-approptiate orientation
-        infile = page.infile #T1, e.g. mpr_reorient
-        tmpfile = os.path.join(self.scratch, '{}_fslreorient2std.nii.gz'.format(page.infile_basename))
-        fslreorient2std_cmd = ['fslreorient2std', infile, tmpfile]
-        self.script.append(fslreorient2std_cmd)
-        swap = os.path.join(self.scratch,"{SPACE}_swapped_{PLANE}.nii.gz".format(SPACE=page.infile_basename,PLANE=self.plane))
-        roi = os.path.join(self.scratch,"{SPACE}_roi_{PLANE}.nii.gz".format(SPACE=page.infile_basename,PLANE=self.plane))
-        swapdim_cmd = ['fslswapdim', tmpfile] + self.swapdims + [swap]
-        self.script.append(swapdim_cmd)
-        
-        # extract sub page of nifti 
-        window_dims = page.slicer['window_dims']
-        fslroi_cmd = ['fslroi', swap, roi] + window_dims
-        self.script.append(fslroi_cmd)
-
-        #slice the image and put slices together as tiles in a png image
-        sample = page.slicer['sample']
-        width = str(page.slicer['width']*180)
-        slicer_cmd = ['slicer', roi, '-u', '-S', sample, width, sliced]
-        self.script.append(slicer_cmd)
-
-        label = page.infile_basename+ '_'+ self.plane
-        # add label
+    def write_manifest(self):
+        # everything qc_pdf.py needs to render the pages, in scratch
         font = self.conf.get('iproc', 'font')
         if not font:
-            logger.info('no iproc.font in user config, trying Nimbus-Sans-Regular')
-            font = 'Nimbus-Sans-Regular'
-        append_cmd = ['convert', sliced, '-font', font, '-background', 'White', '-pointsize', '20',
-                    'label:{}'.format(label), '+swap', '-gravity', 'North-West',
-                    '-append', page.tableau]
-        
-        self.script.append(append_cmd)
-
-    def png_to_PDF(self):
-        # converts tableau png in page to pdf      
-        # sample usage: for page in pages: png_to_PDF(page,
-        tableau_files = [page.tableau for page in self.pages]
-        combine_png_cmd = ['convert', '-adjoin'] + tableau_files + [self.out_pdf]
-        self.script.append(combine_png_cmd)
+            logger.info('no iproc.font in user config, trying {}'.format(DEFAULT_FONT))
+            font = DEFAULT_FONT
+        manifest = {
+            'out_pdf': self.out_pdf,
+            'plane': self.plane,
+            'swapdims': self.swapdims,
+            'font': font,
+            'cache': self.scratch_home,
+            'pages': [{
+                'infile': page.infile,
+                'label': page.infile_basename + '_' + self.plane,
+                'window_dims': [int(dim) for dim in page.slicer['window_dims']],
+                'sample': int(page.slicer['sample']),
+                'width': int(page.slicer['width']),
+            } for page in self.pages]
+        }
+        fname = os.path.join(self.scratch, os.path.basename(self.out_pdf).replace('.pdf', '.json'))
+        with open(fname, 'w') as fo:
+            json.dump(manifest, fo, indent=2)
+        return fname
 
     def final_cleanup(self,save_intermediates):
         if save_intermediates:
@@ -0,0 +1,208 @@
+'''
+Nuisance regression of 4D data, in-process, the way 3dTproject -ort does it.
+
+The voxels inside the mask are read once into a (T,V) float32 matrix. The
+design is the Legendre polynomials up to POLORT (3dTproject's default
+-polort 2) next to the regressor columns, and what it spans is projected out
+of every voxel timeseries with one orthonormal basis from a pivoted QR, so
+that redundant columns (e.g. a censor column duplicated by a spike) do not
+matter. The projection is done on blocks of voxels to bound the size of the
+float64 temporaries, and the products are BLAS calls, threaded by
+OMP_NUM_THREADS. Voxels outside the mask are 0 in the output, like
+3dTproject.
+
+denoise() is the fused version of the nuisance_regress, bandpass and
+wholebrain_only_regress steps: the data is read once, and the nuisance
+residuals, their bandpassed version (3dBandpass 0.01 0.1) and the
+wholebrain-only residuals are all computed from that one read.
+'''
+import os
+import shutil
+import logging
+import tempfile
+import numpy as np
+import nibabel as nib
+import scipy.fft
+import scipy.linalg
+import iproc.codec as codec
+import iproc.nuisance as nuisance
+import iproc.warp as warp
+
+logger = logging.getLogger(__name__)
+
+# 3dTproject default
+POLORT = 2
+# voxels per block of the projection, T x VOXEL_CHUNK float64 temporaries
+VOXEL_CHUNK = 16384
+# passband (Hz) of the bandpass step, as in 3dBandpass 0.01 0.1
+BAND = (0.01, 0.1)
+
+def legendre(numvol, polort=POLORT):
+    ''' (T,polort+1) Legendre polynomials over the run, as in 3dTproject '''
+    return np.polynomial.legendre.legvander(np.linspace(-1, 1, numvol), polort)
+
+def design(ort, numvol, polort=POLORT):
+    '''
+    full design matrix
+    :param ort: (T,K) regressors, or None
+    '''
+    columns = [legendre(numvol, polort)]
+    if ort is not None and np.size(ort):
+        ort = np.asarray(ort, dtype=np.float64).reshape(numvol, -1)
+        columns.append(ort)
+    return np.hstack(columns)
+
+def read_ort(fname):
+    ''' regressor file, one row per volume, as (T,K). K can be 0, e.g. for a run without outliers '''
+    with open(fname) as fo:
+        rows = [line.split() for line in fo]
+    ort = np.array(rows, dtype=np.float64)
+    if ort.ndim != 2:
+        raise ValueError('rows of {} do not all have the same number of columns'.format(fname))
+    return ort
+
+def repetition_time(img):
+    ''' TR in seconds, from the NIfTI header '''
+    tr = float(img.header.get_zooms()[3])
+    units = img.header.get_xyzt_units()[1]
+    if units == 'msec':
+        tr /= 1000.0
+    elif units == 'usec':
+        tr /= 1e6
+    return tr
+
+def basis(X, rtol=1e-7):
+    ''' orthonormal basis of the column space of X '''
+    Q,R,_ = scipy.linalg.qr(X, mode='economic', pivoting=True)
+    diag = np.abs(np.diag(R))
+    rank = int(np.sum(diag > rtol * diag[0])) if diag.size else 0
+    if rank < X.shape[1]:
+        logger.info('design has {} columns, rank {}'.format(X.shape[1], rank))
+    return Q[:,:rank]
+
+def mask_indices(mask_fname, shape):
+    ''' flat (Fortran order) indices of the voxels inside a mask '''
+    mask = np.asanyarray(nib.load(mask_fname).dataobj)
+    if mask.shape[:3] != tuple(shape[:3]):
+        raise ValueError('mask {} is {}, data is {}'.format(mask_fname, mask.shape[:3], tuple(shape[:3])))
+    return np.flatnonzero(mask.reshape(-1, order='F') > 0)
+
+def load_masked(fname, voxels, chunk=nuisance.CHUNK):
+    ''' (T,V) float32 matrix of the voxels of a 4D image, in one read '''
+    img = nib.load(fname)
+    numvol = img.shape[3] if img.ndim > 3 else 1
+    Y = np.empty((numvol, voxels.size), dtype=np.float32)
+    for start,data in nuisance.iter_volumes(fname, chunk):
+        Y[start:start + data.shape[1]] = data[voxels].T
+    return Y
+
+def project_out(Y, Q, chunk=VOXEL_CHUNK):
+    ''' in place, Y - Q Q'Y, on blocks of voxels '''
+    for start in range(0, Y.shape[1], chunk):
+        block = Y[:,start:start + chunk].astype(np.float64)
+        block -= Q @ (Q.T @ block)
+        Y[:,start:start + chunk] = block
+    return Y
+
+def bandpass(Y, tr, band=BAND, chunk=VOXEL_CHUNK, threads=None):
+    '''
+    in place, keep only the frequencies of Y (T,V) within band, on blocks of
+    voxels. Like 3dBandpass, the timeseries are zero-padded to an even, FFT
+    friendly length and every frequency outside the band is zeroed. The
+    quadratic trend that 3dBandpass removes first is already gone from
+    residuals of a design with POLORT >= 2.
+    '''
+    numvol = Y.shape[0]
+    n = scipy.fft.next_fast_len(numvol, real=True)
+    while n % 2:
+        n = scipy.fft.next_fast_len(n + 1, real=True)
+    freqs = scipy.fft.rfftfreq(n, tr)
+    stop = (freqs < band[0]) | (freqs > band[1])
+    threads = threads or len(os.sched_getaffinity(0))
+    for start in range(0, Y.shape[1], chunk):
+        spectrum = scipy.fft.rfft(Y[:,start:start + chunk], n, axis=0, workers=threads)
+        spectrum[stop] = 0
+        Y[:,start:start + chunk] = scipy.fft.irfft(spectrum, n, axis=0, workers=threads)[:numvol]
+    return Y
+
+def write_masked(fname, ref_img, Y, voxels, scratch=None, chunk=nuisance.CHUNK):
+    '''
+    write a (T,V) matrix back into a float32 4D NIfTI on the grid of
+    ref_img, zero outside of voxels. The image is built uncompressed in
+    scratch, and compressed into fname if it ends in .gz.
+    '''
+    numvol = Y.shape[0]
+    nvox = int(np.prod(ref_img.shape[:3]))
+    tmpdir = tempfile.mkdtemp(dir=scratch)
+    try:
+        tmp = os.path.join(tmpdir, os.path.basename(fname).replace('.gz', ''))
+        out = warp.create_4d(tmp, ref_img, numvol)
+        flat = out.reshape((nvox, numvol), order='F')
+        for start in range(0, numvol, chunk):
+            block = np.zeros((nvox, min(chunk, numvol - start)), dtype=np.float32)
+            block[voxels] = Y[start:start + block.shape[1]].T
+            flat[:,start:start + block.shape[1]] = block
+        out.flush()
+        del out, flat
+        codec.store(tmp, fname)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def regress(in_fname, ort, mask_fname, out_fname, scratch=None, polort=POLORT):
+    '''
+    3dTproject -ort ort -input in_fname -mask mask_fname, written to
+    out_fname as float32 NIfTI.
+    :param ort: (T,K) regressors
+    '''
+    img = nib.load(in_fname)
+    numvol = img.shape[3] if img.ndim > 3 else 1
+    voxels = mask_indices(mask_fname, img.shape)
+    Q = basis(design(ort, numvol, polort))
+    Y = load_masked(in_fname, voxels)
+    logger.info('{} volumes, {} voxels, {} regressors'.format(numvol, voxels.size, Q.shape[1]))
+    project_out(Y, Q)
+    write_masked(out_fname, img, Y, voxels, scratch)
+
+def denoise(in_fname, mask_fname, ort, resid_out, bpss_out=None,
+            wb_mask=None, wb_ort=None, wbonly_out=None,
+            band=BAND, scratch=None, polort=POLORT):
+    '''
+    nuisance_regress, bandpass and wholebrain_only_regress, from one read of
+    in_fname. Each output is optional but resid_out.
+    :param ort: (T,K) nuisance regressors
+    :param wb_mask: mask of the whole-brain signal
+    :param wb_ort: (T,K) regressors to use next to the whole-brain signal
+    :returns: the whole-brain signal, or None
+    '''
+    img = nib.load(in_fname)
+    numvol = img.shape[3] if img.ndim > 3 else 1
+    brain = mask_indices(mask_fname, img.shape)
+    voxels = brain
+    if wbonly_out:
+        # the whole-brain mask need not be inside the brain mask
+        wb_voxels = mask_indices(wb_mask, img.shape)
+        voxels = np.union1d(brain, wb_voxels)
+    Y = load_masked(in_fname, voxels)
+    if voxels is not brain:
+        wb_ts = Y[:,np.searchsorted(voxels, wb_voxels)].mean(axis=1, dtype=np.float64)
+        Y = Y[:,np.searchsorted(voxels, brain)]
+    logger.info('{} volumes, {} voxels'.format(numvol, brain.size))
+
+    W = None
+    if wbonly_out:
+        W = Y.copy()
+    project_out(Y, basis(design(ort, numvol, polort)))
+    write_masked(resid_out, img, Y, brain, scratch)
+    logger.info('wrote {}'.format(resid_out))
+    if bpss_out:
+        bandpass(Y, repetition_time(img), band)
+        write_masked(bpss_out, img, Y, brain, scratch)
+        logger.info('wrote {}'.format(bpss_out))
+    del Y
+    if W is None:
+        return None
+    wb_design = np.column_stack([wb_ts] + ([wb_ort] if wb_ort is not None else []))
+    project_out(W, basis(design(wb_design, numvol, polort)))
+    write_masked(wbonly_out, img, W, brain, scratch)
+    logger.info('wrote {}'.format(wbonly_out))
+    return wb_ts
@@ -17,13 +17,17 @@ import csv
 import re
 import logging
 import glob
-import pickle
 import subprocess as sp
 import importlib
 import tempfile
 import datetime
 import collections
 import iproc.commons as commons
+import iproc.provenance as provenance
+import iproc.fsindex as fsindex
+import iproc.ledger as ledger
+import iproc.cleanup as cleanup
+import iproc.codec as codec
 from iproc.bids import sanitize,split_task
 from pathlib import Path
 
@@ -38,9 +42,17 @@ class jobConstructor(object):
         self.args = args
         # TODO: remove moribund function
         self.steplog_base = os.path.join(conf.iproc.LOGDIR,'stepLog')
-        self.rmfiles = {}
-        self.rm_dump_filename = os.path.join(self.conf.iproc.RMFILE_DUMP, f'{self.args.stage}.crash')
-        self.rm_final_filename = os.path.join(self.conf.iproc.RMFILE_DUMP, f'{self.args.stage}.final')
+        # intermediate files, and which step or stage deletes them
+        self.ledger = ledger.ArtifactLedger(os.path.join(conf.iproc.RMFILE_DUMP, 'artifacts.sqlite'))
+        # removes intermediates as soon as the last job to need them is done
+        self.collector = cleanup.Collector(os.path.join(conf.iproc.OUTDIR, conf.iproc.SUB),
+            quota=cleanup.parse_size(conf.get('iproc', 'QUOTA')),
+            remove=not (args.no_remove_files or args.dry_run))
+        self.provenance = provenance.Provenance(os.path.join(conf.iproc.LOGDIR, 'provenance'), conf)
+        # existence checks on outfiles come from directory listings
+        self.fsindex = fsindex.FileIndex()
+        # outfiles of the jobs that will run, anything made from them is out of date
+        self.pending_outfiles = set()
 
     def reset_steplog(self):
         # TODO: remove moribund function
@@ -61,7 +73,7 @@ class jobConstructor(object):
                 logger.info(f'processing sub={sub}, ses={ses}, anat={run}')
                 basename = f'ses-{sanitize(ses)}/anat/sub-{sanitize(sub)}_ses-{sanitize(ses)}_run-{run}_T1w.nii.gz'
                 bids_anat_file = os.path.join(self.args.bids, basename)
-                if not os.path.exists(bids_anat_file):
+                if not self.args.bids_layout.exists(bids_anat_file):
                     raise IOError(f'{bids_anat_file} does not exist.')
                 #scan_no is set automatically by self.scans.anats()
                 run_zpad = f'{int(self.scans.scan_no):03d}'  # note that this is the ScanNumber, not the BIDS run number
@@ -92,7 +104,11 @@ class jobConstructor(object):
                 ]
                 logger.info(sp.list2cmdline(cmd))
                 logfile_base = self._io_file_fmt(cmd)
-                job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                job_spec = JobSpec(cmd,logfile_base,outfiles)
+                job_spec.ingest = {'kind': 'anat', 'name': anat_basename, 'session': ses,
+                                   'input': bids_anat_file, 'raw_output': dest_nii,
+                                   'reorient_output': dest_reorient_nii}
+                job_spec_list.append(job_spec)
         self.scans.reset_default_sessionid()
         return job_spec_list
 
@@ -119,6 +135,8 @@ class jobConstructor(object):
 
                     basename = f'ses-{sanitize(ses)}/func/sub-{sanitize(sub)}_ses-{sanitize(ses)}_task-{bids_task_name}_run-{run}_bold.nii.gz'
                     bids_func_file = os.path.join(self.args.bids, basename)
+                    if not self.args.bids_layout.exists(bids_func_file):
+                        raise IOError(f'{bids_func_file} does not exist.')
                     run_zpad = f'{int(bold_scan["BLD"]):03d}'
 
                     task_dirname = os.path.join(self.conf.iproc.NATDIR, ses, f'{task_name}_{run_zpad}')
@@ -128,16 +146,7 @@ class jobConstructor(object):
                     sec_base = os.path.join(task_dirname, sec_basename)
 
                     outfiles = [dest_nii,sec_base+'_echoTime.sec',sec_base+'_dwellTime.sec']
-                    if self._outfiles_skip(overwrite,outfiles):
-                        continue
-                    #elif not self.args.no_remove_files:
-                    #    for outfile in outfiles:
-                    #        os.remove(outfile) 
-                    #        logging.debug(f'removed {outfile}')
                     work_dirname = os.path.join(self.conf.iproc.WORKDIR, f'{task_name}_{ses}')
-                    for d in [work_dirname, task_dirname]:
-                        if not os.path.exists(d):
-                            os.makedirs(d)
                     script = os.path.join(os.path.expanduser(self.conf.iproc.CODEDIR), 'runscript', 'func_from_bids.py')
                     cmd = [
                         script,
@@ -149,8 +158,21 @@ class jobConstructor(object):
                         '--work-dir', work_dirname,
                         '--num-echos', numechos
                     ]
+                    if self._outfiles_skip(overwrite,outfiles,cmd):
+                        continue
+                    #elif not self.args.no_remove_files:
+                    #    for outfile in outfiles:
+                    #        os.remove(outfile) 
+                    #        logging.debug(f'removed {outfile}')
+                    for d in [work_dirname, task_dirname]:
+                        if not os.path.exists(d):
+                            os.makedirs(d)
                     logfile_base = self._io_file_fmt(cmd)
-                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                    job_spec = JobSpec(cmd,logfile_base,outfiles)
+                    job_spec.ingest = {'kind': 'func', 'name': os.path.basename(bids_func_file), 'session': ses,
+                                       'input': bids_func_file, 'output': dest_nii, 'sec_base': sec_base,
+                                       'skip': task['SKIP'], 'numvol': task['NUMVOL'], 'numechos': numechos}
+                    job_spec_list.append(job_spec)
                     ### added num-echos flag for multi-echo, JS 2025.03.19 
 
 
@@ -159,6 +181,8 @@ class jobConstructor(object):
                     for iEcho in range(1,int(numechos) + 1):
                         basename = f'ses-{sanitize(ses)}/func/sub-{sanitize(sub)}_ses-{sanitize(ses)}_task-{bids_task_name}_run-{run}_echo-{iEcho}_bold.nii.gz'
                         bids_func_file = os.path.join(self.args.bids, basename)
+                        if not self.args.bids_layout.exists(bids_func_file):
+                            raise IOError(f'{bids_func_file} does not exist.')
                         run_zpad = f'{int(bold_scan["BLD"]):03d}'
 
                         task_dirname = os.path.join(self.conf.iproc.NATDIR, ses, f'{task_name}_{run_zpad}')
@@ -168,16 +192,7 @@ class jobConstructor(object):
                         sec_base = os.path.join(task_dirname, sec_basename)
 
                         outfiles = [dest_nii,sec_base+f'_echoTime_e{iEcho}.sec',sec_base+f'_dwellTime_e{iEcho}.sec']
-                        if self._outfiles_skip(overwrite,outfiles):
-                            continue
-                        #elif not self.args.no_remove_files:
-                        #    for outfile in outfiles:
-                        #        os.remove(outfile) 
-                        #        logging.debug(f'removed {outfile}')
                         work_dirname = os.path.join(self.conf.iproc.WORKDIR, f'{task_name}_{ses}')
-                        for d in [work_dirname, task_dirname]:
-                            if not os.path.exists(d):
-                                os.makedirs(d)
                         script = os.path.join(os.path.expanduser(self.conf.iproc.CODEDIR), 'runscript', 'func_from_bids.py')
                         cmd = [
                             script,
@@ -189,8 +204,21 @@ class jobConstructor(object):
                             '--work-dir', work_dirname,
                             '--num-echos', numechos
                         ]
+                        if self._outfiles_skip(overwrite,outfiles,cmd):
+                            continue
+                        #elif not self.args.no_remove_files:
+                        #    for outfile in outfiles:
+                        #        os.remove(outfile) 
+                        #        logging.debug(f'removed {outfile}')
+                        for d in [work_dirname, task_dirname]:
+                            if not os.path.exists(d):
+                                os.makedirs(d)
                         logfile_base = self._io_file_fmt(cmd)
-                        job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                        job_spec = JobSpec(cmd,logfile_base,outfiles)
+                        job_spec.ingest = {'kind': 'func', 'name': os.path.basename(bids_func_file), 'session': ses,
+                                           'input': bids_func_file, 'output': dest_nii, 'sec_base': sec_base,
+                                           'skip': task['SKIP'], 'numvol': task['NUMVOL'], 'numechos': numechos}
+                        job_spec_list.append(job_spec)
 
                 
         self.scans.reset_default_sessionid()
@@ -215,9 +243,6 @@ class jobConstructor(object):
                 outfiles = [f'{dest_fieldmap_nii}.nii.gz']
                 mask_copy_nii = f'{fmap_full_dirname}/{sessionid}_{fmap1_no_pad}_mag_img_brain_mask.nii.gz'
 
-                if self._outfiles_skip(overwrite,outfiles):
-                    continue
-
                 # find the files we need in BIDS directory
                 if preptool == 'topup':
                     input1_bids_fname = fmap_scans['FIRST_BIDS_FNAME']
@@ -232,11 +257,11 @@ class jobConstructor(object):
                     dest_fmap2_nii = os.path.join(fmap_full_dirname, 'fmap2_img.nii.gz')
 
                     ## 2025.03.05: added from LD for bids integration 
-                    input1_series_number = commons.get_json_entity(input1_json_fname, 'SeriesNumber')
-                    input2_series_number = commons.get_json_entity(input2_json_fname, 'SeriesNumber')
+                    input1_series_number = self.args.bids_layout.get_json_entity(input1_json_fname, 'SeriesNumber')
+                    input2_series_number = self.args.bids_layout.get_json_entity(input2_json_fname, 'SeriesNumber')
                     ## 
 
-                    totalReadoutTime1 = commons.get_json_entity(input1_json_fname,'TotalReadoutTime')
+                    totalReadoutTime1 = self.args.bids_layout.get_json_entity(input1_json_fname,'TotalReadoutTime')
                     totalReadoutTime2 = totalReadoutTime1 #commons.get_json_entity(input1_json_fname)
                     if totalReadoutTime1 != totalReadoutTime2:
                         raise ValueError(f'{totalReadoutTime1} != {totalReadoutTime2}. TotalReadoutTime from {input1_json_fname} does not match {input2_json_fname}')
@@ -276,17 +301,51 @@ class jobConstructor(object):
                     logger.info(f'fmapp file is {bids_fmapp_file}')
                 else:
                     raise Exception(f'unknown preptool {preptool}')
+                if self._outfiles_skip(overwrite,outfiles,cmd):
+                    continue
                 # create output directory
                 if not os.path.exists(fmap_full_dirname):
                     os.makedirs(fmap_full_dirname)
 
                 logger.info(sp.list2cmdline(cmd))
                 logfile_base = self._io_file_fmt(cmd)
-                job_spec_list.append(JobSpec(cmd,logfile_base, outfiles))
+                job_spec = JobSpec(cmd,logfile_base, outfiles)
+                job_spec.ingest = {'kind': 'command', 'name': fmap_dirname, 'session': ses, 'cmd': cmd}
+                job_spec_list.append(job_spec)
 
         self.scans.reset_default_sessionid()
         return job_spec_list
 
+    def ingest_from_bids_batched(self, overwrite=True, per='session'):
+        '''
+        the jobs of fmap_from_bids, anat_from_bids and func_from_bids, as one
+        runscript/ingest_from_bids.py job per session (or one for the subject),
+        that ingests all their images in one process
+        '''
+        jobs = self.fmap_from_bids(overwrite) + self.anat_from_bids(overwrite) + self.func_from_bids(overwrite)
+        groups = collections.OrderedDict()
+        for job in jobs:
+            key = job.ingest['session'] if per == 'session' else None
+            groups.setdefault(key, []).append(job)
+        script = os.path.join(self.conf.iproc.CODEDIR, 'runscript', 'ingest_from_bids.py')
+        job_spec_list = []
+        for sessionid,group in groups.items():
+            name = f'{self.conf.iproc.SUB}_{sessionid}' if sessionid else self.conf.iproc.SUB
+            base = os.path.join(self.conf.iproc.LOGDIR, f'{name}_ingest_from_bids')
+            items = [dict(job.ingest, outfiles=job.outfiles) for job in group]
+            cmd = [script,
+                   '--manifest', f'{base}.json',
+                   '--status', f'{base}_status.json',
+                   '--scratch', os.path.join(self.conf.iproc.WORKDIR, 'ingest')]
+            logger.info(f'{name}: {len(items)} images in one job')
+            outfiles = [f for job in group for f in job.outfiles]
+            job_spec = JobSpec(cmd, base, outfiles)
+            job_spec.manifests[f'{base}.json'] = {'items': items}
+            # the status of an earlier run is not the status of this one
+            job_spec.manifests[f'{base}_status.json'] = None
+            job_spec_list.append(job_spec)
+        return job_spec_list
+
     def xnat_to_nii_gz_anat(self, overwrite=True):
         stepname_base = 'xnat_to_nii_gz_anat'
         logger.debug(stepname_base)
@@ -431,24 +490,12 @@ class jobConstructor(object):
                     file_name = sessionid + '_bld' + bold_no + '_reorient_skip'
                     outnii=os.path.join(file_dir, file_name)
                     outfiles_echo = [outnii]
-                    if self._outfiles_skip(overwrite, outfiles_ext):
-                        continue
-                else: #SINGLE ECHO
-                    if self._outfiles_skip(overwrite, outfiles_ext):
-                        continue
 
                 work_name = task_dirname + "_" + sessionid
                 workdir = os.path.join(self.conf.iproc.WORKDIR, work_name)
                 task = self.scans.task_dict[task_type]
                 SKIP = task['SKIP']
                 NUMVOL = task['NUMVOL']
-                
-                
-                if not os.path.exists(workdir):
-                    os.makedirs(workdir)
-
-                if not os.path.exists(file_dir):
-                    os.makedirs(file_dir)
 
                 cmd=[os.path.join(self.conf.iproc.CODEDIR, 'runscript', 'xnat_to_nii_gz_task.sh'),
                         workdir,
@@ -463,6 +510,15 @@ class jobConstructor(object):
                         NUMECHOS,
                         self.conf.iproc.QDIR]
 
+                if self._outfiles_skip(overwrite, outfiles_ext, cmd):
+                    continue
+                
+                if not os.path.exists(workdir):
+                    os.makedirs(workdir)
+
+                if not os.path.exists(file_dir):
+                    os.makedirs(file_dir)
+
                 logfile_base = self._io_file_fmt(cmd)
                 job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
         self.scans.reset_default_sessionid()
@@ -1128,9 +1184,9 @@ class jobConstructor(object):
     
     def combine_warps_parallel(self, anat_space, overwrite=True):
         # this combines and applies warps across all slices of the BOLD data,
-        # moving it, one time point at a time, into an output volume space.
-        # The individual-time-point volumes are not moved into the corresponding
-        # out volume directory until the next step, as they are intermediates.
+        # moving it, one time point at a time, into a single 4D file in an
+        # output volume space. The 4D file is not moved into the corresponding
+        # out volume directory until the next step, as it is an intermediate.
         logger.debug('combine_warps_parallel') 
     
         job_spec_list = []
@@ -1159,10 +1215,8 @@ class jobConstructor(object):
                     outputdir = os.path.join(self.conf.iproc.NATDIR, sessionid, task_dirname)
                     
                     mat_dir = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_mc.mat')
-                    volnums = [ str(n) for n in range(int(numvol)) ]
-                    out_file_names = [ f'{outfile_base}_{n.zfill(4)}.nii.gz' for n in volnums ]
                     bld_dir = f'{bold_no}_{anat_space}'
-                    outfiles = [ os.path.join(outputdir, bld_dir, f) for f in out_file_names ]
+                    outfiles = [ os.path.join(outputdir, bld_dir, codec.intermediate(outfile_base)) ]
         
                     split_in = os.path.join(outputdir, f'{sessionid}_bld{bold_no}_reorient_skip.nii.gz')
                     rmfiles = self._get_rmfiles('combine_warps_parallel')
@@ -1221,17 +1275,14 @@ class jobConstructor(object):
                 else: 
                     print('***** MULTI-ECHO steps.combine_warps_parallel*****')
                     pyscript = os.path.join(self.conf.iproc.CODEDIR,'iProc_p4_sbatch_combined_ME.py')
-                    
-                    volnums = [str(n) for n in range(int(numvol))]
 
                     for thisecho in range(1,int(numechos) + 1):
                         task_dirname  = f'{task_type}_{bold_no}'
                         outputdir = os.path.join(self.conf.iproc.NATDIR, sessionid, task_dirname)
                         mat_dir = os.path.join(outputdir,f"{sessionid}_bld{bold_no}_reorient_skip_mc_e1.mat")
 
-                        out_file_names = [ f'{outfile_base}_{n.zfill(4)}.nii.gz' for n in volnums ]
                         bld_dir = f'{bold_no}_{anat_space}_e{thisecho}'
-                        outfiles = [ os.path.join(outputdir, bld_dir, f) for f in out_file_names ]
+                        outfiles = [ os.path.join(outputdir, bld_dir, codec.intermediate(outfile_base)) ]
             
                         split_in = os.path.join(outputdir, f'{sessionid}_bld{bold_no}_reorient_skip_e{str(thisecho)}.nii.gz')
                         rmfiles = self._get_rmfiles('combine_warps_parallel')
@@ -1292,8 +1343,8 @@ class jobConstructor(object):
         return job_spec_list    
     
     def combine_warps_post(self, overwrite=True):
-        # this combines the individual-time-point volumes created by 
-        #combine_warps_parallel, and places the resulting volume in the
+        # this reorients and masks the 4D volume created by
+        # combine_warps_parallel, and places the result in the
         # output volume space directory for NAT222 or NAT111
         logger.debug('combine_warps_post') 
 
@@ -1327,14 +1378,10 @@ class jobConstructor(object):
                     indir = os.path.join(self.conf.iproc.NATDIR, sessionid, task_dirname)
                     bld_dir = f'{bold_no}_T1'
                     targ_warp_files = os.path.join(indir,bld_dir, "T1_TARG_WARP_")
-                    merge_in = os.path.join(indir,bld_dir,"T1_TARG_FILE_")
-                    targfile_glob = merge_in + '*' 
+                    merge_in = os.path.join(indir,bld_dir,codec.intermediate('T1_TARG_FILE'))
                     targwarp_glob = targ_warp_files + '*'
-                    rmfiles += [targwarp_glob,targfile_glob]
+                    rmfiles += [targwarp_glob,merge_in]
 
-                        
-                    merge_out = os.path.join(outputdir,f"{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_tmp.nii.gz")
-                    rmfiles.append(merge_out)
                     reorient_out = os.path.join(outputdir,f"{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat.nii.gz")
                     dilmask = os.path.join(self.conf.template.TEMPLATE_DIR,"mpr_reorient_brain_mask_dil10.nii.gz")
                     mean_out = os.path.join(outputdir, f"{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mean.nii.gz")
@@ -1350,7 +1397,6 @@ class jobConstructor(object):
                     cmd = [
                         os.path.join(self.conf.iproc.CODEDIR, 'runscript/combine_warps_post.sh'),
                         merge_in,
-                        merge_out,
                         numvol,
                         reorient_out,
                         dilmask,
@@ -1383,14 +1429,10 @@ class jobConstructor(object):
                         indir = os.path.join(self.conf.iproc.NATDIR, sessionid, task_dirname)
                         bld_dir = f'{bold_no}_T1_e{thisecho}'
                         targ_warp_files = os.path.join(indir,bld_dir, "T1_TARG_WARP_")
-                        merge_in = os.path.join(indir,bld_dir,"T1_TARG_FILE_")
-                        targfile_glob = merge_in + '*' 
+                        merge_in = os.path.join(indir,bld_dir,codec.intermediate('T1_TARG_FILE'))
                         targwarp_glob = targ_warp_files + '*'
-                        rmfiles += [targwarp_glob,targfile_glob]
+                        rmfiles += [targwarp_glob,merge_in]
 
-                            
-                        merge_out = os.path.join(outputdir,f"{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_tmp_e{thisecho}.nii.gz") 
-                        rmfiles.append(merge_out)
                         reorient_out = os.path.join(outputdir,f"{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_e{thisecho}.nii.gz")
                         dilmask = os.path.join(self.conf.template.TEMPLATE_DIR,f'mpr_reorient_brain_mask_dil10.nii.gz')
                         mean_out = os.path.join(outputdir, f"{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mean_e{thisecho}.nii.gz")
@@ -1406,7 +1448,6 @@ class jobConstructor(object):
                         cmd = [
                             os.path.join(self.conf.iproc.CODEDIR, 'runscript/combine_warps_post.sh'),
                             merge_in,
-                            merge_out,
                             numvol,
                             reorient_out,
                             dilmask,
@@ -1433,8 +1474,8 @@ class jobConstructor(object):
         return job_spec_list    
 
     def combine_warps_post_MNI(self, overwrite=True):
-        # this combines the individual-time-point volumes created by 
-        #combine_warps_parallel, and places the resulting volume in the
+        # this masks the 4D volume created by combine_warps_parallel,
+        # and places the result in the
         # output volume space directory for MNI222 or MNI111
         logger.debug('combine_warps_post_MNI') 
  
@@ -1462,11 +1503,10 @@ class jobConstructor(object):
                         os.makedirs(outputdir)
                     indir = os.path.join(self.conf.iproc.NATDIR, sessionid, task_dirname)
                     bld_dir = f'{bold_no}_MNI'
-                    merge_in = os.path.join(indir,bld_dir,"MNI_TARG_FILE_")
+                    merge_in = os.path.join(indir,bld_dir,codec.intermediate('MNI_TARG_FILE'))
                     targ_warp_files = os.path.join(indir,bld_dir, "MNI_TARG_WARP_")
-                    targfile_glob = merge_in + '*' 
                     targwarp_glob = targ_warp_files + '*'
-                    rmfiles += [targwarp_glob,targfile_glob]
+                    rmfiles += [targwarp_glob,merge_in]
                     dilmask = os.path.join(self.conf.template.TEMPLATE_DIR,"anat_mni_underlay_brain_mask_dil10.nii.gz")
                     midvol_num = str(int(numvol)//2)
                     midvol_pad = midvol_num.zfill(3)
@@ -1519,11 +1559,10 @@ class jobConstructor(object):
 
                         indir = os.path.join(self.conf.iproc.NATDIR, sessionid, task_dirname)
                         bld_dir = f'{bold_no}_MNI_e{thisecho}'
-                        merge_in = os.path.join(indir,bld_dir,"MNI_TARG_FILE_")
+                        merge_in = os.path.join(indir,bld_dir,codec.intermediate('MNI_TARG_FILE'))
                         targ_warp_files = os.path.join(indir,bld_dir, "MNI_TARG_WARP_")
-                        targfile_glob = merge_in + '*' 
                         targwarp_glob = targ_warp_files + '*'
-                        rmfiles += [targwarp_glob,targfile_glob]
+                        rmfiles += [targwarp_glob,merge_in]
                         dilmask = os.path.join(self.conf.template.TEMPLATE_DIR,f'anat_mni_underlay_brain_mask_dil10.nii.gz')
                         midvol_num = str(int(numvol)//2)
                         midvol_pad = midvol_num.zfill(3)
@@ -1573,6 +1612,8 @@ class jobConstructor(object):
     
         self.reset_steplog()
         job_spec_list = []
+        # with --batch-nuisance, every run goes into one job for the subject
+        batch_runs = []
         subjid=self.conf.iproc.SUB
         FD_LABEL = self.conf.template.FD_LABEL
 
@@ -1606,6 +1647,11 @@ class jobConstructor(object):
                     outfiles = [nuis_out]
                     if self._outfiles_skip(overwrite,outfiles):
                         continue
+                    if self.args.batch_nuisance:
+                        batch_runs.append(dict(resid_in=resid_in, csf_mask=csf_mask, wm_mask=wm_mask, wb_mask=wb_mask,
+                            csf_ts=csf_ts, wm_ts=wm_ts, wb_ts=wb_ts, phys_ts=phys_ts, mc_ts=mc_ts, nuis_ts=nuis_ts,
+                            mcout_ts=mcout_ts, nuis_out_nocensor=nuis_out_nocensor, nuis_out=nuis_out))
+                        continue
         
                     cmd=[os.path.join(self.conf.iproc.CODEDIR,'runscript','calculate_nuisance_params.sh'),
                         resid_in,
@@ -1626,7 +1672,7 @@ class jobConstructor(object):
                         codedir]
         
                     logfile_base = self._io_file_fmt(cmd)
-                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,run=self._run_key()))
 
                 else:
                     print('***** MULTI-ECHO steps.calculate_nuisance_params*****')
@@ -1650,6 +1696,11 @@ class jobConstructor(object):
                     outfiles = [nuis_out]
                     if self._outfiles_skip(overwrite,outfiles):
                         continue
+                    if self.args.batch_nuisance:
+                        batch_runs.append(dict(resid_in=resid_in, csf_mask=csf_mask, wm_mask=wm_mask, wb_mask=wb_mask,
+                            csf_ts=csf_ts, wm_ts=wm_ts, wb_ts=wb_ts, phys_ts=phys_ts, mc_ts=mc_ts, nuis_ts=nuis_ts,
+                            mcout_ts=mcout_ts, nuis_out_nocensor=nuis_out_nocensor, nuis_out=nuis_out))
+                        continue
         
                     cmd=[os.path.join(self.conf.iproc.CODEDIR,'runscript','calculate_nuisance_params.sh'),
                         resid_in,
@@ -1666,11 +1717,22 @@ class jobConstructor(object):
                         nuis_out,
                         outputdir,
                         mcout_ts,
-                        nuis_out_nocensor]
+                        nuis_out_nocensor,
+                        os.path.expanduser(self.conf.iproc.CODEDIR)]
         
                     logfile_base = self._io_file_fmt(cmd)
-                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,run=self._run_key()))
         self.scans.reset_default_sessionid()
+        if batch_runs:
+            manifest = os.path.join(self.conf.iproc.LOGDIR, f'{subjid}_calculate_nuisance_params_manifest.json')
+            cmd = [os.path.join(os.path.expanduser(self.conf.iproc.CODEDIR), 'runscript', 'calculate_nuisance_params.py'),
+                '--manifest',
+                manifest]
+            logfile_base = self._io_file_fmt(cmd)
+            # not tied to a run, so dependent steps wait on all of it
+            job_spec = JobSpec(cmd,logfile_base,[run['nuis_out'] for run in batch_runs])
+            job_spec.manifests[manifest] = batch_runs
+            job_spec_list.append(job_spec)
         return job_spec_list 
     
     def calculate_wholebrain_only(self, overwrite=True):
@@ -1703,20 +1765,17 @@ class jobConstructor(object):
                         resid_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mni_resid'
                         fullpath_resid_out = os.path.join(outputdir,resid_out)
                         mask = os.path.join(self.conf.template.TEMPLATE_DIR,"anat_mni_underlay_brain_mask.nii.gz")
-                        resid_outs = [f'{fullpath_resid_out}+tlrc.HEAD', f'{fullpath_resid_out}+tlrc.BRIK']
                     elif anat_space in ('NAT222','NAT111'): 
                         outputdir = nat_resamp_dir
                         resid_in = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat.nii.gz')
                         resid_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_resid'
                         fullpath_resid_out = os.path.join(outputdir,resid_out)
                         mask = os.path.join(self.conf.template.TEMPLATE_DIR,'mpr_reorient_brain_mask.nii.gz')
-                        resid_outs = [f'{fullpath_resid_out}+orig.HEAD', f'{fullpath_resid_out}+orig.BRIK']
-
                     else:
                         raise NotImplementedError('anat_space parameter to nuisance_regress() must be T1 or MNI')
                     if not os.path.exists(outputdir):
                         os.makedirs(outputdir) 
-                    outfiles = resid_outs + [nuis_out]
+                    outfiles = [f'{fullpath_resid_out}.nii.gz', nuis_out]
                     if self._outfiles_skip(overwrite,outfiles):
                         continue
         
@@ -1730,7 +1789,7 @@ class jobConstructor(object):
                         self.conf.iproc.SCRATCHDIR]
         
                     logfile_base = self._io_file_fmt(cmd)
-                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,run=self._run_key()))
 
         self.scans.reset_default_sessionid()
         return job_spec_list 
@@ -1802,12 +1861,87 @@ class jobConstructor(object):
                        
                         
                     logfile_base = self._io_file_fmt(cmd)
-                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,run=self._run_key()))
 
         self.scans.reset_default_sessionid()
         return job_spec_list 
      
-    def bandpass(self,anat_space, overwrite=True):
+    def denoise(self,anat_space, overwrite=True):
+        # nuisance_regress, bandpass and wholebrain_only_regress in one job,
+        #which reads the data once and writes all three outputs.
+
+        #### -------- ONLY RUNNNG FOR SINGLE ECHO! ------- ####
+
+        logger.debug('denoise') 
+    
+        self.reset_steplog()
+        job_spec_list = []
+        FD_LABEL = self.conf.template.FD_LABEL
+        for sessionid,sess in self.scans.sessions():
+            for task_type,bold_scan in self.scans.tasks():
+                scan_no = bold_scan['BLD']
+                bold_no = f'{int(scan_no):03d}'
+                task_dirname  = f'{task_type}_{bold_no}'
+                numechos = self.scans.task_dict[task_type]['NUMECHOS']
+
+                if int(numechos) != 1:
+                    continue
+
+                natdir = os.path.join(self.conf.iproc.NATDIR, sessionid, task_dirname)
+                nat_resamp_dir = os.path.join(self.conf.iproc.NAT_RESAMP_DIR, sessionid, task_dirname)
+                nuis_out = os.path.join(nat_resamp_dir,f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_nuis.dat')
+                mcout_ts = os.path.join(natdir,f'{sessionid}_bld{bold_no}_reorient_skip_FD{FD_LABEL}_outlier_matrix.dat')
+                if anat_space in ('MNI222','MNI111'): 
+                    outputdir = os.path.join(self.conf.iproc.MNI_RESAMP_DIR, sessionid, task_dirname)
+                    resid_in = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mni.nii.gz')
+                    resid_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mni_resid'
+                    wb_ts = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_wb_ts.dat')
+                    wbmc_ts = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_wb_ts_mcoutlier.dat')
+                    wb_mask = os.path.join(self.conf.template.TEMPLATE_DIR,'mni_masks','wm_mask_1mm.nii.gz')
+                    wbonly_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mni_wbonly'
+                    mask = os.path.join(self.conf.template.TEMPLATE_DIR,'anat_mni_underlay_brain_mask.nii.gz')
+                elif anat_space in ('NAT222','NAT111'): 
+                    outputdir = nat_resamp_dir
+                    resid_in = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat.nii.gz')
+                    resid_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_resid'
+                    wb_ts = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_mni_wb_ts.dat')
+                    wbmc_ts = os.path.join(outputdir,f'{sessionid}_bld{bold_no}_reorient_skip_wb_ts_mcoutlier.dat')
+                    wb_mask = os.path.join(self.conf.template.TEMPLATE_DIR,'mni_masks','wb_mask_mpr_reorient.nii.gz')
+                    wbonly_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_wbonly'
+                    mask = os.path.join(self.conf.template.TEMPLATE_DIR,'mpr_reorient_brain_mask.nii.gz')
+                else:
+                    raise NotImplementedError('anat_space parameter to denoise() must be NAT111, NAT222, MNI111, or MNI222')
+                if not os.path.exists(outputdir):
+                    os.makedirs(outputdir) 
+                bpss_out = f'{resid_out}_bpss'
+                # the same outputs as the three steps it stands in for
+                outfiles = [os.path.join(outputdir,f'{f}.nii.gz') for f in (resid_out, bpss_out, wbonly_out)]
+                if self._outfiles_skip(overwrite,outfiles):
+                    continue
+
+                cmd=[os.path.join(self.conf.iproc.CODEDIR,'runscript','denoise.sbatch'),
+                    resid_in,
+                    nuis_out,
+                    mask,
+                    resid_out,
+                    bpss_out,
+                    wb_mask,
+                    mcout_ts,
+                    wb_ts,
+                    wbmc_ts,
+                    wbonly_out,
+                    outputdir,
+                    self.conf.iproc.CODEDIR,
+                    self.conf.iproc.SCRATCHDIR]
+
+                logfile_base = self._io_file_fmt(cmd)
+                job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,run=self._run_key()))
+
+        self.scans.reset_default_sessionid()
+        return job_spec_list 
+
+    def bandpass(self,anat_space, overwrite=True, multi_echo_only=False):
+        # with multi_echo_only, single-echo runs are left to denoise()
         logger.debug('bandpass') 
     
         job_spec_list = []
@@ -1821,16 +1955,18 @@ class jobConstructor(object):
                 numechos=self.scans.task_dict[task_type]['NUMECHOS']
 
                 if int(numechos) == 1:
+                    if multi_echo_only:
+                        continue
 
                     print('***** SINGLE-ECHO steps.bandpass*****')
                     if anat_space in ('MNI222','MNI111'): 
                         outputdir = os.path.join(self.conf.iproc.MNI_RESAMP_DIR, sessionid, task_dirname)
-                        resid_out = os.path.join(outputdir, f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mni_resid+tlrc')
+                        resid_out = os.path.join(outputdir, f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mni_resid.nii.gz')
                         bpss_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_mni_resid_bpss'
                         mask = os.path.join(self.conf.template.TEMPLATE_DIR, 'anat_mni_underlay_brain_mask.nii.gz')
                     elif anat_space in ('NAT222','NAT111'): 
                         outputdir = os.path.join(self.conf.iproc.NAT_RESAMP_DIR, sessionid, task_dirname)
-                        resid_out = os.path.join(outputdir, f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_resid+orig')
+                        resid_out = os.path.join(outputdir, f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_resid.nii.gz')
                         bpss_out = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat_resid_bpss'
                         mask = os.path.join(self.conf.template.TEMPLATE_DIR, 'mpr_reorient_brain_mask.nii.gz')
                     else:
@@ -1841,7 +1977,7 @@ class jobConstructor(object):
                     if self._outfiles_skip(overwrite,outfiles):
                         continue
 
-                    rmfiles = [f'{resid_out}.{x}' for x in ['BRIK', 'HEAD']]
+                    # the residuals are kept, fs6_project_to_surface projects them too
 
                     # unlike most other scripts here, this one will fail instead of overwrite existing files
                     # right now this is handled in runscript/bandpass.sbatch, but 
@@ -1858,9 +1994,7 @@ class jobConstructor(object):
                         self.conf.iproc.SCRATCHDIR]
         
                     logfile_base = self._io_file_fmt(cmd)
-                    if not self.args.no_remove_files:
-                        cmd.append(" ".join(rmfiles))
-                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,rmfiles))
+                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,run=self._run_key()))
 
                 else:
 
@@ -1908,7 +2042,7 @@ class jobConstructor(object):
                     logfile_base = self._io_file_fmt(cmd)
                     if not self.args.no_remove_files:
                         cmd.append(" ".join(rmfiles))
-                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,rmfiles))
+                    job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,rmfiles,run=self._run_key()))
         self.scans.reset_default_sessionid()
         return job_spec_list 
     
@@ -1930,6 +2064,8 @@ class jobConstructor(object):
 
         sesst = self.conf.T1.T1_SESS
         subjid = self.conf.iproc.SUB
+        # volume to fsaverage6 sampling weights, shared by all runs on the same grid
+        cache_dir = os.path.join(self.conf.iproc.FS6DIR, 'sampling')
         for sessionid,sess in self.scans.sessions():
             for task_type,bold_scan in self.scans.tasks():
                 scan_no = bold_scan['BLD']
@@ -1973,7 +2109,9 @@ class jobConstructor(object):
                         surfdir,
                         self.conf.iproc.SCRATCHDIR,
                         smooth,
-                        bold4]
+                        bold4,
+                        self.conf.iproc.CODEDIR,
+                        cache_dir]
                 else:
                     #bold = f'{sessionid}_bld{bold_no}_reorient_skip_mc_unwarp_anat'
                     bold_tedanaed = f'{sessionid}_bld{bold_no}_desc-denoised_bold'
@@ -1995,10 +2133,12 @@ class jobConstructor(object):
                         boldpath,
                         surfdir,
                         self.conf.iproc.SCRATCHDIR,
-                        smooth]
+                        smooth,
+                        self.conf.iproc.CODEDIR,
+                        cache_dir]
     
                 logfile_base = self._io_file_fmt(cmd)
-                job_spec_list.append(JobSpec(cmd,logfile_base,outfiles))
+                job_spec_list.append(JobSpec(cmd,logfile_base,outfiles,run=self._run_key()))
 
         self.scans.reset_default_sessionid()
         return job_spec_list
@@ -2009,55 +2149,29 @@ class jobConstructor(object):
     ## Helpers
     ###
     def load_rmfile_dump(self,stagename, initialize_blank=False):
-        # try to load a crash file. if none exists, load finished file from previous step.
-        # must be passed the name of the previous step.
-
-        # first check if this is a rerun:
-        if os.path.exists(self.rm_final_filename):
-            with open(self.rm_final_filename, 'rb') as f:
-                self.rmfiles=pickle.load(f)   
-            logger.debug(f'Final rmfile found from a previous successful run of this step {self.rm_final_filename}')
-            return
+        # the ledger persists across stages, all that is left to do here is to
+        # check that the previous stage has run, and to bring in the pickled
+        # dumps of subjects that were processed before there was a ledger.
+        # must be passed the name of the previous stage.
+        for name in [self.args.stage, stagename]:
+            if name and self.ledger.has_stage(name):
+                return
+        for name,suffix in [(self.args.stage, 'final'), (stagename, 'final'), (self.args.stage, 'crash')]:
+            fname = os.path.join(self.conf.iproc.RMFILE_DUMP, f'{name}.{suffix}')
+            if name and os.path.exists(fname):
+                self.ledger.import_pickle(name, fname)
+                return
         if initialize_blank or self.args.blank_rmfiles:
             return
-        try:
-            assert(stagename)
-            prior_final_dump_fname = os.path.join(self.conf.iproc.RMFILE_DUMP, f'{stagename}.final')
-            with open(prior_final_dump_fname, 'rb') as f:
-                self.rmfiles = pickle.load(f)
-            logger.debug(f'final file {prior_final_dump_fname} loaded')
-        except (OSError,IOError,AssertionError) as e:
-            logger.debug(e)
-            try:
-                dump_fname = self.rm_dump_filename
-                with open(dump_fname, 'rb') as f:
-                    self.rmfiles=pickle.load(f)
-            except (OSError,IOError) as e:
-                logger.debug(e)
-                logger.debug(dump_fname)
-                logger.debug(prior_final_dump_fname)
-                raise IOError('no appropriate dump file exists. Did you run the previous steps?')
+        raise IOError(f'nothing from {stagename} in {self.ledger.fname}. Did you run the previous steps?')
 
     def _get_rmfiles(self, stepname):
         # this should work even in the case that the last two are "None"
-        try: 
-            rmfiles = self.rmfiles[stepname][self.scans.sessionid][self.scans.scan_no]
-        except KeyError:
-            rmfiles = []
-        return rmfiles
+        return self.ledger.get_handoff(stepname, self.scans.sessionid, self.scans.scan_no)
         
     def _set_rmfiles(self, stepname, rmfiles):
         # this should work even in the case that the last two are "None"
-        try:
-            self.rmfiles[stepname][self.scans.sessionid][self.scans.scan_no] = rmfiles
-        except KeyError:
-            self.rmfiles[stepname]={}
-            self.rmfiles[stepname][self.scans.sessionid] = {}
-            self.rmfiles[stepname][self.scans.sessionid][self.scans.scan_no] = rmfiles
-        # write to disk
-        fname = self.rm_dump_filename
-        with open(fname,'wb') as f:
-            pickle.dump(self.rmfiles,f)
+        self.ledger.set_handoff(self.args.stage, stepname, self.scans.sessionid, self.scans.scan_no, rmfiles)
  
     @staticmethod
     def _unwarp_direction_from_sidecar(fdir, sessid, boldno):
@@ -2094,9 +2208,24 @@ class jobConstructor(object):
                 f'{self.conf.iproc.SUB}_{sessionid}_{scan_no}_{scan_name}_{scriptname}')
         return outfile_base
     
-    def _outfiles_skip(self,overwrite,outfiles):
-
-        outfiles_exist = {x:os.path.exists(x) for x in outfiles}
+    def _run_key(self):
+        # identifies the run a job belongs to, so jobs of different steps can be linked per run
+        return (self.scans.sessionid, self.scans.scan_no)
+
+    def _outfiles_skip(self,overwrite,outfiles,cmd=None):
+        # with cmd, a change to the command line is a reason to rerun, too
+        skip = self._outfiles_current(overwrite,outfiles,cmd)
+        if not skip:
+            self.pending_outfiles.update(outfiles)
+        return skip
+
+    def _outfiles_current(self,overwrite,outfiles,cmd=None):
+
+        if self.fsindex.empty():
+            # first check since jobs last ran, list the output trees in one go
+            self.fsindex.prefetch_tree([self.conf.get('iproc', d) for d in ['NATDIR', 'NAT_RESAMP_DIR', 'MNI_RESAMP_DIR']])
+        self.fsindex.prefetch(outfiles)
+        outfiles_exist = {x:self.fsindex.exists(x) for x in outfiles}
         existing_outfiles = [k for k,v in list(outfiles_exist.items()) if v]
         nonexisting_outfiles = [k for k,v in list(outfiles_exist.items()) if not v]
         
@@ -2104,6 +2233,10 @@ class jobConstructor(object):
             return False 
         else:
             if not nonexisting_outfiles:
+                current,reason = self.provenance.check(outfiles, self.pending_outfiles, cmd)
+                if not current:
+                    logger.info(f'{reason}. Jobs will be added to job list for rerun.')
+                    return False
                 logger.debug(f'outfiles exist {" ".join(existing_outfiles)}. Job will not be added to job list.')
                 return True
             elif existing_outfiles: 
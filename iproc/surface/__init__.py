@@ -0,0 +1,217 @@
+'''
+Projection of 4D volumes onto fsaverage6, in place of mri_vol2surf
+--regheader --projfrac 0.5 --interp trilinear --trgsubject fsaverage6, and
+smoothing on the surface, in place of mri_surf2surf --cortex --fwhm-trg.
+
+All of it is linear in the data, and only depends on geometry: the surfaces
+of the subject, the grid of the volume and fsaverage6. So both are built once
+as sparse matrices:
+
+ - sampling: (fsaverage6 vertices, voxels). Each row is the trilinear
+   weights of the point halfway through the cortex (white surface moved
+   along its normal by projfrac times the thickness) of the subject
+   vertices that map to that fsaverage6 vertex on sphere.reg, averaged the
+   way mri_vol2surf does it (nnfr: the nearest subject vertex, and every
+   subject vertex nearest to it).
+ - smoothing: (fsaverage6 vertices, fsaverage6 vertices), one step of
+   nearest-neighbour averaging within the cortex label, applied as many
+   times as mri_surf2surf would for the FWHM. Vertices outside of the
+   cortex are 0.
+
+The sampling matrices are cached on disk, keyed by the grid of the volume
+and the surface files, so the runs of a subject all share them. Each volume
+is then read once, in chunks of volumes, and projected onto both
+hemispheres with a sparse product.
+'''
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import nibabel as nib
+import scipy.sparse
+import scipy.spatial
+import iproc.codec as codec
+import iproc.commons as commons
+import iproc.nuisance as nuisance
+
+logger = logging.getLogger(__name__)
+
+HEMIS = ('lh', 'rh')
+TRGSUBJECT = 'fsaverage6'
+PROJFRAC = 0.5
+# mri_vol2surf --reshape, so that the vertices fit in a NIfTI dimension
+RESHAPE_FACTOR = 6
+# part of the key of the cached sampling matrices, bumped when sampling_matrix() changes
+SAMPLING_VERSION = 2
+
+def vertex_normals(coords, faces):
+    '''
+    unit normals of a surface. Like MRIScomputeNormals, the normals of the
+    faces around each vertex are summed unnormalized, so weighted by area
+    '''
+    tri = coords[faces]
+    face_normals = np.cross(tri[:,1] - tri[:,0], tri[:,2] - tri[:,0])
+    normals = np.zeros_like(coords)
+    for i in range(3):
+        np.add.at(normals, faces[:,i], face_normals)
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    return normals
+
+def tkr_to_scanner(orig_fname):
+    ''' 4x4 matrix from surface (tkregister) RAS to scanner RAS, from the orig.mgz of the subject '''
+    orig = nib.load(orig_fname)
+    return orig.affine @ np.linalg.inv(orig.header.get_vox2ras_tkr())
+
+def trilinear(points, shape):
+    '''
+    (P, voxels) sparse trilinear interpolation weights, over the voxels of a
+    grid in NIfTI (Fortran) order. Points outside of the grid get no weights.
+    :param points: (P,3) voxel coordinates
+    '''
+    shape = np.asarray(shape[:3])
+    inside = np.all((points >= 0) & (points <= shape - 1), axis=1)
+    rows = np.flatnonzero(inside)
+    points = points[inside]
+    base = np.minimum(np.floor(points).astype(np.int64), np.maximum(shape - 2, 0))
+    frac = points - base
+    all_rows,all_cols,all_weights = [],[],[]
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.array(corner)
+        weights = np.prod(np.where(corner, frac, 1 - frac), axis=1)
+        idx = np.minimum(base + corner, shape - 1)
+        all_rows.append(rows)
+        all_cols.append(idx[:,0] + shape[0] * (idx[:,1] + shape[1] * idx[:,2]))
+        all_weights.append(weights)
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(all_weights), (np.concatenate(all_rows), np.concatenate(all_cols))),
+        shape=(inside.size, int(np.prod(shape))))
+
+def nnfr(src_sphere, trg_sphere):
+    '''
+    (target vertices, source vertices) sparse averaging matrix between two
+    registered spheres: each target vertex is the mean of its nearest source
+    vertex and of every source vertex whose nearest target vertex it is
+    '''
+    forward = scipy.spatial.cKDTree(src_sphere).query(trg_sphere)[1]
+    reverse = scipy.spatial.cKDTree(trg_sphere).query(src_sphere)[1]
+    rows = np.concatenate([np.arange(trg_sphere.shape[0]), reverse])
+    cols = np.concatenate([forward, np.arange(src_sphere.shape[0])])
+    M = scipy.sparse.csr_matrix((np.ones(rows.size), (rows, cols)),
+        shape=(trg_sphere.shape[0], src_sphere.shape[0]))
+    # a pair found both ways counts once
+    M.data[:] = 1
+    return scipy.sparse.diags(1 / np.asarray(M.sum(axis=1)).ravel()) @ M
+
+def _subject_files(subjects_dir, subject, hemi):
+    return {
+        'white': os.path.join(subjects_dir, subject, 'surf', f'{hemi}.white'),
+        'thickness': os.path.join(subjects_dir, subject, 'surf', f'{hemi}.thickness'),
+        'sphere': os.path.join(subjects_dir, subject, 'surf', f'{hemi}.sphere.reg'),
+        'orig': os.path.join(subjects_dir, subject, 'mri', 'orig.mgz'),
+    }
+
+def sampling_matrix(subjects_dir, subject, hemi, img, trgsubject=TRGSUBJECT, projfrac=PROJFRAC):
+    ''' (target vertices, voxels) sparse matrix from a volume on the grid of img to the target surface '''
+    files = _subject_files(subjects_dir, subject, hemi)
+    coords,faces = nib.freesurfer.read_geometry(files['white'])
+    thickness = nib.freesurfer.read_morph_data(files['thickness'])
+    points = coords + projfrac * thickness[:,np.newaxis] * vertex_normals(coords, faces)
+    # --regheader: the volume and orig.mgz share scanner coordinates
+    tkr2vox = np.linalg.inv(img.affine) @ tkr_to_scanner(files['orig'])
+    points = points @ tkr2vox[:3,:3].T + tkr2vox[:3,3]
+    src_sphere,_ = nib.freesurfer.read_geometry(files['sphere'])
+    trg_sphere,_ = nib.freesurfer.read_geometry(_subject_files(subjects_dir, trgsubject, hemi)['sphere'])
+    return (nnfr(src_sphere, trg_sphere) @ trilinear(points, img.shape)).tocsr()
+
+def cached_sampling_matrix(cache_dir, subjects_dir, subject, hemi, img, trgsubject=TRGSUBJECT, projfrac=PROJFRAC):
+    ''' sampling_matrix(), from cache_dir if it was built already for the same grid and surfaces '''
+    files = list(_subject_files(subjects_dir, subject, hemi).values())
+    files.append(_subject_files(subjects_dir, trgsubject, hemi)['sphere'])
+    key = json.dumps([SAMPLING_VERSION, subject, hemi, trgsubject, projfrac, list(img.shape[:3]),
+        np.round(img.affine, 6).tolist(), [(f, os.stat(f).st_mtime) for f in files]])
+    fname = os.path.join(cache_dir, f'{hemi}.{hashlib.sha1(key.encode()).hexdigest()}.npz')
+    if os.path.exists(fname):
+        logger.info(f'reading {fname}')
+        return scipy.sparse.load_npz(fname)
+    M = sampling_matrix(subjects_dir, subject, hemi, img, trgsubject, projfrac)
+    # concurrent jobs may build the same matrix
+    commons.replace_file(fname, lambda tmp: scipy.sparse.save_npz(tmp, M), '.npz')
+    logger.info(f'wrote {fname}')
+    return M
+
+def fwhm_to_niters(fwhm, coords, faces):
+    ''' number of smoothing steps for a FWHM (mm), as MRISfwhm2niters computes it '''
+    tri = coords[faces]
+    area = 0.5 * np.linalg.norm(np.cross(tri[:,1] - tri[:,0], tri[:,2] - tri[:,0]), axis=1).sum()
+    gstd = fwhm / np.sqrt(np.log(256.0))
+    return int(np.floor(1.14 * (4 * np.pi * gstd ** 2) / (7 * area / coords.shape[0]) + 0.5))
+
+def smoothing_operator(subjects_dir, hemi, subject=TRGSUBJECT):
+    '''
+    one step of nearest-neighbour smoothing within the cortex label, as a
+    sparse (vertices, vertices) matrix, with the white surface it is on
+    :returns: (operator, coords, faces)
+    '''
+    surf = os.path.join(subjects_dir, subject, 'surf', f'{hemi}.white')
+    coords,faces = nib.freesurfer.read_geometry(surf)
+    nvert = coords.shape[0]
+    cortex = np.zeros(nvert, dtype=bool)
+    cortex[nib.freesurfer.read_label(os.path.join(subjects_dir, subject, 'label', f'{hemi}.cortex.label'))] = True
+    edges = np.concatenate([faces[:,[0,1]], faces[:,[1,2]], faces[:,[2,0]]])
+    edges = np.concatenate([edges, edges[:,::-1], np.repeat(np.arange(nvert)[:,np.newaxis], 2, axis=1)])
+    edges = edges[cortex[edges[:,0]] & cortex[edges[:,1]]]
+    A = scipy.sparse.csr_matrix((np.ones(len(edges)), (edges[:,0], edges[:,1])), shape=(nvert, nvert))
+    A.data[:] = 1
+    counts = np.asarray(A.sum(axis=1)).ravel()
+    A = scipy.sparse.diags(np.divide(1, counts, out=np.zeros(nvert), where=counts > 0)) @ A
+    return A.tocsr(),coords,faces
+
+def smooth(X, operator, niters):
+    ''' apply the smoothing operator niters times to (vertices, T) data '''
+    # rows of the operator outside of the cortex are empty, their vertices
+    #are 0, as with --cortex, even without a smoothing step
+    cortex = np.diff(operator.tocsr().indptr) > 0
+    X = np.where(cortex[:,np.newaxis], X, 0)
+    for _ in range(niters):
+        X = operator @ X
+    return np.asarray(X, dtype=np.float32)
+
+def project(fname, operators, chunk=nuisance.CHUNK):
+    '''
+    project a 4D volume through sparse matrices, in one read
+    :param operators: {name: (vertices, voxels) matrix}
+    :returns: {name: (vertices, T) float32 array}
+    '''
+    img = nib.load(fname)
+    numvol = img.shape[3] if img.ndim > 3 else 1
+    out = {name: np.empty((M.shape[0], numvol), dtype=np.float32) for name,M in operators.items()}
+    for start,data in nuisance.iter_volumes(fname, chunk):
+        for name,M in operators.items():
+            out[name][:,start:start + data.shape[1]] = M @ data
+    return out
+
+def write_surface(fname, data, scratch=None, nthreads=None):
+    '''
+    write (vertices, T) data as a NIfTI reshaped like mri_vol2surf --reshape,
+    built uncompressed in scratch and compressed into fname if it ends in .gz
+    :param nthreads: compression threads, see codec.compress()
+    '''
+    nvert,numvol = data.shape
+    if nvert % RESHAPE_FACTOR == 0:
+        dims = (nvert // RESHAPE_FACTOR, 1, RESHAPE_FACTOR, numvol)
+    else:
+        dims = (nvert, 1, 1, numvol)
+    img = nib.Nifti1Image(np.asarray(data, dtype=np.float32).reshape(dims, order='F'), np.eye(4))
+    if not fname.endswith('.gz'):
+        nib.save(img, fname)
+        return
+    fd,tmp = tempfile.mkstemp(dir=scratch, suffix='.nii')
+    os.close(fd)
+    try:
+        nib.save(img, tmp)
+        codec.compress(tmp, fname, nthreads=nthreads)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
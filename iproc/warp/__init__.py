@@ -0,0 +1,217 @@
+'''
+In-process replacement for the per-volume convertwarp/applywarp calls of
+combine_warps_parallel. All transforms follow the FSL conventions:
+
+ - coordinates are FSL "scaled voxel" coordinates (voxel index times voxel
+   size, with x flipped for images stored in neurological orientation),
+   which is what FLIRT matrices and FNIRT/convertwarp warp fields use.
+ - warp fields are pull fields: they are defined on the grid of their
+   reference image, and hold, for each reference voxel, the position
+   (absolute) or the displacement (relative) in the space of their input.
+ - a convertwarp chain of premat, warp1, midmat, warp2, postmat, is
+   evaluated backwards from the reference grid to the input image.
+
+Only the premat (the per-volume motion correction matrix) differs between
+the volumes of a run, so everything after it is evaluated once per run, and
+each volume is resampled with a single affine on top of that.
+
+Runs are streamed: the input is read through a memory-mapped uncompressed
+copy, the warped volumes go straight into a preallocated 4D file, and that
+file is compressed once at the end.
+'''
+import os
+import gzip
+import shutil
+import logging
+import concurrent.futures as cf
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+import iproc.xfm as xfm
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFSIZE = 16 * 1024 ** 2
+
+def fsl_affine(img):
+    '''
+    voxel to FSL coordinate matrix of an image
+    :param img: nibabel image
+    :returns: 4x4 array
+    '''
+    zooms = img.header.get_zooms()[:3]
+    vox2fsl = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(img.affine[:3,:3]) > 0:
+        # neurological storage order, FSL flips x
+        vox2fsl[0,0] = -zooms[0]
+        vox2fsl[0,3] = (img.shape[0] - 1) * zooms[0]
+    return vox2fsl
+
+def find_image(fname):
+    ''' FSL tools add .nii.gz to image names given without an extension, so look for that too '''
+    for candidate in [fname, fname + '.nii.gz', fname + '.nii']:
+        if os.path.exists(candidate):
+            return candidate
+    raise IOError('image {} not found'.format(fname))
+
+def read_flirt_mat(fname):
+    ''' read a FLIRT (or mcflirt MAT_NNNN) text matrix '''
+    return xfm.read_mat(fname)
+
+def grid_coords(img):
+    ''' FSL coordinates of all voxel centres of img, as a (P,3) array in C order '''
+    shape = img.shape[:3]
+    ijk = np.indices(shape, dtype=np.float32).reshape(3,-1).T
+    return apply_affine(fsl_affine(img), ijk)
+
+def apply_affine(mat, points):
+    ''' apply a 4x4 matrix to a (P,3) array of points '''
+    mat = np.asarray(mat, dtype=np.float64)
+    return (points @ mat[:3,:3].T.astype(points.dtype)) + mat[:3,3].astype(points.dtype)
+
+class Warp(object):
+    '''
+    A warp field (as written by convertwarp, fnirt --fout, or fugue),
+    that can be evaluated at arbitrary points.
+    '''
+    def __init__(self, fname, absolute=None):
+        fname = find_image(fname)
+        img = nib.load(fname)
+        data = np.asanyarray(img.dataobj, dtype=np.float32)
+        self.fname = fname
+        self.field = data.reshape(img.shape[:3] + (3,))
+        self.fsl2vox = np.linalg.inv(fsl_affine(img))
+        self.shape = img.shape[:3]
+        if absolute is None:
+            absolute = self._detect_absolute(img)
+        self.absolute = absolute
+        logger.debug('{} is a {} warp'.format(fname, 'absolute' if absolute else 'relative'))
+
+    def _detect_absolute(self, img):
+        # same test as fslpy: an absolute field is closer to the coordinates
+        # of its own grid than a relative one is to zero
+        coords = grid_coords(img).reshape(self.field.shape)
+        absdiff = np.abs(self.field - coords).mean()
+        reldiff = np.abs(self.field).mean()
+        return bool(absdiff < reldiff)
+
+    def __call__(self, points):
+        '''
+        map (P,3) FSL coordinates in the reference space of the warp to FSL
+        coordinates in its input space
+        '''
+        vox = apply_affine(self.fsl2vox, points).T
+        values = np.empty(points.shape, dtype=np.float32)
+        for axis in range(3):
+            # edge values are carried beyond the field of view of the warp
+            values[:,axis] = ndimage.map_coordinates(self.field[...,axis], vox, order=1, mode='nearest', prefilter=False)
+        if self.absolute:
+            return values
+        return points + values
+
+def convertwarp(ref, warp1=None, midmat=None, warp2=None, postmat=None):
+    '''
+    Everything of a convertwarp chain except the premat, evaluated on the
+    grid of ref. Returns a (P,3) array of FSL coordinates in the space the
+    premat maps into, one row per ref voxel in C order.
+    :param ref: reference image (nibabel image)
+    :param warp1, warp2: Warp objects or None
+    :param midmat, postmat: 4x4 arrays or None
+    '''
+    points = grid_coords(ref)
+    if postmat is not None:
+        points = apply_affine(np.linalg.inv(postmat), points)
+    if warp2 is not None:
+        points = warp2(points)
+    if midmat is not None:
+        points = apply_affine(np.linalg.inv(midmat), points)
+    if warp1 is not None:
+        points = warp1(points)
+    return points
+
+def applywarp(data, in_img, points, premat):
+    '''
+    Resample one volume at the points returned by convertwarp(), after
+    undoing premat. Trilinear, zero outside of the input, like applywarp.
+    :param data: 3D array of the input volume
+    :param in_img: input image, for its geometry
+    :returns: flat float32 array, one value per point
+    '''
+    fsl2vox = xfm.concat(np.linalg.inv(fsl_affine(in_img)), np.linalg.inv(premat))
+    return _resample(data, points, fsl2vox)
+
+def _resample(data, points, fsl2vox):
+    vox = apply_affine(fsl2vox, points).T
+    return ndimage.map_coordinates(data, vox, order=1, mode='constant', cval=0.0, prefilter=False, output=np.float32)
+
+def open_mmap(fname, scratch):
+    '''
+    Load a NIfTI image memory-mapped, so that volumes are read from disk as
+    they are needed. A compressed image is first decompressed into scratch,
+    in one sequential pass.
+    :returns: nibabel image
+    '''
+    fname = find_image(fname)
+    if fname.endswith('.gz'):
+        tmp = os.path.join(scratch, os.path.basename(fname)[:-len('.gz')])
+        with gzip.open(fname, 'rb') as fi, open(tmp, 'wb') as fo:
+            shutil.copyfileobj(fi, fo, COPY_BUFSIZE)
+        fname = tmp
+    return nib.load(fname, mmap=True)
+
+def create_4d(fname, ref, numvol=None):
+    '''
+    Preallocate an uncompressed float32 4D NIfTI on the grid of ref, with the
+    header applywarp and fslmerge would have written.
+    :param numvol: number of volumes, None for the shape of ref as it is
+    :returns: writable (X,Y,Z,N) memory map of the image data
+    '''
+    header = ref.header.copy()
+    shape = ref.shape if numvol is None else ref.shape[:3] + (numvol,)
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1.0, 0.0)
+    with open(fname, 'wb') as fo:
+        header.write_to(fo)
+        offset = header.get_data_offset()
+        fo.write(b'\x00' * (offset - fo.tell()))
+        # sparse until the volumes are written
+        fo.truncate(offset + int(np.prod(shape)) * 4)
+    return np.memmap(fname, dtype=header.get_data_dtype(), mode='r+', offset=offset, shape=shape, order='F')
+
+def warp_volumes(in_img, ref, points, premats, write, threads=None, chunk=None):
+    '''
+    Resample every volume of a 4D image onto the grid of ref, with volume i
+    first transformed by premats[i], and hand each result to
+    write(i, volume). Volumes are processed in chunks, in parallel threads.
+    :param in_img: 4D nibabel image, preferably from open_mmap()
+    :param points: output of convertwarp()
+    :param premats: (N,4,4) array
+    :param write: callable taking the volume index and a 3D float32 array
+    '''
+    threads = threads or len(os.sched_getaffinity(0))
+    chunk = chunk or threads
+    numvol = premats.shape[0]
+    if in_img.ndim < 4 or in_img.shape[3] < numvol:
+        raise ValueError('{} has fewer than {} volumes'.format(in_img.get_filename(), numvol))
+    ref_shape = ref.shape[:3]
+
+    if in_img.get_filename().endswith('.gz'):
+        # slicing a compressed file decompresses it from the start each
+        # time, so read the whole run once instead
+        data = np.asanyarray(in_img.dataobj, dtype=np.float32)
+        volume = lambda i: data[...,i]
+    else:
+        volume = lambda i: np.asanyarray(in_img.dataobj[...,i], dtype=np.float32)
+
+    # what undoes the premat and goes to input voxels, for all volumes at once
+    fsl2vox = xfm.concat(np.linalg.inv(fsl_affine(in_img)), np.linalg.inv(premats))
+
+    def one(i):
+        vol = _resample(volume(i), points, fsl2vox[i]).reshape(ref_shape)
+        write(i, vol)
+
+    with cf.ThreadPoolExecutor(threads) as ex:
+        for start in range(0, numvol, chunk):
+            # list() so exceptions in the workers are raised here
+            list(ex.map(one, range(start, min(start + chunk, numvol))))
@@ -0,0 +1,61 @@
+'''
+FSL affine matrices (FLIRT, mcflirt MAT_NNNN), read, composed and written in
+batches.
+
+The matrices of a run are kept in a single (N,4,4) array, and composing them
+with other matrices is one batched product, rather than one convert_xfm
+process per volume. Composition follows convert_xfm -concat: concat(BtoC,
+AtoB) is the matrix that maps A to C.
+'''
+import os
+import numpy as np
+
+def read_mat(fname):
+    ''' one FSL text matrix, as a 4x4 array '''
+    return read_mats([fname])[0]
+
+def read_mats(fnames):
+    '''
+    many FSL text matrices, as a (N,4,4) array, parsed in one go
+    :param fnames: list of matrix files, or a mcflirt .mat directory, in
+        which case all of its MAT_NNNN files are read in volume order
+    '''
+    if isinstance(fnames, str):
+        fnames = [os.path.join(fnames, f) for f in sorted(os.listdir(fnames)) if f.startswith('MAT_')]
+    values = []
+    for fname in fnames:
+        with open(fname) as fo:
+            words = fo.read().split()
+        if len(words) != 16:
+            raise ValueError('{} has {} values, expected 16'.format(fname, len(words)))
+        values += words
+    return np.array(values, dtype=np.float64).reshape(-1,4,4)
+
+def concat(*mats):
+    '''
+    compose matrices or stacks of matrices, last applied first, like
+    convert_xfm -concat. Stacks are broadcast against single matrices.
+    '''
+    result = np.asarray(mats[-1], dtype=np.float64)
+    for mat in reversed(mats[:-1]):
+        result = np.einsum('...ij,...jk->...ik', np.asarray(mat, dtype=np.float64), result)
+    return result
+
+def write_mat(fname, mat):
+    ''' write a 4x4 matrix in the text format of FLIRT and convert_xfm '''
+    with open(fname, 'w') as fo:
+        for row in np.asarray(mat).reshape(4,4):
+            fo.write('  '.join('{:.10f}'.format(v) for v in row) + '  \n')
+
+def write_mats(dirname, mats, prefix='MAT_'):
+    '''
+    write a stack of matrices as {prefix}NNNN files, like mcflirt -mats
+    :returns: list of file names
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    fnames = []
+    for i,mat in enumerate(mats):
+        fname = os.path.join(dirname, '{}{:04d}'.format(prefix, i))
+        write_mat(fname, mat)
+        fnames.append(fname)
+    return fnames
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
-import sys
+import os
+import json
 import numpy as np
-from scipy.io import loadmat
-from scipy.stats import zscore
-from scipy.signal import detrend
+import concurrent.futures as cf
+from argparse import ArgumentParser
+import iproc.nuisance as nuisance
+import iproc.motion as motion
 
 '''
 
@@ -18,35 +20,84 @@ Orig MATLAB command:
 xx=diff(zscore(detrend(nuis_ts))); x=zscore(detrend(nuis_ts)); xx=[zeros(size(xx(1,1:end)));xx]; \
 xxx=[x xx]; dlmwrite('${tmpdir}/nuis_out.dat',xxx,'delimiter', ' ', 'precision',10); catch e=1; end; exit(e)"
 
-'''
-
-def main(NUIS_TS,tmpdir):
+The CSF, WM and whole-brain timeseries used to come from three fslmeants
+calls, pasted together with the motion parameters through text files. They
+are now computed here, from a single read of the BOLD data, and the text
+files are only written for the record.
 
-    # Load nuisance time series
-    nuis_ts = np.loadtxt(NUIS_TS)  # Replace with actual path or pass as a variable
+With --manifest, all the runs of a subject are done in one process.
 
-    # Detrend and z-score normalization
-    nuis_norm = zscore(detrend(nuis_ts, axis=0), ddof=1, axis=0)
+'''
 
-    # First derivative (temporal difference)
-    nuis_deriv1 = np.diff(nuis_norm, axis=0)
-    nuis_deriv1 = np.vstack([np.zeros((1, nuis_deriv1.shape[1])), nuis_deriv1])
+# keys of a run, as command line options and in a --manifest
+RUN_KEYS = [
+    ('resid_in', '4D BOLD data'),
+    ('csf_mask', 'CSF mask'),
+    ('wm_mask', 'WM mask'),
+    ('wb_mask', 'whole-brain mask'),
+    ('csf_ts', 'CSF timeseries output'),
+    ('wm_ts', 'WM timeseries output'),
+    ('wb_ts', 'whole-brain timeseries output'),
+    ('phys_ts', 'CSF, WM and WB timeseries output'),
+    ('mc_ts', 'mcflirt .par file'),
+    ('nuis_ts', 'motion and physiological timeseries output'),
+    ('mcout_ts', 'motion outlier matrix'),
+    ('nuis_out_nocensor', '36P regressors output'),
+    ('nuis_out', '36P regressors and motion outliers output'),
+]
 
-    # Concatenate original + derivative
-    nuis_18P = np.hstack([nuis_norm, nuis_deriv1])
+def write_lines(fname, lines):
+    with open(fname, 'w') as fo:
+        for line in lines:
+            fo.write(line + '\n')
 
-    # Square terms
-    nuis_quad = nuis_18P ** 2
+def timeseries(run, chunk):
+    # CSF, WM and WB, in the column order of the regressor matrix
+    masks = [run['csf_mask'], run['wm_mask'], run['wb_mask']]
+    phys = nuisance.mask_means(run['resid_in'], masks, chunk=chunk)
+    # the timeseries used to be rounded by printf "%0.3f", keep it that way
+    # so that the regressors do not change
+    phys = np.round(phys, 3)
+    for fname,column in zip([run['csf_ts'], run['wm_ts'], run['wb_ts']], phys.T):
+        write_lines(fname, ['{:0.3f}'.format(v) for v in column])
+    write_lines(run['phys_ts'], ['{:10.3f}{:10.3f}{:10.3f}'.format(*row) for row in phys])
 
-    # Full nuisance regressor set
-    FULLNUISDF = np.hstack([nuis_norm, nuis_deriv1, nuis_quad])
+    mc = motion.read_par(run['mc_ts'], numvol=phys.shape[0])
+    write_lines(run['nuis_ts'], [' '.join(['%.10g' % v for v in mc_row] + ['{:0.3f}'.format(v) for v in row]) for mc_row,row in zip(mc, phys)])
+    return np.hstack([mc, phys])
 
-    # Save to file
-    np.savetxt(f'{tmpdir}/nuis_out.dat', FULLNUISDF, delimiter=' ', fmt='%.10g')
+def write_regressors(run, FULLNUISDF):
+    np.savetxt(run['nuis_out_nocensor'], FULLNUISDF, delimiter=' ', fmt='%.10g')
+    # add the motion outliers
+    with open(run['mcout_ts']) as fo:
+        outlier_rows = [line.split() for line in fo]
+    outlier_rows += [[]] * (FULLNUISDF.shape[0] - len(outlier_rows))
+    write_lines(run['nuis_out'], [' '.join(['%.10g' % v for v in row] + outliers) for row,outliers in zip(FULLNUISDF, outlier_rows)])
 
+def main(runs, chunk, threads):
+    # reading the BOLD data is most of the time, and zlib lets go of the GIL
+    with cf.ThreadPoolExecutor(threads) as ex:
+        nuis_ts_list = list(ex.map(lambda run: timeseries(run, chunk), runs))
+    # runs of equal length are detrended and normalized together
+    for run,FULLNUISDF in zip(runs, nuisance.batch_regressors_36p(nuis_ts_list)):
+        write_regressors(run, FULLNUISDF)
+        print('wrote {}'.format(run['nuis_out']))
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python calcualte_nuisance_params.py $NUIS_TS $tmpdir")
+    parser = ArgumentParser(description="compute the 36P nuisance regressors of a run, or of every run in a manifest")
+    parser.add_argument("--manifest",
+        help="JSON list of runs, each with every one of the per-run options below as keys (e.g. resid_in)")
+    for key,help in RUN_KEYS:
+        parser.add_argument("--" + key.replace('_', '-'), help=help)
+    parser.add_argument("--chunk", type=int, default=nuisance.CHUNK, help="volumes to read at a time")
+    args = parser.parse_args()
+    if args.manifest:
+        with open(args.manifest) as fo:
+            runs = json.load(fo)
     else:
-        main(sys.argv[1], sys.argv[2])
+        runs = [{key:getattr(args, key) for key,_ in RUN_KEYS}]
+    for run in runs:
+        missing = [key for key,_ in RUN_KEYS if not run.get(key)]
+        if missing:
+            parser.error('run {} is missing {}'.format(run.get('resid_in'), ', '.join(missing)))
+    main(runs, args.chunk, len(os.sched_getaffinity(0)))
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+import iproc.codec as codec
+
+'''
+
+In place of gzip -f, with the blocks of each file compressed in parallel
+threads, at the level set in the [io] section of the config file.
+
+'''
+
+logger = logging.getLogger(os.path.basename(__file__))
+format="[%(asctime)s][%(levelname)s] - %(name)s - %(message)s"
+logging.basicConfig(format=format, level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="gzip files into multi-member .gz files, compressed in parallel")
+    parser.add_argument("files", nargs="+", help="each one is replaced by file.gz")
+    parser.add_argument("--intermediate", action="store_true", help="use the level of intermediates")
+    args = parser.parse_args()
+    for fname in args.files:
+        codec.compress(fname, intermediate=args.intermediate)
+        print("wrote {}.gz".format(fname))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+import numpy as np
+from argparse import ArgumentParser
+import iproc.regress as regress
+
+'''
+
+Fused nuisance_regress, bandpass and wholebrain_only_regress, in place of
+    3dTproject -ort ${NUIS_OUT} -input ${RESID_IN} -mask ${MASK} -prefix ${RESID_OUT}
+    3dBandpass -prefix ${BPSS_OUT} -mask ${MASK} 0.01 0.1 ${RESID_OUT}
+    fslmeants -i ${RESID_IN} -o ${WB_TS} -m ${WB_MASK}
+    paste -d ' ' ${WB_TS} ${MCOUT_TS} > ${MCOUTWB_TS}
+    3dTproject -ort ${MCOUTWB_TS} -input ${RESID_IN} -mask ${MASK} -prefix ${WBONLY_OUT}
+with ${RESID_IN} read once, and the intermediates kept in memory.
+
+'''
+
+logger = logging.getLogger(os.path.basename(__file__))
+format="[%(asctime)s][%(levelname)s] - %(name)s - %(message)s"
+logging.basicConfig(format=format, level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="nuisance regression, bandpass and whole-brain-only regression of 4D data, in one pass")
+    parser.add_argument("--input", required=True, help="4D data")
+    parser.add_argument("--ort", required=True, help="nuisance regressors, one row per volume")
+    parser.add_argument("--mask", required=True, help="brain mask, voxels outside it are 0 in the outputs")
+    parser.add_argument("--resid", required=True, help="nuisance residuals, .nii.gz")
+    parser.add_argument("--bpss", help="bandpassed nuisance residuals, .nii.gz")
+    parser.add_argument("--band", nargs=2, type=float, default=regress.BAND, metavar=("FBOT", "FTOP"), help="passband in Hz")
+    parser.add_argument("--wb-mask", help="mask of the whole-brain signal")
+    parser.add_argument("--mcout", help="motion outlier regressors, regressed out next to the whole-brain signal")
+    parser.add_argument("--wb-ts", help="where to write the whole-brain signal")
+    parser.add_argument("--wbmc-ts", help="where to write the whole-brain signal next to the motion outlier regressors")
+    parser.add_argument("--wbonly", help="whole-brain-only residuals, .nii.gz")
+    parser.add_argument("--scratch", help="directory for the uncompressed outputs")
+    parser.add_argument("--polort", type=int, default=regress.POLORT, help="order of the Legendre polynomials also projected out")
+    args = parser.parse_args()
+    if args.wbonly and not args.wb_mask:
+        parser.error("--wbonly needs --wb-mask")
+
+    mcout = regress.read_ort(args.mcout) if args.mcout else None
+    wb_ts = regress.denoise(args.input, args.mask, regress.read_ort(args.ort), args.resid, args.bpss,
+        wb_mask=args.wb_mask, wb_ort=mcout, wbonly_out=args.wbonly,
+        band=args.band, scratch=args.scratch, polort=args.polort)
+    # same records as wholebrain_only_regress.sh leaves behind
+    if wb_ts is not None:
+        if args.wb_ts:
+            np.savetxt(args.wb_ts, wb_ts, fmt='%f')
+        if args.wbmc_ts:
+            columns = [wb_ts[:,np.newaxis]] + ([mcout] if mcout is not None else [])
+            wbmc = np.hstack(columns)
+            np.savetxt(args.wbmc_ts, wbmc, fmt=['%f'] + ['%d'] * (wbmc.shape[1] - 1))
+    for fname in (args.resid, args.bpss, args.wbonly):
+        if fname:
+            print("wrote {}".format(fname))
@@ -35,92 +35,22 @@ fslroi ${MC_IN} ${MC_IN%.nii.gz}_OrigMidVol.nii.gz 'expr ${NUMVOL} / 2' 1  ## sp
 echo $((${NUMVOL} / 2)) > ${MC_IN%.nii.gz}_OrigMidVol.txt
 OrigMidVol=$((${NUMVOL} / 2))
 #fi
-# calculate FD outliers using the same FD threshold for REST and TASK
-# now in the config file
-#FDThres=0.4
-#FDTHRES=0pt4
-#if [[ ! -e ${MC_IN%.nii.gz}_FD_vals.txt ]]; then
-fsl_motion_outliers -i ${MC_IN} -o ${MC_IN%.nii.gz}_FD${FDTHRES}_outlier_mat.txt -s ${MC_IN%.nii.gz}_FD_vals.txt -p ${MC_IN%.nii.gz}_FD.png --fd -v --thresh=${FDThres} > ${MC_IN%.nii.gz}_fsl_motion_outlier_FD${FDTHRES}_output.txt
-#fi
-grep 'Found spikes at ' ${MC_IN%.nii.gz}_fsl_motion_outlier_FD${FDTHRES}_output.txt > ${MC_IN%.nii.gz}_tmp1.txt
-
-set +e
-grep -Eo '[0-9]{1,4}' ${MC_IN%.nii.gz}_tmp1.txt > ${MC_IN%.nii.gz}_FD${FDTHRES}_outlier_num.txt
-returncode=$?
-set -e
-
-if [ "${returncode}" -eq 0 ]; then
-    echo "grep found spikes"
-elif [ "${returncode}" -eq 1 ]; then
-    echo "grep did not find any spikes"
-else
-    echo "grep errored with returncode ${returncode}"
-    exit "${returncode}"
-fi
-
-#echo making list of outlier volumes
-#grep -z '[0-9]{1,4}' ${MC_IN%.nii.gz}_tmp1.txt > ${MC_IN%.nii.gz}_FD${FDTHRES}_outlier_num.txt
-#echo list compiled
-
-if [[ ! -e ${MC_IN%.nii.gz}_FD${FDTHRES}_outlier_num.txt ]]; then
-echo No Motion Spikes;
-touch ${MC_IN%.nii.gz}_FD${FDTHRES}_outlier_num.txt
-fi
-OUTLIER_FILE="${MC_IN%.nii.gz}_FD${FDTHRES}_outlier_num.txt"
-MIDVOL_NO="${OrigMidVol}"
-num_outliers=$(cat ${OUTLIER_FILE} | wc -l)
-pct=$(bc -l <<< ${num_outliers}/${NUMVOL})
-status=$(echo "${pct} >= .2" | bc -l)
-if [ "$status" == "1" ]; then
-    echo "WARNING: number of outliers (${num_outliers}) is 20% or greater than the total number of volumes (${NUMVOL})"
-fi
-# search for midvol that is not an outlier
-nits=5
-found=false
-echo "searching for a non-outlier midvol"
-echo "starting with midvol number ${MIDVOL_NO}"
-echo "stopping after ${nits} iterations"
-for (( i = 1; i <= nits; i++ )); do
-    set +e
-    grep -q -w "${MIDVOL_NO}" "${OUTLIER_FILE}"
-    returncode=$?
-    set -e
-    if [ ${returncode} -eq 0 ]; then
-        echo "   ${i}. ${MIDVOL_NO} is an outlier"
-    elif [ ${returncode} -eq 1 ]; then
-        echo "   ${i}. ${MIDVOL_NO} is not an outlier (stop)"
-        found=true
-        break
-    else
-        exit ${returncode}
-    fi
-    MIDVOL_NO=$((${MIDVOL_NO} + 1))
-done
-
-if ! ${found}; then
-    echo "unable to find a usable midvol"
-    echo "exiting"
-    exit 1
-fi
-
-echo "using ${MIDVOL_NO} as midvol"
-
-# Create Final MidVol using updated MIDVOL or OrigMidVol
-echo ${MIDVOL_NO} > ${MC_IN%.nii.gz}_FinalMidVol.txt
-
-
-OUTLIERMATRIX="${MC_IN%.nii.gz}_FD${FDTHRES}_outlier_matrix.dat"
-python ${CODEDIR}/runscript/create_motion_outlier_matrix.py $OUTLIER_FILE $NUMVOL $OUTLIERMATRIX
-
-
-
-#rm ${MC_IN%.nii.gz}_tmp1.txt
-#rm ${MC_IN%.nii.gz}_tmp2.txt
+# motion estimation and correction (within-run alignment), to the middle volume.
+# framewise displacement, the outliers, and whether the middle volume is one of
+# them all come from its motion parameters, so there is no separate motion
+# correction pass (fsl_motion_outliers) to find them.
+# the FD threshold is the same for REST and TASK, and is in the config file
+mcflirt -in ${MC_IN} -out ${MC_OUT} -refvol ${OrigMidVol} -mats -plots -rmsrel -rmsabs -report
+python ${CODEDIR}/runscript/motion_outliers.py --par ${MC_OUT}.par --numvol ${NUMVOL} --thresh ${FDThres} --prefix ${MC_IN%.nii.gz} --label ${FDTHRES}
+MIDVOL_NO=$(cat ${MC_IN%.nii.gz}_FinalMidVol.txt)
 
 #### NOT Fully Tested! ^^ ########
 
-# motion estimation and correction (within-run alignment)
-mcflirt -in ${MC_IN} -out ${MC_OUT} -refvol ${MIDVOL_NO} -mats -plots -rmsrel -rmsabs -report  ## need this but after the specific middle volume has been selected & applying this to that.
+if [ "${MIDVOL_NO}" -ne "${OrigMidVol}" ]; then
+    # the middle volume is an outlier, align to the volume chosen instead
+    rm -rf ${MC_OUT}.mat
+    mcflirt -in ${MC_IN} -out ${MC_OUT} -refvol ${MIDVOL_NO} -mats -plots -rmsrel -rmsabs -report
+fi
 fslroi ${MC_OUT} ${MIDVOL} ${MIDVOL_NO} 1 
 # not going to pass on any warpfiles
 ${CODEDIR}/modwrap.sh 'module load fsl/4.0.3-ncf' 'module load fsl/5.0.4-ncf' ${CODEDIR}/runscript/fm_unw.sh ${FM_SESSID} ${FMdir} ${MIDVOL} ${MIDVOL_UNWARP} ${FM_BOLDNO} ${DEST_DIR} ${WARP_DIR} ${unwarp_direction} ${ME}
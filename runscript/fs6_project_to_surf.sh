@@ -11,6 +11,8 @@ OUTPATH=$6
 scratch_base=$7
 SMOOTH=$8
 BOLD4=$9
+CODEDIR=${10}
+CACHEDIR=${11:-}
 SMOOTH_NAME=${SMOOTH/./p}
 mkdir -p $OUTPATH
 
@@ -24,6 +26,27 @@ if [ "${IPROC_SRUN:-NO}" == "YES" ] ; then
 else
     _IPROC_RUNNER=""
 fi
+
+if [ "${IPROC_SURF_ENGINE:-freesurfer}" == "numpy" ] ; then
+    # one read per input for both hemispheres, with the sampling weights
+    #built once and kept in ${CACHEDIR} for the other runs
+    SCRATCHDIR=$(mktemp --directory --tmpdir=${scratch_base})
+    $_IPROC_RUNNER python ${CODEDIR}/runscript/project_to_surface.py \
+        --input $BOLDPATH/${BOLD}.nii.gz ${BOLD} \
+        --input $BOLDPATH/${BOLD2}.nii.gz ${BOLD2} \
+        --input $BOLDPATH/${BOLD3}.nii.gz ${BOLD3} \
+        --input $BOLDPATH/${BOLD4}.nii.gz ${BOLD4} \
+        --subject $SESST \
+        --fwhm ${SMOOTH} \
+        --outdir $OUTPATH \
+        ${CACHEDIR:+--cache ${CACHEDIR}} \
+        --scratch ${SCRATCHDIR}
+    rmdir ${SCRATCHDIR}
+    echo "Output at:"
+    echo "$OUTPATH/lh.${BOLD2}_fsaverage6_sm${SMOOTH_NAME}.nii.gz"
+    exit 0
+fi
+
 #Project data
 $_IPROC_RUNNER parallel -j 4 --tmpdir=${tmpdir} <<EOF
 mri_vol2surf --mov $BOLDPATH/${BOLD}.nii.gz --regheader $SESST --hemi lh --projfrac 0.5 --trgsubject fsaverage6 --o $tmpdir/lh.${BOLD}_fsaverage6.nii --reshape --interp trilinear
@@ -48,33 +71,8 @@ mri_surf2surf --hemi lh --s fsaverage6 --sval $tmpdir/lh.${BOLD4}_fsaverage6.nii
 mri_surf2surf --hemi rh --s fsaverage6 --sval $tmpdir/rh.${BOLD4}_fsaverage6.nii --cortex --fwhm-trg ${SMOOTH} --tval $tmpdir/rh.${BOLD4}_fsaverage6_sm${SMOOTH_NAME}.nii --reshape
 EOF
 
-$_IPROC_RUNNER parallel -j 4 --tmpdir=${tmpdir} <<EOF
-gzip -f $tmpdir/lh.${BOLD}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/rh.${BOLD}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/lh.${BOLD}_fsaverage6.nii
-gzip -f $tmpdir/rh.${BOLD}_fsaverage6.nii
-EOF
-
-$_IPROC_RUNNER parallel -j 4 --tmpdir=${tmpdir} <<EOF
-gzip -f $tmpdir/lh.${BOLD2}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/rh.${BOLD2}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/lh.${BOLD2}_fsaverage6.nii
-gzip -f $tmpdir/rh.${BOLD2}_fsaverage6.nii
-EOF
-
-$_IPROC_RUNNER parallel -j 4 --tmpdir=${tmpdir} <<EOF
-gzip -f $tmpdir/lh.${BOLD3}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/rh.${BOLD3}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/lh.${BOLD3}_fsaverage6.nii
-gzip -f $tmpdir/rh.${BOLD3}_fsaverage6.nii
-EOF
-
-$_IPROC_RUNNER parallel -j 4 --tmpdir=${tmpdir} <<EOF
-gzip -f $tmpdir/lh.${BOLD4}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/rh.${BOLD4}_fsaverage6_sm${SMOOTH_NAME}.nii
-gzip -f $tmpdir/lh.${BOLD4}_fsaverage6.nii
-gzip -f $tmpdir/rh.${BOLD4}_fsaverage6.nii
-EOF
+# one process, the blocks of each file are compressed in parallel threads
+$_IPROC_RUNNER python ${CODEDIR}/runscript/compress.py $tmpdir/?h.{${BOLD},${BOLD2},${BOLD3},${BOLD4}}_fsaverage6{,_sm${SMOOTH_NAME}}.nii
 
 #rsync -av --remove-source-files ${tmpdir}/* ${OUTPATH}
 
@@ -10,6 +10,8 @@ BOLDPATH=$5
 OUTPATH=$6
 scratch_base=$7
 SMOOTH=$8
+CODEDIR=$9
+CACHEDIR=${10:-}
 SMOOTH_NAME=${SMOOTH/./p}
 mkdir -p $OUTPATH
 
@@ -25,6 +27,22 @@ if [ "${IPROC_SRUN:-NO}" == "YES" ] ; then
 else
     _IPROC_RUNNER=""
 fi
+
+if [ "${IPROC_SURF_ENGINE:-freesurfer}" == "numpy" ] ; then
+    # see fs6_project_to_surf.sh
+    SCRATCHDIR=$(mktemp --directory --tmpdir=${scratch_base})
+    $_IPROC_RUNNER python ${CODEDIR}/runscript/project_to_surface.py \
+        --input $BOLDPATH/tedana/${BOLD_TEDANA}.nii.gz ${BOLD_OUT} \
+        --input $BOLDPATH/${BOLD2}.nii.gz ${BOLD2} \
+        --subject $SESST \
+        --fwhm ${SMOOTH} \
+        --outdir $OUTPATH \
+        ${CACHEDIR:+--cache ${CACHEDIR}} \
+        --scratch ${SCRATCHDIR}
+    rmdir ${SCRATCHDIR}
+    exit 0
+fi
+
 #Project data
 $_IPROC_RUNNER parallel -j 4 --tmpdir=${OUTPATH} <<EOF
 mri_vol2surf --mov $BOLDPATH/tedana/${BOLD_TEDANA}.nii.gz --regheader $SESST --hemi lh --projfrac 0.5 --trgsubject fsaverage6 --o ${OUTPATH}/lh.${BOLD_OUT}_fsaverage6.nii.gz --reshape --interp trilinear
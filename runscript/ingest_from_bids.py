@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import logging
+import concurrent.futures
+from argparse import ArgumentParser
+import iproc.ingest as ingest
+
+'''
+
+Batched BIDS ingest, in place of one func_from_bids.py, anat_from_bids.py and
+fmap_from_bids.py (or fmap_from_bids_topup.sh) job per image. The images of
+the manifest (a session, or a subject) are ingested in parallel threads, the
+anat and func ones in-process, and the status of each one is written to the
+status file for iProc to report. Exits non-zero if any image failed.
+
+'''
+
+logger = logging.getLogger(os.path.basename(__file__))
+format="[%(asctime)s][%(levelname)s] - %(name)s - %(message)s"
+logging.basicConfig(format=format, level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="ingest the BIDS images of a manifest in one process")
+    parser.add_argument("--manifest", required=True, help="JSON manifest written by jobConstructor.ingest_from_bids_batched")
+    parser.add_argument("--status", required=True, help="JSON file to write the status of each image to")
+    parser.add_argument("--scratch", help="directory for the uncompressed outputs")
+    parser.add_argument("--threads", type=int, default=len(os.sched_getaffinity(0)), help="images ingested in parallel")
+    args = parser.parse_args()
+
+    with open(args.manifest) as fo:
+        manifest = json.load(fo)
+    if args.scratch:
+        os.makedirs(args.scratch, exist_ok=True)
+    # the images are already ingested in parallel, so each is compressed in one thread
+    with concurrent.futures.ThreadPoolExecutor(args.threads) as pool:
+        statuses = list(pool.map(lambda item: ingest.run_item(item, args.scratch, 1), manifest['items']))
+    with open(args.status, 'w') as fo:
+        json.dump(statuses, fo, indent=2)
+    failed = [s['name'] for s in statuses if s['status'] != 'ok']
+    logger.info(f'{len(statuses) - len(failed)} of {len(statuses)} images ingested')
+    if failed:
+        logger.error('failed: {}'.format(', '.join(failed)))
+        sys.exit(1)
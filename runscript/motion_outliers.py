@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import sys
+from argparse import ArgumentParser
+import numpy as np
+import iproc.motion as motion
+
+'''
+
+Framewise displacement outliers and the choice of midvol, from the .par file
+of the mcflirt run of fm_unwarp_and_mc_to_midvol.sh.
+
+This used to be fsl_motion_outliers --fd (which runs a motion correction of
+its own), a grep of "Found spikes at" from its output, bc for the 20% check,
+a grep -w loop for the midvol and create_motion_outlier_matrix.py. The files
+that were used from it are still written, under the same names:
+
+    {prefix}_FD_vals.txt                 FD of every volume
+    {prefix}_FD{label}_outlier_num.txt   outlier volumes, one per line
+    {prefix}_FD{label}_outlier_matrix.dat  one regressor per outlier
+    {prefix}_FinalMidVol.txt             the midvol to use
+
+'''
+
+def main(args):
+    par = motion.read_par(args.par, args.numvol)
+    fd = motion.framewise_displacement(par)
+    outlier_idx = motion.outliers(fd, args.thresh)
+    np.savetxt(f'{args.prefix}_FD_vals.txt', fd, fmt='%f')
+    np.savetxt(f'{args.prefix}_FD{args.label}_outlier_num.txt', outlier_idx, fmt='%d')
+    print(f'{outlier_idx.size} outliers at FD > {args.thresh}: {" ".join(str(i) for i in outlier_idx)}')
+    if outlier_idx.size >= motion.OUTLIER_WARNING * args.numvol:
+        print(f'WARNING: number of outliers ({outlier_idx.size}) is {motion.OUTLIER_WARNING:.0%} or greater than the total number of volumes ({args.numvol})')
+    motion.write_outlier_matrix(f'{args.prefix}_FD{args.label}_outlier_matrix.dat', motion.outlier_matrix(outlier_idx, args.numvol))
+    try:
+        midvol = motion.choose_midvol(args.numvol, outlier_idx)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    print(f'using {midvol} as midvol')
+    with open(f'{args.prefix}_FinalMidVol.txt', 'w') as fo:
+        fo.write(f'{midvol}\n')
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="framewise displacement outliers and midvol from mcflirt motion parameters")
+    parser.add_argument("--par", required=True, help="mcflirt .par file")
+    parser.add_argument("--numvol", required=True, type=int, help="number of volumes")
+    parser.add_argument("--thresh", required=True, type=float, help="FD threshold (mm)")
+    parser.add_argument("--prefix", required=True, help="prefix of the output files, the 4D input without .nii.gz")
+    parser.add_argument("--label", required=True, help="FD threshold as it appears in file names, e.g. 0pt4")
+    main(parser.parse_args())
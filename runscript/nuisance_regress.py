@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+import iproc.regress as regress
+
+'''
+
+Nuisance regression, in place of
+    3dTproject -ort ${NUIS_OUT} -input ${RESID_IN} -mask ${MASK} -prefix ${RESID_OUT}
+    3dAFNItoNIFTI ${RESID_OUT}*.BRIK -float
+    gzip -f ${RESID_OUT}.nii
+The residuals are written straight to NIfTI, with no BRIK/HEAD in between.
+
+'''
+
+logger = logging.getLogger(os.path.basename(__file__))
+format="[%(asctime)s][%(levelname)s] - %(name)s - %(message)s"
+logging.basicConfig(format=format, level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="project nuisance regressors out of 4D data, like 3dTproject -ort")
+    parser.add_argument("--input", required=True, help="4D data")
+    parser.add_argument("--ort", required=True, help="regressors, one row per volume")
+    parser.add_argument("--mask", required=True, help="brain mask, voxels outside it are 0 in the output")
+    parser.add_argument("--output", required=True, help="residuals, .nii.gz")
+    parser.add_argument("--scratch", help="directory for the uncompressed output")
+    parser.add_argument("--polort", type=int, default=regress.POLORT, help="order of the Legendre polynomials also projected out")
+    args = parser.parse_args()
+    regress.regress(args.input, regress.read_ort(args.ort), args.mask, args.output, args.scratch, args.polort)
+    print("wrote {}".format(args.output))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+import concurrent.futures
+from argparse import ArgumentParser
+import nibabel as nib
+import iproc.surface as surface
+
+'''
+
+Projection to fsaverage6 and smoothing, in place of, for each input and hemisphere,
+    mri_vol2surf --mov ${BOLD}.nii.gz --regheader ${SESST} --hemi ${HEMI} --projfrac 0.5 \
+        --trgsubject fsaverage6 --o ${HEMI}.${NAME}_fsaverage6.nii --reshape --interp trilinear
+    mri_surf2surf --hemi ${HEMI} --s fsaverage6 --sval ${HEMI}.${NAME}_fsaverage6.nii --cortex \
+        --fwhm-trg ${SMOOTH} --tval ${HEMI}.${NAME}_fsaverage6_sm${SMOOTH_NAME}.nii --reshape
+    gzip -f ${HEMI}.${NAME}_fsaverage6*.nii
+The sampling and smoothing matrices are built once for all inputs, and each
+input is read once for both hemispheres.
+
+'''
+
+logger = logging.getLogger(os.path.basename(__file__))
+format="[%(asctime)s][%(levelname)s] - %(name)s - %(message)s"
+logging.basicConfig(format=format, level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="project 4D volumes onto fsaverage6 and smooth them on the surface")
+    parser.add_argument("--input", nargs=2, action="append", required=True, metavar=("VOLUME", "NAME"),
+        help="4D volume, and the name of its outputs, {hemi}.{NAME}_fsaverage6.nii.gz. Can be repeated")
+    parser.add_argument("--subject", required=True, help="FreeSurfer subject the volumes share scanner coordinates with, as in --regheader")
+    parser.add_argument("--subjects-dir", default=os.environ.get("SUBJECTS_DIR"), help="default: $SUBJECTS_DIR")
+    parser.add_argument("--trgsubject", default=surface.TRGSUBJECT)
+    parser.add_argument("--projfrac", type=float, default=surface.PROJFRAC)
+    parser.add_argument("--fwhm", required=True, help="FWHM (mm) of the smoothing on the target surface")
+    parser.add_argument("--outdir", required=True)
+    parser.add_argument("--cache", help="directory to keep the sampling matrices in, to share them between runs")
+    parser.add_argument("--scratch", help="directory for the uncompressed outputs")
+    parser.add_argument("--threads", type=int, default=len(os.sched_getaffinity(0)), help="parallel compressed writes")
+    args = parser.parse_args()
+    if not args.subjects_dir:
+        parser.error("--subjects-dir or $SUBJECTS_DIR is required")
+
+    smooth_name = args.fwhm.replace('.', 'p')
+    os.makedirs(args.outdir, exist_ok=True)
+    # all inputs are on the same grid
+    img = nib.load(args.input[0][0])
+    sampling,smoothing = {},{}
+    for hemi in surface.HEMIS:
+        if args.cache:
+            sampling[hemi] = surface.cached_sampling_matrix(args.cache, args.subjects_dir, args.subject, hemi, img,
+                args.trgsubject, args.projfrac)
+        else:
+            sampling[hemi] = surface.sampling_matrix(args.subjects_dir, args.subject, hemi, img,
+                args.trgsubject, args.projfrac)
+        operator,coords,faces = surface.smoothing_operator(args.subjects_dir, hemi, args.trgsubject)
+        niters = surface.fwhm_to_niters(float(args.fwhm), coords, faces)
+        logger.info(f'{hemi}: {niters} smoothing steps for {args.fwhm}mm FWHM')
+        smoothing[hemi] = (operator, niters)
+
+    # the writes of one input overlap with the projection of the next, and
+    #are already parallel, so each is compressed in one thread
+    with concurrent.futures.ThreadPoolExecutor(args.threads) as pool:
+        futures = []
+        for volume,name in args.input:
+            logger.info(f'projecting {volume}')
+            projected = surface.project(volume, sampling)
+            for hemi,data in projected.items():
+                base = os.path.join(args.outdir, f'{hemi}.{name}_{args.trgsubject}')
+                futures.append(pool.submit(surface.write_surface, f'{base}.nii.gz', data, args.scratch, 1))
+                smoothed = surface.smooth(data, *smoothing[hemi])
+                futures.append(pool.submit(surface.write_surface, f'{base}_sm{smooth_name}.nii.gz', smoothed, args.scratch, 1))
+        for future in futures:
+            future.result()
+    print("Output at: {}".format(args.outdir))
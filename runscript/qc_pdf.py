@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+from argparse import ArgumentParser
+import iproc.qc as qc
+
+'''
+
+QC PDF from the manifest written by iproc.qc.qc_pdf_maker, in place of, for each page,
+    fslreorient2std ${INFILE} ${REORIENT}
+    fslswapdim ${REORIENT} ${SWAPDIMS} ${SWAP}
+    fslroi ${SWAP} ${ROI} ${WINDOW_DIMS}
+    slicer ${ROI} -u -S ${SAMPLE} ${WIDTH} ${SLICED}
+    convert ${SLICED} -font ${FONT} -background White -pointsize 20 label:${LABEL} +swap -gravity North-West -append ${TABLEAU}
+and then
+    convert -adjoin ${TABLEAUS} ${OUT_PDF}
+Pages are rendered in parallel and written straight into the PDF.
+
+'''
+
+logger = logging.getLogger(os.path.basename(__file__))
+format="[%(asctime)s][%(levelname)s] - %(name)s - %(message)s"
+logging.basicConfig(format=format, level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="render the pages of a QC PDF")
+    parser.add_argument("--manifest", required=True, help="JSON manifest of the PDF")
+    parser.add_argument("--processes", type=int, default=len(os.sched_getaffinity(0)), help="pages rendered in parallel")
+    args = parser.parse_args()
+
+    with open(args.manifest) as fo:
+        manifest = json.load(fo)
+    qc.write_pdf(manifest, args.processes)
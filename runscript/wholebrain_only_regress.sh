@@ -36,7 +36,7 @@ fi
 
 3dAFNItoNIFTI ${RESID_OUT}*.BRIK -float
 
-gzip -f ${RESID_OUT}*.nii
+python ${CODEDIR}/runscript/compress.py ${RESID_OUT}*.nii
 # delete the intermediates from earlier in this script
 rm -f ${RESID_OUT}*.BRIK ${RESID_OUT}*.HEAD
 rsync -av --remove-source-files ${SCRATCHDIR}/* ${OUTDIR}
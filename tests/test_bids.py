@@ -0,0 +1,54 @@
+'''
+iproc.bids Layout, against the files of a small BIDS tree
+'''
+import os
+import json
+import iproc.bids as bids
+
+def tree(root):
+    files = {
+        'ses-01/anat/sub-01_ses-01_run-001_T1w.json': {'SeriesNumber': 3},
+        'ses-01/func/sub-01_ses-01_task-rest_run-001_bold.json': {'SeriesNumber': 5},
+        'ses-01/func/sub-01_ses-01_task-rest_run-002_bold.json': {'SeriesNumber': 7},
+        'ses-01/fmap/sub-01_ses-01_dir-AP_run-001_epi.json': {'SeriesNumber': 4},
+    }
+    for name,sidecar in files.items():
+        fname = os.path.join(root, name)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname, 'w') as fo:
+            json.dump(sidecar, fo)
+        open(fname.replace('.json', '.nii.gz'), 'w').close()
+    return files
+
+def test_layout(tmp_path):
+    root = str(tmp_path / 'sub-01')
+    tree(root)
+    layout = bids.Layout(root)
+    bold = layout.query('01', 'func', suffix='bold', extension='.json')
+    assert sorted(e['run'] for _,e in bold) == ['001', '002']
+    assert all(e['task'] == 'rest' for _,e in bold)
+    nifti = os.path.join(root, 'ses-01/anat/sub-01_ses-01_run-001_T1w.nii.gz')
+    assert layout.exists(nifti)
+    assert not layout.exists(nifti.replace('run-001', 'run-002'))
+    assert layout.get_json_entity(nifti, 'SeriesNumber') == 3
+
+def test_cache(tmp_path):
+    root = str(tmp_path / 'sub-01')
+    tree(root)
+    cache = str(tmp_path / 'index.json')
+    bids.Layout(root, cache=cache, save=False)
+    assert not os.path.exists(cache)
+    bids.Layout(root, cache=cache)
+    assert os.path.exists(cache)
+    # nothing changed, nothing is listed again
+    layout = bids.Layout(root, cache=cache)
+    assert not layout._listed
+    assert layout.get_json_entity(os.path.join(root, 'ses-01/fmap/sub-01_ses-01_dir-AP_run-001_epi.json'), 'SeriesNumber') == 4
+    # a new run is seen, and only its directory is listed again
+    fname = os.path.join(root, 'ses-01/func/sub-01_ses-01_task-rest_run-003_bold.json')
+    with open(fname, 'w') as fo:
+        json.dump({'SeriesNumber': 9}, fo)
+    layout = bids.Layout(root, cache=cache)
+    assert layout._listed == {os.path.dirname(fname)}
+    assert layout.get_json_entity(fname, 'SeriesNumber') == 9
+    assert len(layout.query('01', 'func', suffix='bold')) == 5
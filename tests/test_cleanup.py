@@ -0,0 +1,138 @@
+'''
+iproc.cleanup Collector, on a temporary subject directory
+'''
+import os
+import iproc.cleanup as cleanup
+from iproc.commons import JobSpec
+
+def job(name, *args, rmfiles=None, outfiles=()):
+    return JobSpec([f'/code/runscript/{name}'] + [str(a) for a in args], 'log', list(outfiles), rmfiles)
+
+def write(path, nbytes=1000):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'\0' * nbytes)
+    return str(path)
+
+def test_reader_of_file_holds_it(tmp_path):
+    tmp = write(tmp_path / 'sub' / 'tmp.nii')
+    owner = job('owner', tmp, rmfiles=[tmp])
+    reader = job('reader', '--input', tmp)
+    collector = cleanup.Collector(str(tmp_path))
+    collector.track([owner, reader])
+    owner.state = 'COMPLETED'
+    assert collector.collect([owner, reader]) == 0
+    assert os.path.exists(tmp)
+    reader.state = 'RUNNING'
+    collector.collect([owner, reader])
+    assert os.path.exists(tmp)
+    reader.state = 'COMPLETED'
+    assert collector.collect([owner, reader]) == 1000
+    assert not os.path.exists(tmp)
+
+def test_reader_of_directory_above_holds_it(tmp_path):
+    workdir = tmp_path / 'work'
+    tmp = write(workdir / 'run1' / 'tmp.nii')
+    owner = job('owner', rmfiles=tmp)
+    # names the directory, and a space-joined list in one argument
+    reader = job('reader', f'{workdir} {tmp_path}/other')
+    collector = cleanup.Collector(str(tmp_path))
+    collector.track([owner, reader])
+    owner.state = 'COMPLETED'
+    collector.collect([owner, reader])
+    assert os.path.exists(tmp)
+    reader.state = 'COMPLETED'
+    collector.collect([owner, reader])
+    assert not os.path.exists(tmp)
+
+def test_directory_rmfile(tmp_path):
+    workdir = tmp_path / 'work'
+    write(workdir / 'a' / 'b.nii', 300)
+    write(workdir / 'c.nii', 200)
+    owner = job('owner', rmfiles=[str(workdir) + os.sep])
+    collector = cleanup.Collector(str(tmp_path))
+    collector.track([owner])
+    owner.state = 'COMPLETED'
+    assert collector.collect([owner]) == 500
+    assert not workdir.exists()
+
+def test_glob_waits_for_every_matching_reader(tmp_path):
+    tmps = [write(tmp_path / f'vol{i}.nii') for i in range(3)]
+    keep = write(tmp_path / 'keep.nii')
+    owner = job('owner', rmfiles=[str(tmp_path / 'vol*.nii')])
+    readers = [job('reader', tmp) for tmp in tmps[:2]]
+    other = job('other', keep)
+    jobs = [owner, other] + readers
+    collector = cleanup.Collector(str(tmp_path))
+    collector.track(jobs)
+    owner.state = other.state = 'COMPLETED'
+    readers[0].state = 'COMPLETED'
+    collector.collect(jobs)
+    assert all(os.path.exists(tmp) for tmp in tmps)
+    readers[1].state = 'FAILED'
+    collector.collect(jobs)
+    assert all(os.path.exists(tmp) for tmp in tmps)
+    readers[1].state = 'COMPLETED'
+    assert collector.collect(jobs) == 3000
+    assert not any(os.path.exists(tmp) for tmp in tmps)
+    assert os.path.exists(keep)
+
+def test_skipped_job_releases(tmp_path):
+    tmp = write(tmp_path / 'tmp.nii')
+    owner = job('owner', tmp, rmfiles=[tmp])
+    owner.skip = True
+    collector = cleanup.Collector(str(tmp_path))
+    collector.track([owner])
+    assert collector.collect([owner]) == 1000
+    assert not os.path.exists(tmp)
+
+def test_failed_job_keeps(tmp_path):
+    tmp = write(tmp_path / 'tmp.nii')
+    owner = job('owner', rmfiles=[tmp])
+    collector = cleanup.Collector(str(tmp_path))
+    collector.track([owner])
+    owner.state = 'FAILED'
+    assert collector.collect([owner]) == 0
+    assert os.path.exists(tmp)
+
+def test_no_remove(tmp_path):
+    tmp = write(tmp_path / 'tmp.nii')
+    owner = job('owner', rmfiles=[tmp])
+    collector = cleanup.Collector(str(tmp_path), remove=False)
+    collector.track([owner])
+    owner.state = 'COMPLETED'
+    assert collector.collect([owner]) == 0
+    assert os.path.exists(tmp)
+
+def test_hold(tmp_path):
+    write(tmp_path / 'existing', 4000)
+    collector = cleanup.Collector(str(tmp_path), quota=cleanup.parse_size('10K'))
+    first = job('step', outfiles=[str(tmp_path / 'out1')])
+    # nothing known about what the step writes yet
+    assert not collector.hold(first)
+    collector.submitted(first)
+    write(tmp_path / 'out1', 4000)
+    first.state = 'COMPLETED'
+    collector.collect([first])
+    assert collector.live == 8000
+    # 8000 live and 4000 more, estimated from the first job of the step
+    second = job('step', outfiles=[str(tmp_path / 'out2')])
+    assert collector.hold(second)
+    assert not collector.hold(job('other'))
+    # the job of another step that is still running counts against it
+    collector.submitted(job('step'))
+    assert collector.hold(job('other'))
+    assert not cleanup.Collector(str(tmp_path)).hold(second)
+
+def test_hold_after_freeing(tmp_path):
+    tmp = write(tmp_path / 'tmp', 6000)
+    collector = cleanup.Collector(str(tmp_path), quota=10000)
+    owner = job('step', outfiles=[str(tmp_path / 'out')], rmfiles=[tmp])
+    collector.track([owner])
+    collector.submitted(owner)
+    assert collector.live == 6000
+    write(tmp_path / 'out', 3000)
+    owner.state = 'COMPLETED'
+    collector.collect([owner])
+    # the 3000 written, minus the 6000 freed
+    assert collector.live == 3000
+    assert not collector.hold(job('step'))
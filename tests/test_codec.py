@@ -0,0 +1,54 @@
+'''
+iproc.codec round trips
+'''
+import os
+import gzip
+import numpy as np
+import nibabel as nib
+import pytest
+import iproc.codec as codec
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    for variable in codec.ENVIRONMENT.values():
+        monkeypatch.delenv(variable, raising=False)
+
+@pytest.mark.parametrize('nthreads', [1, 3])
+def test_compress_round_trip(tmp_path, monkeypatch, nthreads):
+    # small blocks, so the file is many gzip members
+    monkeypatch.setattr(codec, 'BLOCK_SIZE', 1000)
+    content = np.random.default_rng(0).integers(0, 8, 25000, dtype=np.uint8).tobytes()
+    src = tmp_path / 'data.bin'
+    src.write_bytes(content)
+    dst = codec.compress(str(src), nthreads=nthreads, gzip_level=1)
+    assert dst == str(src) + '.gz'
+    assert not src.exists()
+    with gzip.open(dst, 'rb') as fo:
+        assert fo.read() == content
+
+def test_empty_file(tmp_path):
+    src = tmp_path / 'empty'
+    src.write_bytes(b'')
+    with gzip.open(codec.compress(str(src)), 'rb') as fo:
+        assert fo.read() == b''
+
+def test_store_nifti(tmp_path, monkeypatch):
+    monkeypatch.setattr(codec, 'BLOCK_SIZE', 4096)
+    data = np.random.default_rng(1).standard_normal((8, 7, 6, 5)).astype(np.float32)
+    for dst in ['out.nii.gz', 'out.nii']:
+        src = str(tmp_path / 'tmp.nii')
+        nib.save(nib.Nifti1Image(data, np.eye(4)), src)
+        codec.store(src, str(tmp_path / dst), intermediate=True)
+        assert not os.path.exists(src)
+        np.testing.assert_array_equal(np.asanyarray(nib.load(str(tmp_path / dst)).dataobj), data)
+
+def test_settings(monkeypatch):
+    assert codec.level() == codec.GZIP_LEVEL
+    assert codec.level(intermediate=True) == codec.INTERMEDIATE_GZIP_LEVEL
+    assert codec.intermediate('x') == 'x.nii.gz'
+    monkeypatch.setenv('IPROC_INTERMEDIATE_FORMAT', 'nii')
+    assert codec.intermediate('x') == 'x.nii'
+    assert codec.fsloutputtype() == 'NIFTI'
+    monkeypatch.setenv('IPROC_GZIP_LEVEL', '12')
+    with pytest.raises(ValueError):
+        codec.level()
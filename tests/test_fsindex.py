@@ -0,0 +1,62 @@
+'''
+iproc.fsindex FileIndex, against os.path.exists
+'''
+import os
+import iproc.fsindex as fsindex
+
+def test_exists(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'file').write_text('')
+    os.symlink(tmp_path / 'a' / 'file', tmp_path / 'a' / 'link')
+    os.symlink(tmp_path / 'a' / 'gone', tmp_path / 'a' / 'dangling')
+    index = fsindex.FileIndex()
+    for name in ['file', 'link', 'dangling', 'nothing']:
+        path = str(tmp_path / 'a' / name)
+        assert index.exists(path) == os.path.exists(path), name
+    # a directory that does not exist, or is a file
+    assert not index.exists(str(tmp_path / 'missing' / 'file'))
+    assert not index.exists(str(tmp_path / 'a' / 'file' / 'below'))
+    assert index.exists(str(tmp_path / 'a') + os.sep)
+
+def test_listing_is_kept_until_clear(tmp_path):
+    index = fsindex.FileIndex()
+    path = tmp_path / 'new'
+    assert not index.exists(str(path))
+    assert not index.exists(str(tmp_path / 'missing' / 'new'))
+    path.write_text('')
+    (tmp_path / 'missing').mkdir()
+    (tmp_path / 'missing' / 'new').write_text('')
+    # the listings are stale until clear()
+    assert not index.exists(str(path))
+    assert not index.exists(str(tmp_path / 'missing' / 'new'))
+    assert not index.empty()
+    index.clear()
+    assert index.empty()
+    assert index.exists(str(path))
+    assert index.exists(str(tmp_path / 'missing' / 'new'))
+
+def test_prefetch(tmp_path):
+    paths = [tmp_path / d / 'f' for d in ('a', 'b', 'c')]
+    for path in paths[:2]:
+        path.parent.mkdir()
+        path.write_text('')
+    index = fsindex.FileIndex(threads=2)
+    index.prefetch([str(p) for p in paths])
+    assert set(index._listings) == {str(p.parent) for p in paths}
+    assert index._listings[str(paths[2].parent)] is None
+    assert [index.exists(str(p)) for p in paths] == [True, True, False]
+
+def test_prefetch_tree_depth(tmp_path):
+    deep = tmp_path / 'l1' / 'l2' / 'l3'
+    deep.mkdir(parents=True)
+    (deep / 'f').write_text('')
+    os.symlink(tmp_path / 'l1', tmp_path / 'loop')
+    index = fsindex.FileIndex()
+    index.prefetch_tree([str(tmp_path)], depth=2)
+    # the root and two levels below it, symlinked directories are not followed
+    assert set(index._listings) == {str(tmp_path), str(tmp_path / 'l1'), str(tmp_path / 'l1' / 'l2')}
+    index.clear()
+    index.prefetch_tree([str(tmp_path), None], depth=5)
+    assert str(deep) in index._listings
+    assert str(tmp_path / 'loop') not in index._listings
+    assert index.exists(str(deep / 'f'))
@@ -0,0 +1,44 @@
+'''
+iproc.ingest conversions, against nibabel
+'''
+import numpy as np
+import nibabel as nib
+import pytest
+import iproc.ingest as ingest
+
+def image(tmp_path, name, shape, affine, scaled=True):
+    data = np.random.default_rng(len(shape)).integers(0, 500, shape).astype(np.int16)
+    img = nib.Nifti1Image(data, affine)
+    img.set_sform(affine, 1)
+    img.set_qform(affine, 1)
+    if scaled:
+        img.header.set_slope_inter(0.5, 2)
+    fname = str(tmp_path / name)
+    nib.save(img, fname)
+    return fname
+
+@pytest.mark.parametrize('output', ['out.nii', 'out.nii.gz'])
+def test_to_float_3d(tmp_path, output):
+    fname = image(tmp_path, 'anat.nii.gz', (6, 5, 4), np.diag([-1.0, 1, 1, 1]))
+    out = ingest.to_float(fname, str(tmp_path / output), scratch=str(tmp_path), nthreads=1)
+    img = nib.load(out)
+    assert img.shape == (6, 5, 4)
+    assert img.get_data_dtype() == np.float32
+    np.testing.assert_allclose(img.get_fdata(), nib.load(fname).get_fdata())
+    np.testing.assert_array_equal(img.affine, nib.load(fname).affine)
+
+def test_to_float_skip(tmp_path):
+    fname = image(tmp_path, 'bold.nii.gz', (6, 5, 4, 10), np.diag([-1.0, 1, 1, 1]))
+    out = ingest.to_float(fname, str(tmp_path / 'out.nii.gz'), skip=2, numvol=5, scratch=str(tmp_path))
+    np.testing.assert_allclose(nib.load(out).get_fdata(), nib.load(fname).get_fdata()[...,2:7])
+
+def test_to_float_radiological(tmp_path):
+    # neurological storage, the header is swapped and the data is left alone
+    fname = image(tmp_path, 'bold.nii.gz', (6, 5, 4, 3), np.eye(4), scaled=False)
+    out = ingest.to_float(fname, str(tmp_path / 'out.nii.gz'), radiological=True, scratch=str(tmp_path))
+    img = nib.load(out)
+    assert ingest.is_radiological(img.header)
+    np.testing.assert_allclose(img.get_fdata(), nib.load(fname).get_fdata())
+    expected = np.eye(4)
+    expected[0,0],expected[0,3] = -1,5
+    np.testing.assert_allclose(img.affine, expected)
@@ -0,0 +1,36 @@
+'''
+iproc.ledger handoffs, stages and releases
+'''
+import pytest
+import iproc.ledger as ledger
+from iproc.commons import JobSpec
+
+@pytest.fixture
+def db(tmp_path):
+    return ledger.ArtifactLedger(str(tmp_path / 'artifacts.sqlite'))
+
+def job(name, rmfiles, run=None):
+    return JobSpec([f'/code/runscript/{name}'], 'log', [], rmfiles, run=run)
+
+def test_handoff(db):
+    db.set_handoff('stage1', 'bbreg', 'S1', 3, ['a', 'b'])
+    assert db.get_handoff('bbreg', 'S1', '3') == ['a', 'b']
+    db.set_handoff('stage1', 'bbreg', 'S1', 3, 'c')
+    assert db.get_handoff('bbreg', 'S1', 3) == ['c']
+    assert db.get_handoff('bbreg', 'S2', 3) == []
+
+def test_stage_without_handoffs(db):
+    assert not db.has_stage('stage1')
+    db.set_handoff('stage1', 'bbreg', None, None, [])
+    assert db.has_stage('stage1')
+    assert db.get_handoff('bbreg', None, None) == []
+    db.mark_stage('stage2')
+    assert db.has_stage('stage2')
+
+def test_releases_are_pruned(db):
+    db.release('stage1', [job('a.sh', ['x', 'y'], run=('S1', 1)), job('b.sh', ['y', 'z'])])
+    assert db.releasable('stage1') == ['x', 'y', 'z']
+    db.prune_releases('stage1', ['x', 'y', 'z'])
+    assert db.releasable('stage1') == []
+    db.release('stage1', [job('a.sh', ['w'])])
+    assert db.releasable('stage1') == ['w']
@@ -0,0 +1,121 @@
+'''
+iproc.executors.local scheduling, with small sh -c jobs
+'''
+import time
+import pytest
+import iproc.commons as commons
+import iproc.executors.local as local
+from iproc.commons import JobSpec
+
+MB = 1024 ** 2
+
+@pytest.fixture
+def pool(monkeypatch):
+    # the core ids are made up, so nothing is pinned
+    monkeypatch.setattr(local.os, 'sched_setaffinity', lambda pid, cores: None, raising=False)
+    p = local.Pool(cores=[0, 1], mem=1000 * MB)
+    monkeypatch.setattr(local, '_pool', p)
+    yield p
+    p.cancel([job_id for job_id,task in p.tasks.items() if task.state in ('PENDING', 'RUNNING')])
+
+def job(tmp_path, name, script):
+    return JobSpec(['sh', '-c', script], str(tmp_path / name), [])
+
+def settle(pool, job_ids, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pool.schedule()
+        if all(pool.tasks[j].state not in ('PENDING', 'RUNNING') for j in job_ids):
+            return [pool.tasks[j].state for j in job_ids]
+        time.sleep(0.02)
+    raise AssertionError(f'jobs {job_ids} did not finish')
+
+def test_afterok(pool, tmp_path):
+    order = tmp_path / 'order'
+    first = local.submit(job(tmp_path, 'first', f'sleep 0.3; echo first >> {order}'))
+    second = local.submit(job(tmp_path, 'second', f'echo second >> {order}'), parent=first)
+    assert pool.tasks[second].state == 'PENDING'
+    assert settle(pool, [first, second]) == ['COMPLETED', 'COMPLETED']
+    assert order.read_text().split() == ['first', 'second']
+
+def test_failed_parent_cancels(pool, tmp_path):
+    marker = tmp_path / 'ran'
+    parent = local.submit(job(tmp_path, 'parent', 'exit 3'))
+    child = local.submit(job(tmp_path, 'child', f'touch {marker}'), parent=parent)
+    grandchild = local.submit(job(tmp_path, 'grandchild', f'touch {marker}'), parent=child)
+    assert settle(pool, [parent, child, grandchild]) == ['FAILED', 'CANCELLED', 'CANCELLED']
+    assert not marker.exists()
+
+def test_cpu_admission(pool, tmp_path):
+    both = local.submit(job(tmp_path, 'both', 'sleep 0.3'), cpu=2)
+    one = local.submit(job(tmp_path, 'one', 'true'), cpu=1)
+    assert pool.tasks[both].state == 'RUNNING'
+    assert pool.tasks[both].cores == [0, 1]
+    assert pool.tasks[one].state == 'PENDING'
+    assert settle(pool, [both, one]) == ['COMPLETED', 'COMPLETED']
+    assert pool.tasks[one].start >= pool.tasks[both].end
+    assert pool.free_cores == [0, 1] and pool.free_mem == 1000 * MB
+
+def test_mem_admission(pool, tmp_path):
+    first = local.submit(job(tmp_path, 'first', 'sleep 0.3'), mem='600M')
+    second = local.submit(job(tmp_path, 'second', 'true'), mem='600M')
+    third = local.submit(job(tmp_path, 'third', 'sleep 0.1'), mem='300M')
+    assert pool.tasks[second].state == 'PENDING'
+    assert pool.tasks[third].state == 'RUNNING'
+    assert settle(pool, [first, second, third]) == ['COMPLETED'] * 3
+    assert pool.tasks[second].start >= pool.tasks[first].end
+
+def test_oversized_runs_alone(pool, tmp_path):
+    small = local.submit(job(tmp_path, 'small', 'sleep 0.3'))
+    big = local.submit(job(tmp_path, 'big', 'sleep 0.1'), cpu=4, mem='2GB')
+    assert pool.tasks[big].state == 'PENDING'
+    assert settle(pool, [small, big]) == ['COMPLETED', 'COMPLETED']
+    assert pool.tasks[big].start >= pool.tasks[small].end
+    # it gets every core there is, and nothing starts beside it
+    assert pool.tasks[big].cores == [0, 1]
+    big = local.submit(job(tmp_path, 'big', 'sleep 0.3'), cpu=4)
+    small = local.submit(job(tmp_path, 'small', 'true'))
+    assert pool.tasks[big].state == 'RUNNING'
+    assert pool.tasks[small].state == 'PENDING'
+    settle(pool, [big, small])
+
+def poll_until(jobs, cancel_on_fail, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        count = local.poll_count(jobs, cancel_on_fail)
+        if count == len(jobs):
+            return count
+        time.sleep(0.02)
+    raise AssertionError('jobs did not finish')
+
+def test_poll_count_cancel_on_fail(pool, tmp_path):
+    jobs = {}
+    for name,script in [('fails', 'exit 1'), ('slow', 'sleep 5')]:
+        j = job(tmp_path, name, script)
+        jobs[local.submit(j)] = j
+    with pytest.raises(commons.FailedJobError):
+        poll_until(jobs, cancel_on_fail=True)
+    assert [j.state for j in jobs.values()] == ['FAILED', 'RUNNING']
+    # the autocancel got the job that was still running
+    assert [t.state for t in pool.tasks.values()] == ['FAILED', 'CANCELLED']
+
+def test_poll_count_keep_going(pool, tmp_path):
+    jobs = {}
+    parent = None
+    for name,script in [('fails', 'exit 1'), ('dependent', 'true'), ('other', 'sleep 0.2')]:
+        j = job(tmp_path, name, script)
+        job_id = local.submit(j, parent=parent if name == 'dependent' else None)
+        jobs[job_id] = j
+        parent = job_id
+    assert poll_until(jobs, cancel_on_fail=False) == 3
+    assert [j.state for j in jobs.values()] == ['FAILED', 'CANCELLED', 'COMPLETED']
+
+def test_skipped_and_dummy(pool, tmp_path):
+    skipped = job(tmp_path, 'skipped', 'true')
+    skipped.skip = True
+    assert local.submit(skipped) is commons.skipped_job
+    dummy = job(tmp_path, 'dummy', 'exit 1')
+    dummy.dummy = True
+    job_id = local.submit(dummy)
+    assert job_id.startswith('dummy_') and not pool.tasks
+    assert local.poll_count({job_id: dummy}) == 1
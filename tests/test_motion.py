@@ -0,0 +1,31 @@
+'''
+iproc.motion against a straightforward reimplementation of
+fsl_motion_outliers --fd
+'''
+import numpy as np
+import pytest
+import iproc.motion as motion
+
+def test_framewise_displacement(tmp_path):
+    rng = np.random.default_rng(3)
+    par = rng.standard_normal((30, 6)) * [0.01, 0.01, 0.01, 0.3, 0.3, 0.3]
+    fname = str(tmp_path / 'mc.par')
+    np.savetxt(fname, np.vstack([np.zeros((2, 6)), par]))
+    par = motion.read_par(fname, numvol=30)
+    expected = [0.0]
+    for prev,row in zip(par[:-1], par[1:]):
+        rot,trans = np.abs(row[:3] - prev[:3]),np.abs(row[3:] - prev[3:])
+        expected.append(50.0 * rot.sum() + trans.sum())
+    fd = motion.framewise_displacement(par)
+    np.testing.assert_allclose(fd, expected)
+    idx = motion.outliers(fd, 0.5)
+    assert list(idx) == [i for i,v in enumerate(expected) if v > 0.5]
+
+def test_outlier_matrix_and_midvol():
+    matrix = motion.outlier_matrix([3, 7, 12], 10)
+    assert matrix.shape == (10, 2)
+    assert matrix[3,0] == 1 and matrix[7,1] == 1 and matrix.sum() == 2
+    assert motion.choose_midvol(10, []) == 5
+    assert motion.choose_midvol(10, [5, 6]) == 7
+    with pytest.raises(ValueError):
+        motion.choose_midvol(10, range(5, 10))
@@ -0,0 +1,56 @@
+'''
+iproc.nuisance against straightforward reimplementations of fslmeants and
+the MATLAB 36P recipe
+'''
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy.signal import detrend
+import iproc.nuisance as nuisance
+
+SHAPE = (5, 4, 3)
+
+@pytest.fixture
+def run(tmp_path):
+    rng = np.random.default_rng(1)
+    data = rng.integers(0, 1000, SHAPE + (40,)).astype(np.int16)
+    img = nib.Nifti1Image(data, np.eye(4))
+    # scaled on disk, as the scanner writes it
+    img.header.set_slope_inter(0.5, 10)
+    fname = str(tmp_path / 'bold.nii.gz')
+    nib.save(img, fname)
+    masks = []
+    for i,region in enumerate([np.s_[:2], np.s_[2:], np.s_[1:4,1:3,1:2]]):
+        mask = np.zeros(SHAPE, dtype=np.uint8)
+        mask[region] = 1
+        masks.append(str(tmp_path / f'mask{i}.nii.gz'))
+        nib.save(nib.Nifti1Image(mask, np.eye(4)), masks[-1])
+    return fname, masks
+
+def test_iter_volumes(run):
+    fname,_ = run
+    expected = nib.load(fname).get_fdata().reshape(-1, 40, order='F')
+    for start,data in nuisance.iter_volumes(fname, chunk=7):
+        np.testing.assert_allclose(data, expected[:,start:start + data.shape[1]])
+
+def test_mask_means(run):
+    fname,masks = run
+    data = nib.load(fname).get_fdata()
+    expected = np.column_stack([data[nib.load(m).get_fdata() > 0].mean(axis=0) for m in masks])
+    np.testing.assert_allclose(nuisance.mask_means(fname, masks, chunk=16), expected, rtol=1e-6)
+
+def test_regressors_36p():
+    rng = np.random.default_rng(2)
+    nuis_ts = rng.standard_normal((60, 9)).cumsum(axis=0)
+    x = detrend(nuis_ts, axis=0)
+    x = (x - x.mean(axis=0)) / x.std(axis=0, ddof=1)
+    xx = np.vstack([np.zeros((1, 9)), np.diff(x, axis=0)])
+    expected = np.hstack([x, xx, x ** 2, xx ** 2])
+    np.testing.assert_allclose(nuisance.regressors_36p(nuis_ts), expected, atol=1e-12)
+
+def test_batch_regressors_36p():
+    rng = np.random.default_rng(4)
+    nuis_ts = rng.standard_normal((60, 9)).cumsum(axis=0)
+    runs = [nuis_ts, nuis_ts[:50], 2 * nuis_ts]
+    for batched,single in zip(nuisance.batch_regressors_36p(runs), runs):
+        np.testing.assert_allclose(batched, nuisance.regressors_36p(single), atol=1e-12)
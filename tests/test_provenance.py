@@ -0,0 +1,63 @@
+'''
+iproc.provenance rerun decisions
+'''
+import os
+import pytest
+import iproc.config as config
+import iproc.provenance as provenance
+from iproc.commons import JobSpec
+
+@pytest.fixture
+def prov(tmp_path):
+    codedir = tmp_path / 'code'
+    (codedir / 'runscript').mkdir(parents=True)
+    (codedir / 'runscript' / 'step.sh').write_text('#!/bin/bash\n')
+    cfg = tmp_path / 'subject.cfg'
+    cfg.write_text(f'[iproc]\nCODEDIR = {codedir}\n[template]\nFD_THRESH = 0.2\n')
+    conf = config.Config()
+    conf.parse(str(cfg))
+    return provenance.Provenance(str(tmp_path / 'provenance'), conf)
+
+def run(prov, tmp_path, cmd, rmfiles=None):
+    outfile = str(tmp_path / 'out.nii.gz')
+    job = JobSpec(cmd, 'log', [outfile], rmfiles)
+    # wrappers are prepended after the job is built
+    job.prepend_cmd(['notify_exit.sh', str(tmp_path / 'sentinel-1234')])
+    prov.started(job)
+    with open(outfile, 'w') as fo:
+        fo.write('out')
+    prov.completed(job)
+    return outfile
+
+def step(tmp_path, *args):
+    return [str(tmp_path / 'code' / 'runscript' / 'step.sh')] + list(args)
+
+def test_command_line(prov, tmp_path):
+    outfile = run(prov, tmp_path, step(tmp_path, '--skip', '4', '--num-vol', '120'))
+    assert prov.check([outfile]) == (True, None)
+    assert prov.check([outfile], cmd=step(tmp_path, '--skip', '4', '--num-vol', '120'))[0]
+    current,reason = prov.check([outfile], cmd=step(tmp_path, '--skip', '6', '--num-vol', '120'))
+    assert not current
+    assert 'command line' in reason
+
+def test_rmfiles_are_not_the_command(prov, tmp_path):
+    rmfiles = ['a.nii.gz', 'b.nii.gz']
+    outfile = run(prov, tmp_path, step(tmp_path, 'x') + [' '.join(rmfiles)], rmfiles)
+    assert prov.check([outfile], cmd=step(tmp_path, 'x'))[0]
+
+def test_config_and_scripts(prov, tmp_path):
+    outfile = run(prov, tmp_path, step(tmp_path, '0.2'))
+    assert prov.check([outfile])[0]
+    prov.conf.set('template', 'FD_THRESH', '0.3')
+    assert not prov.check([outfile])[0]
+    prov.conf.set('template', 'FD_THRESH', '0.2')
+    prov._md5.clear()
+    with open(tmp_path / 'code' / 'runscript' / 'step.sh', 'a') as fo:
+        fo.write('echo\n')
+    assert not prov.check([outfile])[0]
+
+def test_started_is_not_current(prov, tmp_path):
+    outfile = str(tmp_path / 'out.nii.gz')
+    job = JobSpec(step(tmp_path), 'log', [outfile])
+    prov.started(job)
+    assert not prov.check([outfile])[0]
@@ -0,0 +1,79 @@
+'''
+iproc.qc middle volume extraction and windows, against nibabel
+'''
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+import iproc.qc as qc
+
+SHAPE = (9, 8, 7)
+
+def image(tmp_path, name, numvol, affine=None, scaled=False):
+    data = np.random.default_rng(numvol).integers(0, 500, SHAPE + (numvol,)[:1 if numvol else 0])
+    if scaled:
+        img = nib.Nifti1Image(data.astype(np.int16), np.eye(4) if affine is None else affine)
+        img.header.set_slope_inter(0.25, -3)
+    else:
+        img = nib.Nifti1Image(data.astype(np.float32), np.eye(4) if affine is None else affine)
+    fname = str(tmp_path / name)
+    nib.save(img, fname)
+    return fname
+
+def test_midvol():
+    assert qc.midvol(nib.Nifti1Image(np.zeros(SHAPE), np.eye(4))) == 0
+    assert qc.midvol(nib.Nifti1Image(np.zeros(SHAPE + (7,)), np.eye(4))) == 3
+    assert qc.midvol(nib.Nifti1Image(np.zeros(SHAPE + (8,)), np.eye(4))) == 4
+
+@pytest.mark.parametrize('name', ['bold.nii', 'bold.nii.gz'])
+@pytest.mark.parametrize('scaled', [False, True])
+def test_read_volume(tmp_path, name, scaled):
+    fname = image(tmp_path, name, 11, scaled=scaled)
+    expected = nib.load(fname).get_fdata()
+    data,affine = qc.read_volume(fname, cache=str(tmp_path / 'cache'))
+    np.testing.assert_allclose(data, expected[...,5], rtol=1e-6)
+    np.testing.assert_array_equal(affine, nib.load(fname).affine)
+    data,_ = qc.read_volume(fname, volume=2)
+    np.testing.assert_allclose(data, expected[...,2], rtol=1e-6)
+
+def test_thumbnail(tmp_path):
+    cache = str(tmp_path / 'cache')
+    anat = image(tmp_path, 'anat.nii.gz', 0)
+    assert qc.thumbnail(anat, cache) == anat
+    bold = image(tmp_path, 'bold.nii.gz', 6)
+    cached = qc.thumbnail(bold, cache)
+    np.testing.assert_allclose(nib.load(cached).get_fdata(), nib.load(bold).get_fdata()[...,3])
+    assert qc.thumbnail(bold, cache) == cached
+
+def test_stale_thumbnail_replaced(tmp_path):
+    cache = str(tmp_path / 'cache')
+    bold = image(tmp_path, 'bold.nii.gz', 6)
+    other = qc.thumbnail(image(tmp_path, 'other.nii.gz', 4), cache)
+    cached = qc.thumbnail(bold, cache)
+    image(tmp_path, 'bold.nii.gz', 8)
+    replaced = qc.thumbnail(bold, cache)
+    assert replaced != cached
+    assert not os.path.exists(cached)
+    assert os.path.exists(other)
+    np.testing.assert_allclose(nib.load(replaced).get_fdata(), nib.load(bold).get_fdata()[...,4])
+
+@pytest.mark.parametrize('affine', [
+    np.eye(4),
+    np.diag([-2.0, 2.0, 2.0, 1.0]),
+    np.array([[0, 0, 2.0, 0], [-2.0, 0, 0, 0], [0, 2.0, 0, 0], [0, 0, 0, 1]]),
+])
+def test_read_window(tmp_path, affine):
+    fname = image(tmp_path, 'bold.nii.gz', 5, affine=affine)
+    img = nib.load(fname)
+    swapdims = ['-x', 'z', 'y']
+    window = [1, 5, 0, 4, 2, 3]
+    # fslreorient2std, fslswapdim, then fslroi, on the whole volume
+    ornt = nib.orientations.ornt_transform(nib.orientations.io_orientation(img.affine),
+                                           nib.orientations.axcodes2ornt(qc.STD_AXCODES))
+    std = nib.orientations.apply_orientation(img.get_fdata()[...,2], ornt)
+    swapped = std.transpose([qc.AXES[d.lstrip('-')] for d in swapdims])
+    for axis,dim in enumerate(swapdims):
+        if dim.startswith('-'):
+            swapped = np.flip(swapped, axis)
+    expected = swapped[1:6,0:4,2:5]
+    np.testing.assert_allclose(qc.read_window(fname, swapdims, window), expected)
@@ -0,0 +1,103 @@
+'''
+iproc.regress against numpy.linalg.lstsq, and against a bandpass whose
+result is known exactly
+'''
+import numpy as np
+import nibabel as nib
+import pytest
+import iproc.regress as regress
+
+SHAPE = (6, 5, 4)
+TR = 2.0
+
+def save(fname, data, tr=TR):
+    img = nib.Nifti1Image(data.astype(np.float32), np.diag([2.0, 2.0, 2.0, 1.0]))
+    img.header.set_zooms((2.0, 2.0, 2.0, tr)[:data.ndim])
+    img.header.set_xyzt_units('mm', 'sec')
+    nib.save(img, fname)
+    return fname
+
+@pytest.fixture
+def run(tmp_path):
+    rng = np.random.default_rng(0)
+    numvol = 100
+    ort = rng.standard_normal((numvol, 5))
+    # a spike regressor twice, as the censor columns can be
+    spike = np.zeros((numvol, 1))
+    spike[40] = 1
+    ort = np.hstack([ort, spike, spike])
+    X = regress.design(ort, numvol)
+    beta = rng.standard_normal((X.shape[1],) + SHAPE)
+    data = np.tensordot(X, beta, axes=1) + rng.standard_normal((numvol,) + SHAPE)
+    data = np.moveaxis(data, 0, -1) + 100
+    mask = np.zeros(SHAPE)
+    mask[1:5,1:4,1:3] = 1
+    wb_mask = np.zeros(SHAPE)
+    wb_mask[2:6,2:5,:] = 1
+    return dict(
+        data=data, ort=ort, mask=mask, wb_mask=wb_mask,
+        in_fname=save(str(tmp_path / 'in.nii.gz'), data),
+        mask_fname=save(str(tmp_path / 'mask.nii.gz'), mask),
+        wb_mask_fname=save(str(tmp_path / 'wb_mask.nii.gz'), wb_mask),
+    )
+
+def lstsq_residuals(X, Y):
+    beta = np.linalg.lstsq(X, Y, rcond=None)[0]
+    return Y - X @ beta
+
+def masked(data, mask):
+    return data[mask > 0].T
+
+def test_legendre():
+    P = regress.legendre(50)
+    x = np.linspace(-1, 1, 50)
+    np.testing.assert_allclose(P, np.column_stack([np.ones(50), x, (3 * x ** 2 - 1) / 2]))
+
+def test_regress(run, tmp_path):
+    out = str(tmp_path / 'resid.nii.gz')
+    regress.regress(run['in_fname'], run['ort'], run['mask_fname'], out, scratch=str(tmp_path))
+    result = np.asanyarray(nib.load(out).dataobj)
+    Y = masked(np.asanyarray(nib.load(run['in_fname']).dataobj, dtype=np.float64), run['mask'])
+    expected = lstsq_residuals(regress.design(run['ort'], Y.shape[0]), Y)
+    np.testing.assert_allclose(masked(result, run['mask']), expected, atol=1e-4)
+    assert not result[run['mask'] == 0].any()
+
+def test_bandpass_keeps_the_band():
+    numvol = 100
+    t = np.arange(numvol) * TR
+    # whole cycles over the run, so the spectrum has no leakage
+    inside = np.sin(2 * np.pi * 0.05 * t)
+    below = np.cos(2 * np.pi * 0.005 * t)
+    above = np.sin(2 * np.pi * 0.15 * t)
+    Y = np.column_stack([inside + below + above, above, 2 * inside]).astype(np.float32)
+    regress.bandpass(Y, TR, threads=1)
+    np.testing.assert_allclose(Y, np.column_stack([inside, np.zeros(numvol), 2 * inside]), atol=1e-5)
+
+def test_repetition_time(tmp_path):
+    img = nib.load(save(str(tmp_path / 'tr.nii'), np.zeros(SHAPE + (3,)), tr=2000))
+    img.header.set_xyzt_units('mm', 'msec')
+    assert regress.repetition_time(img) == 2.0
+
+def test_denoise(run, tmp_path):
+    resid_out = str(tmp_path / 'resid.nii.gz')
+    bpss_out = str(tmp_path / 'bpss.nii.gz')
+    wbonly_out = str(tmp_path / 'wbonly.nii.gz')
+    wb_ort = run['ort'][:,-1:]
+    wb_ts = regress.denoise(run['in_fname'], run['mask_fname'], run['ort'], resid_out, bpss_out,
+                            run['wb_mask_fname'], wb_ort, wbonly_out, scratch=str(tmp_path))
+    data = np.asanyarray(nib.load(run['in_fname']).dataobj, dtype=np.float64)
+    numvol = data.shape[3]
+    Y = masked(data, run['mask'])
+
+    resid = lstsq_residuals(regress.design(run['ort'], numvol), Y)
+    np.testing.assert_allclose(masked(np.asanyarray(nib.load(resid_out).dataobj), run['mask']), resid, atol=1e-4)
+
+    bpss = regress.bandpass(resid.copy(), TR, threads=1)
+    np.testing.assert_allclose(masked(np.asanyarray(nib.load(bpss_out).dataobj), run['mask']), bpss, atol=1e-4)
+
+    # the whole-brain signal is the mean over its own mask, not the brain mask
+    np.testing.assert_allclose(wb_ts, masked(data, run['wb_mask']).mean(axis=1), rtol=1e-6)
+    wbonly = lstsq_residuals(regress.design(np.column_stack([wb_ts, wb_ort]), numvol), Y)
+    result = np.asanyarray(nib.load(wbonly_out).dataobj)
+    np.testing.assert_allclose(masked(result, run['mask']), wbonly, atol=1e-4)
+    assert not result[run['mask'] == 0].any()
@@ -0,0 +1,74 @@
+'''
+iproc.surface against direct computations, on synthetic geometry. There is
+no FreeSurfer here, so nothing compares it to mri_vol2surf/mri_surf2surf.
+'''
+import numpy as np
+import nibabel as nib
+import scipy.ndimage
+import scipy.sparse
+import iproc.surface as surface
+
+def test_vertex_normals_area_weighted():
+    coords = np.array([[0,0,0], [10,0,0], [0,10,0], [0,0,1], [0,-1,0]], dtype=float)
+    # a large face in z = 0 and a small one in x = 0, around vertex 0
+    faces = np.array([[0,1,2], [0,3,4]])
+    normals = surface.vertex_normals(coords, faces)
+    expected = np.array([0,0,100.]) + np.array([1.,0,0])
+    np.testing.assert_allclose(normals[0], expected / np.linalg.norm(expected))
+    np.testing.assert_allclose(np.linalg.norm(normals, axis=1), 1)
+
+def test_trilinear():
+    rng = np.random.default_rng(0)
+    shape = (6, 5, 4)
+    volume = rng.standard_normal(shape)
+    points = rng.uniform(0, np.array(shape) - 1, (50, 3))
+    points[0] = np.array(shape) - 1
+    points[1] = 0
+    M = surface.trilinear(points, shape)
+    expected = scipy.ndimage.map_coordinates(volume, points.T, order=1)
+    np.testing.assert_allclose(M @ volume.ravel(order='F'), expected)
+
+def test_trilinear_outside():
+    points = np.array([[-0.5, 1, 1], [1, 1, 3.5], [1, 1, 1]])
+    M = surface.trilinear(points, (4, 4, 4))
+    assert M[0].nnz == 0 and M[1].nnz == 0
+    assert M[2].sum() == 1
+
+def _operator():
+    # a strip of vertices 0..4, 0 and 4 outside of the cortex
+    nvert = 5
+    cortex = np.array([False, True, True, True, False])
+    rows,cols = [],[]
+    for i in np.flatnonzero(cortex):
+        for j in (i - 1, i, i + 1):
+            if cortex[j]:
+                rows.append(i)
+                cols.append(j)
+    A = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(nvert, nvert))
+    counts = np.asarray(A.sum(axis=1)).ravel()
+    A = scipy.sparse.diags(np.divide(1, counts, out=np.zeros(nvert), where=counts > 0)) @ A
+    return A.tocsr(),cortex
+
+def test_smooth_without_steps_is_masked():
+    operator,cortex = _operator()
+    X = np.arange(10, dtype=np.float32).reshape(5, 2) + 1
+    out = surface.smooth(X, operator, 0)
+    np.testing.assert_array_equal(out[~cortex], 0)
+    np.testing.assert_array_equal(out[cortex], X[cortex])
+
+def test_smooth():
+    operator,cortex = _operator()
+    X = np.arange(10, dtype=np.float32).reshape(5, 2) + 1
+    expected = X.astype(float)
+    for _ in range(3):
+        expected = operator @ expected
+    np.testing.assert_allclose(surface.smooth(X, operator, 3), expected, rtol=1e-6)
+    np.testing.assert_array_equal(surface.smooth(X, operator, 3)[~cortex], 0)
+
+def test_write_surface(tmp_path):
+    data = np.random.default_rng(1).standard_normal((12, 3)).astype(np.float32)
+    fname = str(tmp_path / 'lh.surf.nii.gz')
+    surface.write_surface(fname, data, str(tmp_path), nthreads=1)
+    img = nib.load(fname)
+    assert img.shape == (2, 1, 6, 3)
+    np.testing.assert_array_equal(np.asarray(img.dataobj).reshape((12, 3), order='F'), data)
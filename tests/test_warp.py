@@ -0,0 +1,122 @@
+'''
+iproc.warp against warps whose FSL result is known analytically: a linear
+image is resampled exactly by trilinear interpolation, so applywarp of it
+through constant warp fields and translation matrices has a closed form.
+'''
+import numpy as np
+import nibabel as nib
+import pytest
+import iproc.warp as warp
+import iproc.xfm as xfm
+
+SHAPE = (12, 14, 10)
+ZOOMS = (2.0, 2.0, 2.5)
+COEFS = np.array([1.0, -2.0, 3.0])
+
+def image(data, radiological=True):
+    affine = np.diag(list(ZOOMS) + [1.0])
+    if radiological:
+        affine[0,0] = -ZOOMS[0]
+    img = nib.Nifti1Image(data.astype(np.float32), affine)
+    img.header.set_zooms(ZOOMS + data.shape[3:])
+    return img
+
+def linear(img, numvol):
+    ''' the linear function of FSL coordinates, over every volume of img '''
+    points = warp.grid_coords(img).reshape(SHAPE + (3,))
+    vol = points @ COEFS + 7.0
+    return np.stack([vol + 10 * i for i in range(numvol)], axis=-1)
+
+def translation(shift):
+    mat = np.eye(4)
+    mat[:3,3] = shift
+    return mat
+
+def expected(ref, in_img, pulled, numvol):
+    '''
+    value of the linear input image at the FSL coordinates pulled, (P,3) per
+    volume, and a mask of the ref voxels of each volume whose sample is well
+    inside the input
+    '''
+    fsl2vox = np.linalg.inv(warp.fsl_affine(in_img))
+    vox = [warp.apply_affine(fsl2vox, p) for p in pulled]
+    inside = np.stack([np.all((v > 0.01) & (v < np.array(SHAPE) - 1.01), axis=1) for v in vox], axis=-1)
+    values = np.stack([p @ COEFS + 7.0 + 10 * i for i,p in enumerate(pulled)], axis=-1)
+    return values.reshape(SHAPE + (numvol,)), inside.reshape(SHAPE + (numvol,))
+
+def write_warp(tmp_path, ref, field, name='warp.nii.gz'):
+    fname = str(tmp_path / name)
+    img = nib.Nifti1Image(field.astype(np.float32), ref.affine)
+    img.header.set_zooms(ZOOMS + (1.0,))
+    nib.save(img, fname)
+    return fname
+
+def run_chain(tmp_path, in_img, ref, premats, **chain):
+    points = warp.convertwarp(ref, **chain)
+    out = warp.create_4d(str(tmp_path / 'out.nii'), ref, len(premats))
+    def write(i, vol):
+        out[...,i] = vol
+    warp.warp_volumes(in_img, ref, points, premats, write, threads=2, chunk=2)
+    out.flush()
+    return np.asarray(nib.load(str(tmp_path / 'out.nii')).dataobj)
+
+@pytest.mark.parametrize('radiological', [True, False])
+@pytest.mark.parametrize('absolute', [False, True])
+def test_warp_and_premat(tmp_path, radiological, absolute):
+    numvol = 3
+    template = image(np.zeros(SHAPE), radiological)
+    in_img = image(linear(template, numvol), radiological)
+    nib.save(in_img, str(tmp_path / 'in.nii'))
+    in_img = warp.open_mmap(str(tmp_path / 'in.nii'), str(tmp_path))
+    ref = image(np.zeros(SHAPE), radiological)
+
+    shift = np.array([0.0, 4.0, -2.5])
+    field = np.broadcast_to(shift, SHAPE + (3,)).copy()
+    points = warp.grid_coords(ref)
+    if absolute:
+        field += points.reshape(SHAPE + (3,))
+    fname = write_warp(tmp_path, ref, field)
+    premats = np.stack([translation([2.0 * i, 0.0, 0.0]) for i in range(numvol)])
+
+    result = run_chain(tmp_path, in_img, ref, premats, warp1=warp.Warp(fname))
+
+    # FSL pulls each ref point through the warp, then through the inverse premat
+    pulled = [points + shift - premats[i,:3,3] for i in range(numvol)]
+    values, inside = expected(ref, in_img, pulled, numvol)
+    assert warp.Warp(fname).absolute == absolute
+    assert inside.sum() > 0.5 * inside.size
+    np.testing.assert_allclose(result[inside], values[inside], atol=1e-3)
+
+def test_postmat_midmat_warp2(tmp_path):
+    numvol = 2
+    ref = image(np.zeros(SHAPE))
+    in_img = image(linear(ref, numvol))
+    nib.save(in_img, str(tmp_path / 'in.nii.gz'))
+    in_img = warp.open_mmap(str(tmp_path / 'in.nii.gz'), str(tmp_path))
+
+    shift1,shift2 = np.array([2.0, 0.0, 0.0]),np.array([0.0, -2.0, 2.5])
+    warp1 = write_warp(tmp_path, ref, np.broadcast_to(shift1, SHAPE + (3,)), 'warp1.nii.gz')
+    warp2 = write_warp(tmp_path, ref, np.broadcast_to(shift2, SHAPE + (3,)), 'warp2.nii.gz')
+    midmat,postmat = translation([0.0, 2.0, 0.0]),translation([-2.0, 0.0, 0.0])
+    premats = np.stack([np.eye(4)] * numvol)
+
+    result = run_chain(tmp_path, in_img, ref, premats,
+                       warp1=warp.Warp(warp1), midmat=midmat, warp2=warp.Warp(warp2), postmat=postmat)
+
+    # convertwarp order, backwards: postmat, warp2, midmat, warp1
+    points = warp.grid_coords(ref)
+    pulled = points - postmat[:3,3] + shift2 - midmat[:3,3] + shift1
+    values, inside = expected(ref, in_img, [pulled] * numvol, numvol)
+    np.testing.assert_allclose(result[inside], values[inside], atol=1e-3)
+
+def test_outside_is_zero(tmp_path):
+    ref = image(np.zeros(SHAPE))
+    nib.save(image(linear(ref, 1) + 100), str(tmp_path / 'in.nii'))
+    in_img = warp.open_mmap(str(tmp_path / 'in.nii'), str(tmp_path))
+    premats = np.stack([translation([-ZOOMS[0] * SHAPE[0], 0.0, 0.0])])
+    result = run_chain(tmp_path, in_img, ref, premats)
+    assert not result.any()
+
+def test_convert_xfm_concat():
+    a,b = translation([1.0, 2.0, 3.0]),np.diag([2.0, 1.0, 1.0, 1.0])
+    np.testing.assert_allclose(xfm.concat(a, b), a @ b)
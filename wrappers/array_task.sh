@@ -0,0 +1,22 @@
+#!/bin/bash
+# runs one task of a job array submitted by iproc.executors.slurm.submit_array.
+# line N+1 of the manifest holds the log file base and the command of array
+# task N, shell quoted. Output goes to the same log names a single sbatch
+# submission of that job would have used, with the array job and task ids in
+# place of the job id.
+# usage: array_task.sh <manifest>
+set -euo pipefail
+manifest=$1
+
+line=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "$manifest")
+if [ -z "$line" ]; then
+    echo "no line for array task ${SLURM_ARRAY_TASK_ID} in ${manifest}" >&2
+    exit 1
+fi
+eval "set -- $line"
+logfile_base=$1
+shift
+
+logname="${logfile_base}_${SLURMD_NODENAME}_${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}"
+exec > "${logname}.out" 2> "${logname}.err"
+exec "$@"
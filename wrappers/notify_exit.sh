@@ -0,0 +1,20 @@
+#!/bin/bash
+# runs a job command and records its exit status in a sentinel file, so that
+# the iproc driver can wake up as soon as the job exits instead of waiting out
+# the full polling interval.
+# usage: notify_exit.sh <sentinel> commandToRun.sh cmdarg1 cmdarg2 cmdarg3
+set -uo pipefail
+sentinel=$1
+shift
+
+write_sentinel() {
+    rc=$?
+    # write to a temporary name first, so the driver never reads a partial file
+    mkdir -p "$(dirname "$sentinel")"
+    echo "$rc" > "${sentinel}.tmp" && mv -f "${sentinel}.tmp" "$sentinel"
+    exit $rc
+}
+trap write_sentinel EXIT
+trap 'exit 143' TERM INT
+
+"$@"